@@ -0,0 +1,281 @@
+import numpy as np
+from joblib import Parallel, delayed
+from typing import Iterator, List, Tuple, NamedTuple, Union
+
+from data.utils.cohort import PackedCohort, apply_nutrient_weights, validate_nutrients
+from data.utils.modified_mdtw import LOCAL_COST_BLOCK_SIZE, events_to_arrays, local_cost_matrix
+
+# Operation of every step of an alignment
+MATCH = 0
+FIRST_TO_EMPTY = 1
+SECOND_TO_EMPTY = 2
+
+
+class Alignment(NamedTuple):
+    """
+    Optimal warping path between two sequences of events.
+
+    Attributes:
+        distance (float): MDTW distance, the sum of ``costs``.
+        first (np.ndarray): Index of the event of the first sequence in every step, -1 where an
+            event of the second sequence is matched to empty.
+        second (np.ndarray): Index of the event of the second sequence in every step, -1 where an
+            event of the first sequence is matched to empty.
+        operations (np.ndarray): ``MATCH``, ``FIRST_TO_EMPTY`` or ``SECOND_TO_EMPTY`` for every step.
+        costs (np.ndarray): Local cost of every step.
+    """
+    distance: float
+    first: np.ndarray
+    second: np.ndarray
+    operations: np.ndarray
+    costs: np.ndarray
+
+
+def _masked_costs(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray,
+                  delta: float, beta: float, alpha: float, max_time_gap: float) -> np.ndarray:
+    costs = local_cost_matrix(t1, V1, t2, V2, delta, beta, alpha, sq1, sq2)
+    if max_time_gap is not None:
+        costs[np.abs(t1[:, None] - t2[None, :]) > max_time_gap] = np.inf
+    return costs
+
+
+def _last_row(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray,
+              delta: float, beta: float, alpha: float, max_time_gap: float) -> np.ndarray:
+    """
+    Last row of the MDTW cost matrix, i.e. the cost of reaching state (m1, j) for every j.
+
+    Rows are solved as in ``_mdtw_dp``, keeping only two of them and one block of local costs.
+    """
+    m2 = len(t2)
+    block_rows = max(1, LOCAL_COST_BLOCK_SIZE // max(m2, 1))
+    offsets = np.zeros(m2 + 1)
+    np.cumsum(sq2, out=offsets[1:])
+    prev_row = offsets.copy()
+    curr_row = np.empty(m2 + 1)
+    for start in range(0, len(t1), block_rows):
+        stop = min(start + block_rows, len(t1))
+        local_costs = _masked_costs(t1[start:stop], V1[start:stop], sq1[start:stop], t2, V2, sq2, delta, beta, alpha, max_time_gap)
+        for i in range(start, stop):
+            curr_row[0] = prev_row[0] + sq1[i]
+            np.minimum(prev_row[1:] + sq1[i], prev_row[:-1] + local_costs[i - start], out=curr_row[1:])
+            curr_row -= offsets
+            np.minimum.accumulate(curr_row, out=curr_row)
+            curr_row += offsets
+            prev_row, curr_row = curr_row, prev_row
+    return prev_row
+
+
+def _full_alignment(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray,
+                    delta: float, beta: float, alpha: float, max_time_gap: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Optimal path of a small problem from the whole table of moves, one byte per DP state.
+
+    Returns:
+        tuple: Event indices into both sequences of every step, -1 for empty.
+    """
+    m1, m2 = len(t1), len(t2)
+    local_costs = _masked_costs(t1, V1, sq1, t2, V2, sq2, delta, beta, alpha, max_time_gap)
+    offsets = np.zeros(m2 + 1)
+    np.cumsum(sq2, out=offsets[1:])
+
+    # Moves into each state, as in ``_windowed_dp``: 0 from above, 1 diagonal, 2 from the left
+    moves = np.full((m1 + 1, m2 + 1), 2, dtype=np.int8)
+    prev_row = offsets.copy()
+    diagonal = np.full(m2 + 1, np.inf)
+    for i in range(1, m1 + 1):
+        vertical = prev_row + sq1[i - 1]
+        diagonal[1:] = prev_row[:-1] + local_costs[i - 1]
+        candidate = np.minimum(vertical, diagonal) - offsets
+        curr_row = np.minimum.accumulate(candidate)
+        moves[i] = np.where(curr_row < candidate, 2, diagonal < vertical)
+        prev_row = curr_row + offsets
+
+    first, second = [], []
+    i, j = m1, m2
+    while i > 0 or j > 0:
+        move = moves[i, j]
+        if move == 2:
+            j -= 1
+            first.append(-1)
+            second.append(j)
+        elif move == 1:
+            i, j = i - 1, j - 1
+            first.append(i)
+            second.append(j)
+        else:
+            i -= 1
+            first.append(i)
+            second.append(-1)
+    return np.array(first[::-1], dtype=np.int64), np.array(second[::-1], dtype=np.int64)
+
+
+def _shift(indices: np.ndarray, offset: int) -> np.ndarray:
+    return np.where(indices >= 0, indices + offset, -1)
+
+
+def _hirschberg(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray,
+                delta: float, beta: float, alpha: float, max_time_gap: float, max_cells: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Optimal path by divide and conquer over the rows.
+
+    The cost of the best path through state (mid, j) is the forward cost of reaching it
+    plus the cost of going on from it to (m1, m2), which is the forward cost of the
+    reversed suffixes. Both are last rows of a two-row DP; the best j splits the problem
+    into two independent halves. Problems of at most ``max_cells`` states, or with a single
+    row, are solved directly. Memory stays O(m2 + max_cells) and the work about twice
+    that of the distance alone.
+    """
+    m1, m2 = len(t1), len(t2)
+    if m1 == 0 or m2 == 0:
+        return (np.concatenate([np.arange(m1), np.full(m2, -1)]).astype(np.int64),
+                np.concatenate([np.full(m1, -1), np.arange(m2)]).astype(np.int64))
+    if m1 == 1 or (m1 + 1) * (m2 + 1) <= max_cells:
+        return _full_alignment(t1, V1, sq1, t2, V2, sq2, delta, beta, alpha, max_time_gap)
+
+    mid = m1 // 2
+    forward = _last_row(t1[:mid], V1[:mid], sq1[:mid], t2, V2, sq2, delta, beta, alpha, max_time_gap)
+    backward = _last_row(t1[:mid - 1:-1], V1[:mid - 1:-1], sq1[:mid - 1:-1], t2[::-1], V2[::-1], sq2[::-1],
+                         delta, beta, alpha, max_time_gap)[::-1]
+    j = int(np.argmin(forward + backward))
+
+    first_top, second_top = _hirschberg(t1[:mid], V1[:mid], sq1[:mid], t2[:j], V2[:j], sq2[:j], delta, beta, alpha, max_time_gap, max_cells)
+    first_bottom, second_bottom = _hirschberg(t1[mid:], V1[mid:], sq1[mid:], t2[j:], V2[j:], sq2[j:], delta, beta, alpha, max_time_gap, max_cells)
+    return np.concatenate([first_top, _shift(first_bottom, mid)]), np.concatenate([second_top, _shift(second_bottom, j)])
+
+
+def mdtw_alignment_vectorized(t1: np.ndarray, V1: np.ndarray, t2: np.ndarray, V2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2,
+                              sq1: np.ndarray = None, sq2: np.ndarray = None, max_time_gap: float = None,
+                              max_cells: int = LOCAL_COST_BLOCK_SIZE) -> Alignment:
+    """
+    Find an optimal MDTW warping path between two sequences given as stacked arrays.
+
+    Uses Hirschberg's divide and conquer, so memory grows linearly with the sequence
+    lengths instead of holding the (m1 + 1) x (m2 + 1) cost matrix. No validation is
+    performed; nutrients are expected to be normalized already.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence, shape (m1,).
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        t2 (np.ndarray): Event times of the second sequence, shape (m2,).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        sq1 (np.ndarray, optional): Precomputed squared norms of V1.
+        sq2 (np.ndarray, optional): Precomputed squared norms of V2.
+        max_time_gap (float, optional): Largest time difference allowed between matched events,
+            see ``mdtw_distance_vectorized``.
+        max_cells (int): Subproblems with at most this many DP states are solved from a full
+            table of moves.
+
+    Returns:
+        Alignment: Distance and the steps of the path, in order.
+    """
+    if sq1 is None:
+        sq1 = np.einsum('ij,ij->i', V1, V1)
+    if sq2 is None:
+        sq2 = np.einsum('ij,ij->i', V2, V2)
+    first, second = _hirschberg(t1, V1, sq1, t2, V2, sq2, delta, beta, alpha, max_time_gap, max_cells)
+
+    operations = np.where(first < 0, SECOND_TO_EMPTY, np.where(second < 0, FIRST_TO_EMPTY, MATCH)).astype(np.int8)
+    costs = np.zeros(len(first))
+    costs[operations == FIRST_TO_EMPTY] = sq1[first[operations == FIRST_TO_EMPTY]]
+    costs[operations == SECOND_TO_EMPTY] = sq2[second[operations == SECOND_TO_EMPTY]]
+    matched = operations == MATCH
+    i, j = first[matched], second[matched]
+    cross = np.einsum('kd,kd->k', V1[i], V2[j])
+    costs[matched] = (np.maximum(sq1[i] + sq2[j] - 2 * cross, 0)
+                      + 2 * beta * cross * (np.abs(t1[i] - t2[j]) / delta) ** alpha)
+    return Alignment(float(costs.sum()), first, second, operations, costs)
+
+
+def mdtw_alignment(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2,
+                   max_time_gap: float = None, validate: bool = True, W=None) -> Alignment:
+    """
+    Find which events of two sequences are matched with each other and which with empty.
+
+    Args:
+        ER1 (list): First sequence of events (time, nutrients).
+        ER2 (list): Second sequence of events (time, nutrients).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        validate (bool): Check the nutrient values; pass False for sequences that come from
+            ``prepare_person``, which already validated them.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        Alignment: Distance and the steps of an optimal path, see ``mdtw_alignment_vectorized``.
+    """
+    t1, V1 = events_to_arrays(ER1)
+    t2, V2 = events_to_arrays(ER2)
+    if len(t1) == 0:
+        V1 = np.zeros((0, V2.shape[1]))
+    if len(t2) == 0:
+        V2 = np.zeros((0, V1.shape[1]))
+    if validate and len(t1) and len(t2):
+        validate_nutrients(V1, V2)
+    if W is not None:
+        V1, V2 = apply_nutrient_weights(V1, W), apply_nutrient_weights(V2, W)
+    return mdtw_alignment_vectorized(t1, V1, t2, V2, delta, beta, alpha, max_time_gap=max_time_gap)
+
+
+def _align_rows(cohort: PackedCohort, rows: np.ndarray, targets: np.ndarray, delta: float, beta: float, alpha: float,
+                max_time_gap: float) -> List[Alignment]:
+    alignments = []
+    for i, medoid in zip(rows, targets):
+        t1, V1, sq1 = cohort.person(i)
+        t2, V2, sq2 = cohort.person(medoid)
+        alignments.append(mdtw_alignment_vectorized(t1, V1, t2, V2, delta, beta, alpha, sq1, sq2, max_time_gap))
+    return alignments
+
+
+def align_to_medoids(prepared_data: Union[dict, PackedCohort], medoids, labels, delta: float = 23, beta: float = 1, alpha: float = 2,
+                     max_time_gap: float = None, n_jobs: int = 1, block_size: int = 64, W=None) -> Iterator[Alignment]:
+    """
+    Align every person with the medoid of its cluster, e.g. to explain a ``clara`` result.
+
+    Alignments are produced in the order of the cohort, one block of persons per joblib
+    task, and each one only needs memory linear in the two sequence lengths.
+
+    Args:
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        medoids (array-like): Cohort indices of the medoids, shape (k,).
+        labels (array-like): Index into ``medoids`` of every person's cluster, shape (n,).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        n_jobs (int): Number of joblib workers, -1 for all cores.
+        block_size (int): Persons per joblib task.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        Iterator[Alignment]: Alignment of every person (first sequence) with its medoid (second sequence).
+    """
+    cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+    cohort = cohort.weighted(W)
+    medoids = np.asarray(medoids, dtype=np.int64)
+    labels = np.asarray(labels, dtype=np.int64)
+    if len(labels) != len(cohort):
+        raise ValueError("There must be one label per person.")
+    if len(medoids) == 0 or labels.min() < 0 or labels.max() >= len(medoids):
+        raise ValueError("Labels must index into the medoids.")
+    if medoids.min() < 0 or medoids.max() >= len(cohort):
+        raise ValueError("Medoids must be indices of persons in the cohort.")
+
+    targets = medoids[labels]
+    blocks = [np.arange(start, min(start + block_size, len(cohort))) for start in range(0, len(cohort), block_size)]
+    arguments = [(cohort, rows, targets[rows], delta, beta, alpha, max_time_gap) for rows in blocks]
+    return _iter_alignments(arguments, n_jobs)
+
+
+def _iter_alignments(arguments: list, n_jobs: int) -> Iterator[Alignment]:
+    if n_jobs == 1:
+        parts = (_align_rows(*args) for args in arguments)
+    else:
+        parts = Parallel(n_jobs=n_jobs, return_as='generator')(delayed(_align_rows)(*args) for args in arguments)
+    for part in parts:
+        yield from part
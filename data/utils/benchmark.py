@@ -0,0 +1,278 @@
+"""
+Offline benchmark suite for the MDTW kernels and the distance matrix build.
+
+Every input is built from ``generate_synthetic_data``, so results can be
+reproduced without data access. Typical use::
+
+    python -m data.utils.benchmark --save benchmarks.json               # record a baseline
+    python -m data.utils.benchmark --baseline benchmarks.json --threshold 0.25
+
+The second command exits with status 1 when a timing or peak memory exceeds the
+baseline by more than the threshold. The approximate ``mdtw_distance_fast`` cases
+also report their relative error against the exact distance, and the cached matrix
+builds their time relative to computing every pair.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from functools import partial
+from itertools import count
+from typing import List, Dict, Tuple
+
+from data.utils.cache import DistanceCache
+from data.utils.cohort import prepare_cohort
+from data.utils.fast_mdtw import mdtw_distance_fast
+from data.utils.modified_mdtw import (calculate_distance_matrix, generate_synthetic_data, local_distance, mdtw_distance,
+                                      mdtw_distance_optimized, prepare_person)
+
+
+def benchmark_events(length: int, n_features: int = 1) -> List[Tuple[float, List[float]]]:
+    """
+    Build a prepared event sequence of a given length from synthetic persons.
+
+    ``generate_synthetic_data`` gives at most 24 meals a day, so consecutive
+    synthetic persons are laid out as consecutive days, and every nutrient
+    column comes from a different run of days.
+
+    Args:
+        length (int): Number of events.
+        n_features (int): Number of nutrients per event.
+
+    Returns:
+        list: Events as (time, normalized nutrients) tuples.
+    """
+    days = math.ceil(length / 24)
+    persons = generate_synthetic_data(num_people=days * n_features, min_meals=24, max_meals=24)
+    calories = np.array([[record['nutrients'][0] for record in person['records']] for person in persons])
+    calories = calories.reshape(n_features, -1)[:, :length]
+    records = [{'time': float(24 * (k // 24) + k % 24), 'nutrients': calories[:, k].tolist()} for k in range(length)]
+    return list(prepare_person({'person_id': 'benchmark', 'records': records}).items())
+
+
+def measure(function: callable, *args, repeat: int = 3, number: int = 1) -> Dict[str, float]:
+    """
+    Time a call and record its peak traced memory.
+
+    The peak comes from a first call under ``tracemalloc``, which sees NumPy
+    buffers as well as Python objects and doubles as a warm-up. Timings are then
+    taken without tracing.
+
+    Args:
+        function (callable): Function to benchmark.
+        *args: Arguments of the call.
+        repeat (int): Number of timed repetitions; the fastest is kept.
+        number (int): Calls per repetition.
+
+    Returns:
+        dict: Seconds per call and peak memory in bytes.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function(*args)
+        timings.append((time.perf_counter() - start) / number)
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+
+def run_benchmarks(lengths: Tuple[int, ...] = (10, 50, 200), n_features: Tuple[int, ...] = (1, 3, 8),
+                   matrix_sizes: Tuple[int, ...] = (100, 1000, 10000), repeat: int = 3,
+                   reference_max_length: int = 200) -> Dict[str, Dict[str, float]]:
+    """
+    Run the benchmark suite.
+
+    Args:
+        lengths (tuple): Sequence lengths for the pairwise kernels.
+        n_features (tuple): Nutrients per event for the pairwise kernels.
+        matrix_sizes (tuple): Cohort sizes for ``calculate_distance_matrix``.
+        repeat (int): Timed repetitions per case.
+        reference_max_length (int): Longest sequence given to the cell-by-cell ``mdtw_distance``.
+
+    Returns:
+        dict: Seconds per call and peak memory for every case, keyed by case name.
+    """
+    results = {}
+    for d in n_features:
+        events = benchmark_events(2, d)
+        results[f"local_distance[n_features={d}]"] = measure(local_distance, events[0], events[1], repeat=repeat, number=1000)
+        for length in lengths:
+            events = benchmark_events(2 * length, d)
+            ER1, ER2 = events[::2], events[1::2]
+            name = f"[length={length},n_features={d}]"
+            if length <= reference_max_length:
+                results["mdtw_distance" + name] = measure(mdtw_distance, ER1, ER2, repeat=repeat)
+            results["mdtw_distance_optimized" + name] = measure(mdtw_distance_optimized, ER1, ER2, repeat=repeat)
+
+    for n in matrix_sizes:
+        prepared_data = {person['person_id']: prepare_person(person) for person in generate_synthetic_data(num_people=n)}
+        results[f"calculate_distance_matrix[n={n}]"] = measure(calculate_distance_matrix, prepared_data, repeat=1 if n > 1000 else repeat)
+    return results
+
+
+def run_approximation_benchmarks(lengths: Tuple[int, ...] = (200, 1000, 5000), radii: Tuple[int, ...] = (0, 1, 4, 16),
+                                 repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the approximate ``mdtw_distance_fast`` with the exact ``mdtw_distance_optimized``.
+
+    The second sequence is shifted by 40 minutes so that the optimal path is not
+    trivially the diagonal.
+
+    Args:
+        lengths (tuple): Sequence lengths.
+        radii (tuple): Radii of the approximation.
+        repeat (int): Timed repetitions per case.
+
+    Returns:
+        dict: Seconds per call and peak memory for every case, keyed by case name; the
+        approximate cases add their relative error and relative error bound.
+    """
+    results = {}
+    for length in lengths:
+        events = benchmark_events(2 * length)
+        ER1 = events[::2]
+        ER2 = [(t + 2 / 3, v) for t, v in events[1::2]]
+        exact = mdtw_distance_optimized(ER1, ER2)
+        results[f"mdtw_distance_optimized[length={length},n_features=1]"] = measure(mdtw_distance_optimized, ER1, ER2, repeat=repeat)
+        for radius in radii:
+            result = measure(partial(mdtw_distance_fast, radius=radius), ER1, ER2, repeat=repeat)
+            approximation = mdtw_distance_fast(ER1, ER2, radius=radius)
+            result['relative_error'] = approximation.distance / exact - 1 if exact > 0 else 0.0
+            result['relative_error_bound'] = approximation.error_bound / exact if exact > 0 else 0.0
+            results[f"mdtw_distance_fast[length={length},radius={radius}]"] = result
+    return results
+
+
+def run_cache_benchmarks(sizes: Tuple[int, ...] = (1500,), repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Time matrix builds through a ``DistanceCache`` against computing every pair.
+
+    A cold build starts from an empty cache and stores every pair; a warm build
+    rebuilds the same cohort from a cache filled by an earlier build.
+
+    Args:
+        sizes (tuple): Cohort sizes.
+        repeat (int): Timed repetitions per case.
+
+    Returns:
+        dict: Seconds per call and peak memory for every case, keyed by case name; the
+        cached cases add their time relative to the build without cache.
+    """
+    results = {}
+    directory = tempfile.mkdtemp(prefix='mdtw_cache_')
+    try:
+        for n in sizes:
+            cohort = prepare_cohort(generate_synthetic_data(num_people=n))
+            paths = (os.path.join(directory, f"{n}_{k}.sqlite") for k in count())
+            recompute = results[f"calculate_distance_matrix[n={n}]"] = measure(calculate_distance_matrix, cohort, repeat=repeat)
+            cold = measure(lambda: calculate_distance_matrix(cohort, cache=DistanceCache(next(paths))), repeat=repeat)
+            warm_path = next(paths)
+            calculate_distance_matrix(cohort, cache=DistanceCache(warm_path))
+            warm = measure(lambda: calculate_distance_matrix(cohort, cache=DistanceCache(warm_path)), repeat=repeat)
+            for name, result in (('cold', cold), ('warm', warm)):
+                result['relative_time'] = result['seconds'] / recompute['seconds']
+                results[f"calculate_distance_matrix[n={n},cache={name}]"] = result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def save_baseline(results: Dict[str, Dict[str, float]], path: str) -> None:
+    """
+    Write benchmark results to a JSON baseline together with the environment they ran in.
+
+    Args:
+        results (dict): Output of ``run_benchmarks``.
+        path (str): Destination file.
+    """
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                   'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+    with open(path, 'w') as file:
+        json.dump({'environment': environment, 'results': results}, file, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    Read the results of a baseline written by ``save_baseline``.
+    """
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def compare_to_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float = 0.25,
+                        memory_threshold: float = None) -> List[str]:
+    """
+    Find the cases that got slower or use more memory than the baseline.
+
+    Args:
+        results (dict): Output of ``run_benchmarks``.
+        baseline (dict): Baseline results; cases missing from either side are skipped.
+        threshold (float): Allowed relative increase of the time per call.
+        memory_threshold (float, optional): Allowed relative increase of the peak memory, ``threshold`` by default.
+
+    Returns:
+        list: One message per regression, empty when there is none.
+    """
+    memory_threshold = threshold if memory_threshold is None else memory_threshold
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        for metric, allowed in (('seconds', threshold), ('peak_bytes', memory_threshold)):
+            current, reference = results[name][metric], baseline[name][metric]
+            if reference > 0 and current > reference * (1 + allowed):
+                regressions.append(f"{name} {metric}: {current:.6g} vs baseline {reference:.6g} (+{current / reference - 1:.0%})")
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the MDTW kernels and the distance matrix build.")
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--n-features', type=int, nargs='+', default=[1, 3, 8])
+    parser.add_argument('--matrix-sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--fast-lengths', type=int, nargs='*', default=[200, 1000, 5000],
+                        help="Sequence lengths for the approximate against exact comparison.")
+    parser.add_argument('--radii', type=int, nargs='+', default=[0, 1, 4, 16])
+    parser.add_argument('--cache-sizes', type=int, nargs='*', default=[1500],
+                        help="Cohort sizes for the builds through a distance cache.")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare against this JSON baseline.")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed relative slowdown.")
+    parser.add_argument('--memory-threshold', type=float, help="Allowed relative increase of peak memory.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(tuple(args.lengths), tuple(args.n_features), tuple(args.matrix_sizes), args.repeat)
+    results.update(run_approximation_benchmarks(tuple(args.fast_lengths), tuple(args.radii), args.repeat))
+    results.update(run_cache_benchmarks(tuple(args.cache_sizes), args.repeat))
+    for name, result in results.items():
+        line = f"{name:60s} {result['seconds'] * 1e3:12.4f} ms {result['peak_bytes'] / 2 ** 20:10.2f} MiB"
+        if 'relative_error' in result:
+            line += f" error {result['relative_error']:9.2e} (bound {result['relative_error_bound']:.2e})"
+        if 'relative_time' in result:
+            line += f" {result['relative_time']:.2f}x uncached"
+        print(line)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.baseline:
+        regressions = compare_to_baseline(results, load_baseline(args.baseline), args.threshold, args.memory_threshold)
+        for message in regressions:
+            print("REGRESSION", message)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
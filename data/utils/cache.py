@@ -0,0 +1,386 @@
+import hashlib
+import sqlite3
+import struct
+import threading
+import numpy as np
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
+from typing import Dict
+
+from data.utils.cohort import PackedCohort
+
+# Memory, in KiB, SQLite may use to keep the pages of the cache file of every connection
+CACHE_PAGES_KIB = 256 * 1024
+# Entries read per query by DistanceCache.preload
+PRELOAD_PAGE = 1 << 20
+
+
+def sequence_hash(times: np.ndarray, nutrients: np.ndarray) -> bytes:
+    """
+    Stable content hash of a prepared sequence.
+
+    Args:
+        times (np.ndarray): Event times, shape (m,).
+        nutrients (np.ndarray): Normalized nutrients, shape (m, d).
+
+    Returns:
+        bytes: 16-byte digest, equal for sequences with identical times and nutrients.
+    """
+    nutrients = np.ascontiguousarray(nutrients, dtype=np.float64)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(struct.pack('<qq', *nutrients.reshape(len(times), -1).shape))
+    digest.update(np.ascontiguousarray(times, dtype='<f8').tobytes())
+    digest.update(nutrients.astype('<f8', copy=False).tobytes())
+    return digest.digest()
+
+
+def _hash64(digest: bytes) -> int:
+    return int.from_bytes(digest[:8], 'little')
+
+
+def cohort_hashes(cohort: PackedCohort) -> np.ndarray:
+    """
+    Content hash of every person of a packed cohort, truncated to 64 bits for ``pair_keys``.
+    """
+    return np.array([_hash64(sequence_hash(*cohort.person(i)[:2])) for i in range(len(cohort))], dtype=np.uint64)
+
+
+def parameters_key(delta: float, beta: float, alpha: float, max_time_gap: float = None) -> bytes:
+    """
+    Encode the distance parameters for use in pair keys.
+    """
+    return struct.pack('<dddd', delta, beta, alpha, np.nan if max_time_gap is None else max_time_gap)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # SplitMix64 finalizer; uint64 arithmetic wraps around
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+@lru_cache(maxsize=64)
+def _salt(parameters: bytes) -> np.uint64:
+    return np.uint64(_hash64(hashlib.blake2b(parameters, digest_size=8).digest()))
+
+
+def pair_keys(hashes1, hashes2, parameters: bytes) -> np.ndarray:
+    """
+    Cache keys of pairs of sequences under given parameters, independent of pair order.
+
+    Keys are 64-bit, computed without a Python loop so that a warm matrix build
+    spends its time in the cache lookups; the chance of any collision among ten
+    million stored pairs is below one in 300,000.
+
+    Args:
+        hashes1 (array-like): 64-bit hashes of the first sequences, from ``cohort_hashes``.
+        hashes2 (array-like): 64-bit hashes of the second sequences, broadcast against hashes1.
+        parameters (bytes): Output of ``parameters_key``.
+
+    Returns:
+        np.ndarray: Signed 64-bit keys, as stored by SQLite.
+    """
+    hashes1, hashes2 = np.atleast_1d(np.asarray(hashes1, dtype=np.uint64)), np.atleast_1d(np.asarray(hashes2, dtype=np.uint64))
+    return _mix(np.minimum(hashes1, hashes2) ^ _mix(np.maximum(hashes1, hashes2) ^ _salt(parameters))).view(np.int64)
+
+
+def pair_key(hash1: bytes, hash2: bytes, parameters: bytes) -> int:
+    """
+    Cache key of a pair of sequences given by their ``sequence_hash``, see ``pair_keys``.
+    """
+    return int(pair_keys(_hash64(hash1), _hash64(hash2), parameters)[0])
+
+
+class DistanceCache:
+    """
+    Persistent cache of pairwise MDTW distances in a local SQLite file.
+
+    Lookups only read the file. New distances, recency updates and hit and miss
+    counts are buffered in memory until ``flush``, which writes them in one
+    transaction; matrix builds flush when the buffers fill up and once every
+    worker is done with its tiles, so workers rarely wait for the write lock,
+    and the file is in WAL mode so readers never do.
+
+    Entries are keyed by ``pair_keys``. Once the entry count, kept in the
+    counters table, exceeds ``max_entries``, the least recently used entries are
+    evicted in one batch down to ``low_water * max_entries``. Recency is
+    approximate: an entry read back is only marked as used again once more than
+    half of ``max_entries`` was stored after it, so rebuilding an unchanged cohort
+    writes nothing. Hit, miss and eviction counts are stored in the same file, so
+    they add up across processes and runs. The object can be sent to worker
+    processes, where it opens its own connection and buffers, and shared by
+    threads: every thread gets its own connection and a lock guards the buffers.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10_000_000, low_water: float = 0.9, buffer_size: int = 1 << 18):
+        """
+        Args:
+            path (str): SQLite database file, created if missing.
+            max_entries (int): Largest number of distances kept.
+            low_water (float): Fraction of ``max_entries`` left after an eviction.
+            buffer_size (int): Pending distances and recency updates that trigger a flush.
+        """
+        if not 0 < low_water <= 1:
+            raise ValueError("low_water must be in (0, 1].")
+        self.path = path
+        self.max_entries = max_entries
+        self.low_water = low_water
+        self.buffer_size = buffer_size
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._reset_buffers()
+        self._connect().execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as connection:
+            # Distances are stored as the bits of the float64, which SQLite prints exactly, see preload
+            connection.execute("CREATE TABLE IF NOT EXISTS distances (key INTEGER PRIMARY KEY, bits INTEGER NOT NULL, used INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS distances_used ON distances (used)")
+            connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            connection.executemany("INSERT OR IGNORE INTO counters VALUES (?, 0)", [('hits',), ('misses',), ('evictions',), ('clock',)])
+            connection.execute("INSERT OR IGNORE INTO counters SELECT 'entries', COUNT(*) FROM distances")
+            self._clock = self._counter(connection, 'clock')
+
+    def _reset_buffers(self) -> None:
+        self._pending = []
+        self._n_pending = 0
+        self._touched = []
+        self._n_touched = 0
+        self._hits = self._misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads, so every thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are opened explicitly by _transaction
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # Losing the last transactions on a power failure only loses cached distances
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # Pair keys are random, so lookups hit pages all over the file
+            connection.execute(f"PRAGMA cache_size=-{CACHE_PAGES_KIB}")
+            connection.execute(f"PRAGMA mmap_size={CACHE_PAGES_KIB * 1024}")
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        # Take the write lock up front: a read transaction that later writes fails at once in WAL mode
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _counter(connection: sqlite3.Connection, name: str) -> int:
+        return connection.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        state.update(_pending=[], _n_pending=0, _touched=[], _n_touched=0, _hits=0, _misses=0)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        self.flush()
+        return self._counter(self._connect(), 'entries')
+
+    @property
+    def _stale_clock(self) -> int:
+        # Entries last used before this are marked as used again when read
+        return self._clock - self.max_entries // 2
+
+    def preload(self) -> None:
+        """
+        Read every stored entry into memory, about 32 bytes per entry, until ``release``.
+
+        ``get_many`` then finds keys with NumPy instead of one SQLite search per key,
+        and keys missing from the preloaded entries are reported missing, so pairs
+        stored meanwhile by other processes are computed again. Reading an entry costs
+        a small fraction of a keyed search, so this pays off when a build looks up a
+        good part of the cache, e.g. when rebuilding a cohort that barely changed. The
+        arrays go along to worker processes.
+        """
+        self.flush()
+        connection = self._connect()
+        columns = [[], []]
+        last = None
+        while True:
+            # Whole columns come back as text, much faster than one Python tuple per row
+            where = "" if last is None else f"WHERE key > {last}"
+            page = connection.execute(f"SELECT group_concat(key), group_concat(bits), max(key) FROM "
+                                      f"(SELECT key, bits FROM distances {where} ORDER BY key LIMIT {PRELOAD_PAGE})").fetchone()
+            if page[2] is None:
+                break
+            for parts, text in zip(columns, page):
+                parts.append(np.fromstring(text, dtype=np.int64, sep=','))
+            last = page[2]
+        keys, bits = (np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64) for parts in columns)
+        order = np.argsort(keys)
+        keys, distances = keys[order], bits[order].view(np.float64)
+
+        # Sorted keys are spread evenly, so the leading bits of a key nearly give its position
+        n_bits = max(1, len(keys).bit_length())
+        shift = np.int64(64 - n_bits)
+        starts = np.searchsorted(keys >> shift, np.arange(-2 ** (n_bits - 1), 2 ** (n_bits - 1) + 1))
+        stale = connection.execute("SELECT group_concat(key) FROM distances WHERE used < ?", (self._stale_clock,)).fetchone()[0]
+        stale = np.sort(np.fromstring(stale or '', dtype=np.int64, sep=','))
+        self._snapshot = (keys, distances, starts, shift, stale)
+
+    def release(self) -> None:
+        """
+        Drop the entries read by ``preload``.
+        """
+        self._snapshot = None
+
+    def _touch(self, keys: np.ndarray) -> None:
+        if len(keys):
+            with self._lock:
+                self._touched.append(keys)
+                self._n_touched += len(keys)
+
+    def _get_preloaded(self, keys: np.ndarray) -> np.ndarray:
+        stored, distances, starts, shift, stale = self._snapshot
+        values = np.full(len(keys), np.nan)
+        if not len(stored):
+            return values
+        bucket = (keys >> shift) + len(starts) // 2
+        position, end = starts[bucket], starts[bucket + 1]
+        # Walk the few stored keys sharing the leading bits of each key
+        while True:
+            ahead = (position < end) & (stored[np.minimum(position, len(stored) - 1)] < keys)
+            if not ahead.any():
+                break
+            position += ahead
+        position = np.minimum(position, len(stored) - 1)
+        matched = stored[position] == keys
+        values[matched] = distances[position[matched]]
+        if len(stale):
+            self._touch(keys[matched][np.isin(keys[matched], stale)])
+        return values
+
+    def _get_stored(self, keys: np.ndarray) -> np.ndarray:
+        values = np.full(len(keys), np.nan)
+        order = np.argsort(keys)
+        connection = self._connect()
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            targets = order[start:start + 500]
+            rows = connection.execute(f"SELECT key, bits, used FROM distances WHERE key IN ({','.join('?' * len(targets))})",
+                                      keys[targets].tolist()).fetchall()
+            if not rows:
+                continue
+            found, bits, used = (np.array(column, dtype=np.int64) for column in zip(*rows))
+            sorter = np.argsort(found)
+            # Search from the queried side, which repeats the key of persons with identical sequences
+            position = sorter[np.minimum(np.searchsorted(found, keys[targets], sorter=sorter), len(found) - 1)]
+            matched = found[position] == keys[targets]
+            values[targets[matched]] = bits[position[matched]].view(np.float64)
+            self._touch(found[used < self._stale_clock])
+        return values
+
+    def get_many(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Look up several pairs at once, among the preloaded entries if any.
+
+        Args:
+            keys (np.ndarray): Pair keys from ``pair_keys``.
+
+        Returns:
+            np.ndarray: Distance of every key, NaN when it is not in the cache.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        values = self._get_stored(keys) if self._snapshot is None else self._get_preloaded(keys)
+        hits = int(np.count_nonzero(~np.isnan(values)))
+        with self._lock:
+            self._hits += hits
+            self._misses += len(keys) - hits
+            if self._n_touched >= self.buffer_size:
+                self.flush()
+        return values
+
+    def put_many(self, keys: np.ndarray, distances: np.ndarray) -> None:
+        """
+        Store several pair distances; they are written, and found by ``get_many``, at the next ``flush``.
+
+        Args:
+            keys (np.ndarray): Pair keys from ``pair_keys``.
+            distances (np.ndarray): Distance of every pair.
+        """
+        pending = (np.asarray(keys, dtype=np.int64), np.asarray(distances, dtype=np.float64).view(np.int64))
+        with self._lock:
+            self._pending.append(pending)
+            self._n_pending += len(pending[0])
+            if self._n_pending >= self.buffer_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered distances, recency updates and counts in one transaction,
+        evicting least recently used entries if the cache is over capacity.
+        """
+        with self._lock:
+            if not (self._pending or self._touched or self._hits or self._misses):
+                return
+            empty = (np.zeros(0, dtype=np.int64),) * 2
+            keys, bits = (np.concatenate(column) for column in zip(*self._pending)) if self._pending else empty
+            # Inserting in key order keeps SQLite on neighbouring pages
+            keys, first = np.unique(keys, return_index=True)
+            with self._transaction() as connection:
+                clock = self._counter(connection, 'clock') + len(keys)
+                inserted = connection.executemany("INSERT OR IGNORE INTO distances VALUES (?, ?, ?)",
+                                                  zip(keys.tolist(), bits[first].tolist(), repeat(clock))).rowcount
+                if self._touched:
+                    connection.executemany("UPDATE distances SET used = ? WHERE key = ?",
+                                           zip(repeat(clock), np.unique(np.concatenate(self._touched)).tolist()))
+                connection.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                       [(len(keys), 'clock'), (self._hits, 'hits'), (self._misses, 'misses'), (inserted, 'entries')])
+                entries = self._counter(connection, 'entries')
+                if entries > self.max_entries:
+                    excess = entries - int(self.low_water * self.max_entries)
+                    evicted = connection.execute("DELETE FROM distances WHERE key IN (SELECT key FROM distances ORDER BY used LIMIT ?)",
+                                                 (excess,)).rowcount
+                    connection.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                           [(-evicted, 'entries'), (evicted, 'evictions')])
+            self._clock = clock
+            self._reset_buffers()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Cache statistics, after flushing the buffers.
+
+        Returns:
+            dict: Number of hits, misses, evictions and stored entries.
+        """
+        self.flush()
+        return dict(self._connect().execute("SELECT name, value FROM counters WHERE name != 'clock'").fetchall())
+
+    def clear(self) -> None:
+        """
+        Remove every entry and reset the statistics.
+        """
+        with self._lock:
+            self._reset_buffers()
+            self._snapshot = None
+            with self._transaction() as connection:
+                connection.execute("DELETE FROM distances")
+                connection.execute("UPDATE counters SET value = 0")
+            self._clock = 0
+
+    def close(self) -> None:
+        """
+        Flush the buffers and close the connection of the calling thread; those of
+        other threads close when their thread ends.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self.flush()
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,495 @@
+import os
+import numpy as np
+from typing import List, Dict, Tuple
+
+
+def validate_nutrients(*nutrient_arrays: np.ndarray) -> None:
+    """
+    Check that stacked nutrient arrays share one feature dimension and lie in [0, 1].
+
+    Args:
+        *nutrient_arrays (np.ndarray): Nutrient matrices of shape (m, d).
+
+    Raises:
+        ValueError: If the dimensions differ or a value is missing or outside [0, 1].
+    """
+    dims = {V.shape[1] for V in nutrient_arrays if len(V) > 0}
+    if len(dims) > 1:
+        raise ValueError("Mismatch in feature dimensions.")
+    for V in nutrient_arrays:
+        if np.any(V < 0):
+            raise ValueError("Nutrient values must be non-negative.")
+        if np.any(V > 1):
+            raise ValueError("Nutrient values must be in the range [0, 1].")
+        if np.any(np.isnan(V)):
+            raise ValueError("Nutrient values must not be NaN.")
+
+
+def nutrient_weight_factor(W) -> np.ndarray:
+    """
+    Square-root factor of a nutrient weight matrix.
+
+    Returns L with ``W = L @ L.T``, so that the rows ``u = v @ L`` satisfy
+    ``ui.uj = vi.T @ W @ vj`` and ``||ui - uj||^2 = (vi - vj).T @ W @ (vi - vj)``:
+    weighted distances are plain distances between transformed vectors. The
+    Cholesky factor is used, or the eigendecomposition for a singular W.
+
+    W must have non-negative entries. Then ``vi.T @ W @ vj >= 0`` for nutrient
+    vectors, local costs stay non-negative, and the lower bounds, early abandoning
+    and ``exact_time_gap`` remain valid.
+
+    Args:
+        W (array-like): Symmetric positive semi-definite matrix of shape (d, d), or the
+            diagonal of one as shape (d,).
+
+    Returns:
+        np.ndarray: Factor L of shape (d, d).
+
+    Raises:
+        ValueError: If W is not square, symmetric, positive semi-definite and non-negative.
+    """
+    W = np.asarray(W, dtype=np.float64)
+    if W.ndim == 1:
+        W = np.diag(W)
+    if W.ndim != 2 or W.shape[0] != W.shape[1]:
+        raise ValueError("Nutrient weight matrix must be square.")
+    if not np.allclose(W, W.T):
+        raise ValueError("Nutrient weight matrix must be symmetric.")
+    if np.any(W < 0):
+        raise ValueError("Nutrient weight matrix must have non-negative entries.")
+    try:
+        return np.linalg.cholesky(W)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(W)
+        if eigenvalues.min() < -1e-12 * max(eigenvalues.max(), 1.0):
+            raise ValueError("Nutrient weight matrix must be positive semi-definite.")
+        return eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+
+
+def apply_nutrient_weights(nutrients: np.ndarray, W=None) -> np.ndarray:
+    """
+    Transform stacked nutrient vectors so that plain dot products apply the weights W.
+
+    Args:
+        nutrients (np.ndarray): Nutrients of shape (m, d).
+        W (array-like, optional): Nutrient weight matrix, see ``nutrient_weight_factor``.
+
+    Returns:
+        np.ndarray: Transformed nutrients, or the input when W is None.
+    """
+    if W is None or len(nutrients) == 0:
+        return nutrients
+    factor = nutrient_weight_factor(W)
+    if nutrients.shape[1] != len(factor):
+        raise ValueError("Nutrient weight matrix does not match the number of nutrients.")
+    return nutrients @ factor
+
+
+def _same_weights(factor1: np.ndarray, factor2: np.ndarray) -> bool:
+    if factor1 is None or factor2 is None:
+        return factor1 is None and factor2 is None
+    return factor1.shape == factor2.shape and np.array_equal(factor1, factor2)
+
+class PackedCohort:
+    """
+    Columnar storage of a prepared cohort.
+
+    All events of all persons live in contiguous arrays; person ``i`` owns the
+    slice ``offsets[i]:offsets[i + 1]`` of ``times``, ``nutrients`` and ``sq_norms``.
+
+    Attributes:
+        ids (np.ndarray): Person ids, shape (n,).
+        times (np.ndarray): Event times sorted within each person, shape (N,).
+        nutrients (np.ndarray): Normalized nutrient vectors, shape (N, d).
+        offsets (np.ndarray): Start of each person's events, shape (n + 1,).
+        sq_norms (np.ndarray): Squared norm of every nutrient vector, shape (N,).
+        weight_factor (np.ndarray): Factor of the nutrient weight matrix already applied to
+            ``nutrients``, see ``nutrient_weight_factor``, or None for unweighted nutrients.
+    """
+
+    def __init__(self, ids, times: np.ndarray, nutrients: np.ndarray, offsets: np.ndarray, sq_norms: np.ndarray = None,
+                 weight_factor: np.ndarray = None):
+        self.ids = np.asarray(ids)
+        self.times = np.ascontiguousarray(times, dtype=np.float64)
+        self.nutrients = np.ascontiguousarray(nutrients, dtype=np.float64)
+        if self.nutrients.ndim != 2:
+            self.nutrients = self.nutrients.reshape(len(self.times), -1)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        if sq_norms is None:
+            sq_norms = np.einsum('ij,ij->i', self.nutrients, self.nutrients)
+        self.sq_norms = np.ascontiguousarray(sq_norms, dtype=np.float64)
+        self.weight_factor = None if weight_factor is None else np.asarray(weight_factor, dtype=np.float64)
+
+        if len(self.offsets) != len(self.ids) + 1 or self.offsets[0] != 0 or self.offsets[-1] != len(self.times):
+            raise ValueError("Offsets do not match the number of persons and events.")
+        if np.any(np.diff(self.offsets) < 0):
+            raise ValueError("Offsets must be non-decreasing.")
+        self._index = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def n_features(self) -> int:
+        return self.nutrients.shape[1]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of events of every person."""
+        return np.diff(self.offsets)
+
+    def index_of(self, person_id) -> int:
+        """
+        Find the position of a person in the cohort.
+
+        Args:
+            person_id: Id of the person.
+
+        Returns:
+            int: Index of the person.
+        """
+        if self._index is None:
+            self._index = {person_id: i for i, person_id in enumerate(self.ids.tolist())}
+        return self._index[person_id]
+
+    def person(self, i: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get views on one person's events.
+
+        Args:
+            i (int): Index of the person.
+
+        Returns:
+            tuple: Times, nutrients and squared norms of the person's events.
+        """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.times[start:stop], self.nutrients[start:stop], self.sq_norms[start:stop]
+
+    def events(self, i: int) -> List[Tuple[float, List[float]]]:
+        """
+        Get one person's events in the (time, nutrients) list form used by ``mdtw_distance``.
+
+        Args:
+            i (int): Index of the person.
+
+        Returns:
+            list: Sequence of events (time, nutrients).
+        """
+        times, nutrients, _ = self.person(i)
+        return list(zip(times.tolist(), nutrients.tolist()))
+
+    def subset(self, indices) -> "PackedCohort":
+        """
+        Build a new cohort holding only the given persons, in the given order.
+
+        Args:
+            indices (array-like): Indices of the persons to keep.
+
+        Returns:
+            PackedCohort: The selected persons.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Event positions of every selected person, concatenated
+        starts = np.repeat(self.offsets[indices] - offsets[:-1], lengths)
+        events = starts + np.arange(offsets[-1])
+        return PackedCohort(self.ids[indices], self.times[events], self.nutrients[events], offsets, self.sq_norms[events],
+                            self.weight_factor)
+
+    def weighted(self, W) -> "PackedCohort":
+        """
+        Apply a nutrient weight matrix to every event once.
+
+        The factor is recorded in ``weight_factor``, so a cohort can only be weighted
+        once: passing the same W again to a function that weights its input would
+        otherwise square the weights silently.
+
+        Args:
+            W (array-like): Nutrient weight matrix, see ``nutrient_weight_factor``.
+
+        Returns:
+            PackedCohort: Cohort whose nutrients are transformed by the factor of W; the
+            kernels then compute weighted distances without further work.
+
+        Raises:
+            ValueError: If the cohort is already weighted.
+        """
+        if W is None:
+            return self
+        if self.weight_factor is not None:
+            raise ValueError("Nutrient weights were already applied to this cohort; pass W only once.")
+        factor = nutrient_weight_factor(W)
+        if len(self.times) and self.n_features != len(factor):
+            raise ValueError("Nutrient weight matrix does not match the number of nutrients.")
+        nutrients = self.nutrients @ factor if len(self.times) else self.nutrients
+        return PackedCohort(self.ids, self.times, nutrients, self.offsets, weight_factor=factor)
+
+    def padded(self, indices=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Copy persons into zero-padded dense tensors for the batched kernel.
+
+        Args:
+            indices (array-like, optional): Indices of the persons, all persons by default.
+
+        Returns:
+            tuple: Times of shape (B, L), nutrients of shape (B, L, d), squared norms
+            of shape (B, L) and lengths of shape (B,), where L is the longest length.
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices, dtype=np.int64)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+        width = int(lengths.max(initial=0))
+        times = np.zeros((len(indices), width))
+        nutrients = np.zeros((len(indices), width, self.n_features))
+        sq_norms = np.zeros((len(indices), width))
+
+        rows = np.repeat(np.arange(len(indices)), lengths)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        events = np.repeat(self.offsets[indices], lengths) + cols
+        times[rows, cols] = self.times[events]
+        nutrients[rows, cols] = self.nutrients[events]
+        sq_norms[rows, cols] = self.sq_norms[events]
+        return times, nutrients, sq_norms, lengths
+
+    def concat(self, other: "PackedCohort") -> "PackedCohort":
+        """
+        Build a new cohort with the persons of other appended after these.
+
+        Args:
+            other (PackedCohort): Persons to append, with the same number of nutrients and weights.
+
+        Returns:
+            PackedCohort: Combined cohort.
+        """
+        if len(self.times) and len(other.times) and other.n_features != self.n_features:
+            raise ValueError("Inconsistent nutrient vector lengths across cohorts.")
+        if not _same_weights(self.weight_factor, other.weight_factor):
+            raise ValueError("Cohorts have different nutrient weights.")
+        nutrients = self.nutrients if not len(other.times) else other.nutrients if not len(self.times) else np.concatenate([self.nutrients, other.nutrients])
+        return PackedCohort(
+            np.concatenate([self.ids, other.ids]),
+            np.concatenate([self.times, other.times]),
+            nutrients,
+            np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]),
+            np.concatenate([self.sq_norms, other.sq_norms]),
+            self.weight_factor,
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Write the cohort to an ``.npz`` file.
+
+        Args:
+            path (str): Destination file.
+        """
+        np.savez(path, ids=self.ids, times=self.times, nutrients=self.nutrients, offsets=self.offsets, sq_norms=self.sq_norms,
+                 weight_factor=np.zeros(0) if self.weight_factor is None else self.weight_factor)
+
+    @classmethod
+    def load(cls, path: str) -> "PackedCohort":
+        """
+        Read a cohort written by ``save``.
+
+        Args:
+            path (str): Source file.
+
+        Returns:
+            PackedCohort: Loaded cohort.
+        """
+        with np.load(path) as arrays:
+            factor = arrays['weight_factor'] if 'weight_factor' in arrays.files and arrays['weight_factor'].size else None
+            return cls(arrays['ids'], arrays['times'], arrays['nutrients'], arrays['offsets'], arrays['sq_norms'], factor)
+
+    @classmethod
+    def open(cls, directory: str, mmap_mode: str = 'r') -> "PackedCohort":
+        """
+        Open a cohort written by ``PackedCohortWriter`` without reading the events into memory.
+
+        Args:
+            directory (str): Cohort directory.
+            mmap_mode (str): Memory-map mode passed to ``np.load``.
+
+        Returns:
+            PackedCohort: Cohort backed by memory-mapped event arrays.
+        """
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ('times', 'nutrients', 'offsets', 'sq_norms')}
+        factor_path = os.path.join(directory, "weight_factor.npy")
+        factor = np.load(factor_path) if os.path.exists(factor_path) else None
+        return cls(np.load(os.path.join(directory, "ids.npy")), weight_factor=factor, **arrays)
+
+    def to_prepared(self) -> Dict:
+        """
+        Convert the cohort back to the ``{person_id: prepare_person(...)}`` dictionary form.
+
+        Returns:
+            dict: Dictionary with time as keys and normalized nutrient vectors as values, per person.
+        """
+        return {person_id: dict(self.events(i)) for i, person_id in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def from_prepared(cls, prepared_data: Dict, W=None) -> "PackedCohort":
+        """
+        Pack the output of ``prepare_person`` for a whole cohort.
+
+        Args:
+            prepared_data (dict): Dictionary containing prepared data for each person.
+            W (array-like, optional): Nutrient weight matrix applied after validation.
+
+        Returns:
+            PackedCohort: Packed cohort with persons in dictionary order.
+        """
+        ids = list(prepared_data.keys())
+        lengths = [len(records) for records in prepared_data.values()]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        times = np.fromiter((t for records in prepared_data.values() for t in records), dtype=np.float64, count=offsets[-1])
+        nutrients = [v for records in prepared_data.values() for v in records.values()]
+        if len({len(v) for v in nutrients}) > 1:
+            raise ValueError("Inconsistent nutrient vector lengths in prepared data.")
+        nutrients = np.array(nutrients, dtype=np.float64).reshape(len(times), -1) if len(times) else np.zeros((0, 0))
+        validate_nutrients(nutrients)
+        return cls(ids, times, nutrients, offsets).weighted(W)
+
+
+def prepare_cohort(persons: List[dict], W=None) -> PackedCohort:
+    """
+    Prepare many persons at once into a packed cohort.
+
+    Applies the same checks and normalization as ``prepare_person`` in a single
+    vectorized pass over all events, so the packed kernels need no further
+    checks. Events sharing a time are kept as separate events instead of being
+    collapsed into one dictionary key.
+
+    Args:
+        persons (list): List of dictionaries containing each person's data.
+        W (array-like, optional): Nutrient weight matrix applied after normalization,
+            see ``nutrient_weight_factor``.
+
+    Returns:
+        PackedCohort: Packed cohort with events sorted by time within each person.
+    """
+    ids = [person['person_id'] for person in persons]
+    lengths = np.array([len(person['records']) for person in persons], dtype=np.int64)
+    for person, length in zip(persons, lengths):
+        nutrients_lengths = {len(record['nutrients']) for record in person['records']}
+        if len(nutrients_lengths) != 1:
+            raise ValueError(f"Inconsistent nutrient vector lengths for person {person['person_id']}.")
+    if len({len(person['records'][0]['nutrients']) for person in persons}) > 1:
+        raise ValueError("Inconsistent nutrient vector lengths across persons.")
+
+    offsets = np.zeros(len(persons) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    owner = np.repeat(np.arange(len(persons)), lengths)
+    times = np.array([record['time'] for person in persons for record in person['records']], dtype=np.float64)
+    nutrients = np.array([record['nutrients'] for person in persons for record in person['records']], dtype=np.float64)
+    nutrients = nutrients.reshape(len(times), -1) if len(times) else np.zeros((0, 0))
+
+    # Stable sort by time inside each person
+    order = np.lexsort((times, owner))
+    times = times[order]
+    nutrients = nutrients[order]
+
+    invalid = np.any((nutrients < 0) | ~np.isfinite(nutrients), axis=1) if len(times) else np.zeros(0, dtype=bool)
+    if np.any(invalid):
+        person_id = ids[int(owner[order][np.argmax(invalid)])]
+        raise ValueError(f"Negative or non-finite nutrient values for person {person_id}.")
+
+    totals = np.add.reduceat(nutrients, offsets[:-1], axis=0) if len(persons) else nutrients[:0]
+    zero_total = np.any(totals == 0, axis=1)
+    if np.any(zero_total):
+        raise ValueError(f"Zero total nutrients for person {ids[int(np.argmax(zero_total))]}.")
+    nutrients /= np.repeat(totals, lengths, axis=0)
+
+    return PackedCohort(ids, times, nutrients, offsets).weighted(W)
+
+
+class PackedCohortWriter:
+    """
+    Append packed cohorts batch by batch to an on-disk cohort directory.
+
+    Events are appended to raw files as they arrive and converted to ``.npy`` files
+    by ``close``, so memory holds one batch of events plus one id and offset per
+    person. The result is opened with ``PackedCohort.open``.
+    """
+
+    _EVENT_ARRAYS = ('times', 'nutrients', 'sq_norms')
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory (str): Output directory, created if missing.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.ids = []
+        self.lengths = []
+        self.n_features = None
+        self.weight_factor = None
+        self._files = {name: open(os.path.join(directory, f"{name}.bin"), 'wb') for name in self._EVENT_ARRAYS}
+
+    def __enter__(self) -> "PackedCohortWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def append(self, cohort: PackedCohort) -> None:
+        """
+        Append the persons of a packed cohort.
+
+        Args:
+            cohort (PackedCohort): Persons to append.
+
+        Raises:
+            ValueError: If the number of nutrients or the nutrient weights differ from earlier batches.
+        """
+        if len(cohort.times):
+            if self.n_features is None:
+                self.n_features = cohort.n_features
+            elif cohort.n_features != self.n_features:
+                raise ValueError("Inconsistent nutrient vector lengths across persons.")
+        if self.ids and not _same_weights(self.weight_factor, cohort.weight_factor):
+            raise ValueError("Cohorts have different nutrient weights.")
+        self.weight_factor = cohort.weight_factor
+        for name in self._EVENT_ARRAYS:
+            self._files[name].write(np.ascontiguousarray(getattr(cohort, name), dtype='<f8').tobytes())
+        self.ids.extend(cohort.ids.tolist())
+        self.lengths.extend(cohort.lengths.tolist())
+
+    def close(self, block_size: int = 1 << 20) -> None:
+        """
+        Write the ``.npy`` files of the cohort.
+
+        Args:
+            block_size (int): Number of values copied at a time.
+        """
+        if self._files is None:
+            return
+        for file in self._files.values():
+            file.close()
+        self._files = None
+
+        n_events = int(np.sum(self.lengths))
+        shapes = {'times': (n_events,), 'nutrients': (n_events, self.n_features or 0), 'sq_norms': (n_events,)}
+        for name in self._EVENT_ARRAYS:
+            raw = os.path.join(self.directory, f"{name}.bin")
+            target = np.lib.format.open_memmap(os.path.join(self.directory, f"{name}.npy"), mode='w+', dtype='<f8', shape=shapes[name])
+            flat = target.reshape(-1)
+            if flat.size:
+                source = np.memmap(raw, dtype='<f8', mode='r')
+                for start in range(0, flat.size, block_size):
+                    flat[start:start + block_size] = source[start:start + block_size]
+                del source
+            target.flush()
+            del flat, target
+            os.remove(raw)
+
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        np.save(os.path.join(self.directory, "offsets.npy"), offsets)
+        np.save(os.path.join(self.directory, "ids.npy"), np.asarray(self.ids))
+        if self.weight_factor is not None:
+            np.save(os.path.join(self.directory, "weight_factor.npy"), self.weight_factor)
@@ -0,0 +1,175 @@
+import numpy as np
+from typing import Union
+
+
+def condensed_size(n: int) -> int:
+    """
+    Number of entries of the condensed upper triangle of an n x n matrix.
+    """
+    return n * (n - 1) // 2
+
+
+def condensed_index(n: int, i: int, j: int) -> int:
+    """
+    Position of d(i, j), i < j, in the condensed layout used by scipy ``squareform``.
+
+    Args:
+        n (int): Number of persons.
+        i (int): Row index.
+        j (int): Column index, greater than i.
+
+    Returns:
+        int: Position in the condensed array.
+    """
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def n_from_condensed_size(size: int) -> int:
+    """
+    Recover the number of persons from the length of a condensed array.
+
+    Raises:
+        ValueError: If size is not n(n-1)/2 for any n.
+    """
+    n = int(round((1 + np.sqrt(1 + 8 * size)) / 2))
+    if condensed_size(n) != size:
+        raise ValueError(f"{size} is not a valid condensed distance matrix size.")
+    return n
+
+
+class CondensedDistanceMatrix:
+    """
+    Symmetric distance matrix stored as its condensed upper triangle.
+
+    The ``data`` array, in memory or an ``np.memmap``, follows the scipy
+    ``squareform`` layout, so ``np.asarray(matrix)`` can go straight to
+    ``scipy.cluster.hierarchy.linkage``.
+
+    Attributes:
+        data (np.ndarray): Condensed distances, shape (n(n-1)/2,).
+        n (int): Number of persons.
+    """
+
+    def __init__(self, data: np.ndarray, n: int = None):
+        self.data = data
+        self.n = n_from_condensed_size(len(data)) if n is None else n
+        if len(data) != condensed_size(self.n):
+            raise ValueError(f"Expected {condensed_size(self.n)} condensed entries, got {len(data)}.")
+
+    @classmethod
+    def allocate(cls, n: int, dtype=np.float64, path: str = None) -> "CondensedDistanceMatrix":
+        """
+        Create a zero-filled condensed matrix, on disk when a path is given.
+
+        Args:
+            n (int): Number of persons.
+            dtype: np.float32 or np.float64.
+            path (str, optional): File backing an ``np.memmap``.
+
+        Returns:
+            CondensedDistanceMatrix: Empty matrix.
+        """
+        size = condensed_size(n)
+        # np.memmap cannot map an empty file, and there is nothing to store anyway
+        if path is None or size == 0:
+            return cls(np.zeros(size, dtype=dtype), n)
+        return cls(np.memmap(path, dtype=dtype, mode='w+', shape=(size,)), n)
+
+    @classmethod
+    def open(cls, path: str, dtype=np.float64, mode: str = 'r') -> "CondensedDistanceMatrix":
+        """
+        Map a condensed matrix previously written to disk.
+
+        Args:
+            path (str): File written through ``allocate``.
+            dtype: Dtype the file was written with.
+            mode (str): ``np.memmap`` mode, 'r' or 'r+'.
+
+        Returns:
+            CondensedDistanceMatrix: Memory-mapped matrix.
+        """
+        return cls(np.memmap(path, dtype=dtype, mode=mode))
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return np.asarray(self.data, dtype=dtype)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def distance(self, i: int, j: int) -> float:
+        """
+        Look up d(i, j).
+        """
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        return float(self.data[condensed_index(self.n, i, j)])
+
+    def row(self, i: int) -> np.ndarray:
+        """
+        Look up the distances from person i to every person.
+
+        Args:
+            i (int): Index of the person.
+
+        Returns:
+            np.ndarray: Row i of the square matrix, shape (n,).
+        """
+        row = np.zeros(self.n, dtype=self.data.dtype)
+        k = np.arange(i)
+        row[:i] = self.data[self.n * k - k * (k + 1) // 2 + (i - k - 1)]
+        start = condensed_index(self.n, i, i + 1)
+        row[i + 1:] = self.data[start:start + self.n - i - 1]
+        return row
+
+    def rows(self, indices) -> np.ndarray:
+        """
+        Look up the distances from several persons to every person.
+
+        Args:
+            indices (array-like): Indices of the persons.
+
+        Returns:
+            np.ndarray: Rows of the square matrix, shape (len(indices), n).
+        """
+        block = np.zeros((len(indices), self.n), dtype=self.data.dtype)
+        for k, i in enumerate(indices):
+            block[k] = self.row(int(i))
+        return block
+
+    def __getitem__(self, key: Union[int, tuple]):
+        if isinstance(key, tuple):
+            return self.distance(*key)
+        return self.row(key)
+
+    def to_dense(self, dtype=None) -> np.ndarray:
+        """
+        Expand to the square form, e.g. for ``KMedoids(metric='precomputed')``.
+
+        Args:
+            dtype (optional): Dtype of the result, defaults to the stored dtype.
+
+        Returns:
+            np.ndarray: Square symmetric matrix.
+        """
+        dense = np.zeros((self.n, self.n), dtype=dtype or self.data.dtype)
+        upper = np.triu_indices(self.n, 1)
+        dense[upper] = self.data
+        dense.T[upper] = self.data
+        return dense
+
+    def flush(self) -> None:
+        """
+        Write pending changes of a memory-mapped matrix to disk.
+        """
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
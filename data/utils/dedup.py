@@ -0,0 +1,141 @@
+import numpy as np
+from typing import Tuple, Union
+
+from data.utils.cache import cohort_hashes
+from data.utils.cohort import PackedCohort
+from data.utils.condensed import CondensedDistanceMatrix
+from data.utils.modified_mdtw import calculate_distance_matrix
+
+
+def quantize_cohort(cohort: PackedCohort, time_resolution: float = None, nutrient_decimals: int = None) -> PackedCohort:
+    """
+    Round event times and nutrient values of a packed cohort.
+
+    Args:
+        cohort (PackedCohort): Packed cohort.
+        time_resolution (float, optional): Times are rounded to multiples of this value.
+        nutrient_decimals (int, optional): Nutrients are rounded to this many decimals.
+
+    Returns:
+        PackedCohort: Quantized copy, or the cohort itself when no rounding is requested.
+    """
+    if time_resolution is None and nutrient_decimals is None:
+        return cohort
+    times = cohort.times if time_resolution is None else np.round(cohort.times / time_resolution) * time_resolution
+    nutrients = cohort.nutrients if nutrient_decimals is None else np.round(cohort.nutrients, nutrient_decimals)
+    return PackedCohort(cohort.ids, times, nutrients, cohort.offsets, weight_factor=cohort.weight_factor)
+
+
+def canonicalize(cohort: PackedCohort, time_resolution: float = None, nutrient_decimals: int = None) -> Tuple[PackedCohort, np.ndarray]:
+    """
+    Group persons whose (optionally quantized) prepared sequences are identical.
+
+    Args:
+        cohort (PackedCohort): Packed cohort.
+        time_resolution (float, optional): Times are rounded to multiples of this value.
+        nutrient_decimals (int, optional): Nutrients are rounded to this many decimals.
+
+    Returns:
+        tuple: Cohort of unique representatives, in order of first appearance and carrying
+        the id of their first member, and the representative index of every person, shape (n,).
+    """
+    quantized = quantize_cohort(cohort, time_resolution, nutrient_decimals)
+    # Hashes are truncated to 64 bits, so persons sharing one are compared before merging
+    groups = {}
+    first_members = []
+    inverse = np.empty(len(cohort), dtype=np.int64)
+    for i, digest in enumerate(cohort_hashes(quantized)):
+        times, nutrients = quantized.person(i)[:2]
+        candidates = groups.setdefault(digest, [])
+        for group in candidates:
+            other_times, other_nutrients = quantized.person(first_members[group])[:2]
+            if np.array_equal(times, other_times) and np.array_equal(nutrients, other_nutrients):
+                inverse[i] = group
+                break
+        else:
+            inverse[i] = len(first_members)
+            candidates.append(len(first_members))
+            first_members.append(i)
+    return quantized.subset(np.array(first_members, dtype=np.int64)), inverse
+
+
+class DeduplicatedDistanceMatrix:
+    """
+    Distance matrix over a full cohort, stored as distances between unique sequences.
+
+    Members of the same group are at distance zero and share every other distance.
+    Lookups are resolved through the representative index; the full matrix is only
+    built on request.
+
+    Attributes:
+        ids (np.ndarray): Ids of all persons, shape (n,).
+        inverse (np.ndarray): Representative index of every person, shape (n,).
+        unique (CondensedDistanceMatrix): Distances between representatives.
+    """
+
+    def __init__(self, ids: np.ndarray, inverse: np.ndarray, unique: CondensedDistanceMatrix):
+        self.ids = np.asarray(ids)
+        self.inverse = np.asarray(inverse, dtype=np.int64)
+        self.unique = unique
+
+    def __len__(self) -> int:
+        return len(self.inverse)
+
+    @property
+    def shape(self):
+        return (len(self), len(self))
+
+    @property
+    def group_sizes(self) -> np.ndarray:
+        """Number of persons sharing each unique sequence, usable as sample weights."""
+        return np.bincount(self.inverse, minlength=len(self.unique))
+
+    def distance(self, i: int, j: int) -> float:
+        return self.unique.distance(self.inverse[i], self.inverse[j])
+
+    def row(self, i: int) -> np.ndarray:
+        return self.unique.row(self.inverse[i])[self.inverse]
+
+    def __getitem__(self, key: Union[int, tuple]):
+        if isinstance(key, tuple):
+            return self.distance(*key)
+        return self.row(key)
+
+    def to_dense(self, dtype=None) -> np.ndarray:
+        """
+        Expand to the full square matrix over all persons.
+        """
+        return self.unique.to_dense(dtype)[np.ix_(self.inverse, self.inverse)]
+
+    def to_condensed(self, dtype=None) -> CondensedDistanceMatrix:
+        """
+        Expand to the full condensed matrix over all persons.
+        """
+        rows, cols = np.triu_indices(len(self), 1)
+        dense = self.unique.to_dense(dtype)
+        return CondensedDistanceMatrix(dense[self.inverse[rows], self.inverse[cols]], len(self))
+
+
+def calculate_deduplicated_distance_matrix(prepared_data: Union[dict, PackedCohort], time_resolution: float = None, nutrient_decimals: int = None,
+                                           **kwargs) -> DeduplicatedDistanceMatrix:
+    """
+    Calculate the distance matrix running MDTW only between unique prepared sequences.
+
+    Without quantization only exactly identical sequences are merged and the result
+    equals ``calculate_distance_matrix``. With quantization every person is compared
+    through the rounded sequence of its group.
+
+    Args:
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        time_resolution (float, optional): Times are rounded to multiples of this value.
+        nutrient_decimals (int, optional): Nutrients are rounded to this many decimals.
+        **kwargs: Passed to ``calculate_distance_matrix`` (delta, beta, alpha, n_jobs, dtype, ...).
+
+    Returns:
+        DeduplicatedDistanceMatrix: Distance matrix over all persons.
+    """
+    cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+    unique, inverse = canonicalize(cohort, time_resolution, nutrient_decimals)
+    matrix = calculate_distance_matrix(unique, condensed=True, **kwargs)
+    return DeduplicatedDistanceMatrix(cohort.ids, inverse, matrix)
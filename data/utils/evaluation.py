@@ -0,0 +1,239 @@
+import numpy as np
+from statistics import NormalDist
+from typing import List, Tuple, NamedTuple, Union
+
+from data.utils.condensed import CondensedDistanceMatrix
+from data.utils.kmedoids import _nearest_two, build_medoids, fasterpam
+
+
+class ClusterEvaluation(NamedTuple):
+    """
+    Quality of one k-medoids clustering, from ``evaluate_clusterings``.
+
+    Attributes:
+        k (int): Number of clusters.
+        medoids (np.ndarray): Indices of the medoids, shape (k,).
+        labels (np.ndarray): Index into ``medoids`` of every point's nearest medoid, shape (n,).
+        inertia (float): Sum of the distances of every point to its medoid.
+        silhouette (float): Mean silhouette, exact or estimated from the sampled points;
+            ``np.nan`` for a single cluster.
+        silhouette_interval (tuple): Confidence interval of the mean silhouette, a single
+            point when every point was evaluated.
+        removal_loss (np.ndarray): Increase of the inertia when a medoid is removed and its
+            points go to their second nearest medoid, shape (k,).
+        best_swap (tuple): Position in ``medoids`` and index of the candidate of the best swap
+            found, or (-1, -1) when no candidate was evaluated.
+        best_swap_change (float): Change of the inertia of that swap; negative when the medoids
+            are not a local optimum of the swap neighbourhood.
+        n_evaluated (int): Points used for the silhouette and as swap candidates.
+    """
+    k: int
+    medoids: np.ndarray
+    labels: np.ndarray
+    inertia: float
+    silhouette: float
+    silhouette_interval: Tuple[float, float]
+    removal_loss: np.ndarray
+    best_swap: Tuple[int, int]
+    best_swap_change: float
+    n_evaluated: int
+
+
+def _as_storage(D) -> Union[np.ndarray, CondensedDistanceMatrix]:
+    if isinstance(D, CondensedDistanceMatrix):
+        return D
+    if getattr(D, 'ndim', None) == 1:
+        return CondensedDistanceMatrix(D)
+    if getattr(D, 'ndim', None) != 2 or D.shape[0] != D.shape[1]:
+        raise ValueError("Distances must be a square matrix or a condensed upper triangle.")
+    return D
+
+
+def _rows(D: Union[np.ndarray, CondensedDistanceMatrix], indices: np.ndarray) -> np.ndarray:
+    """
+    Distances from the given points to every point as a float64 block; a memory-mapped
+    square matrix only reads these rows.
+    """
+    if isinstance(D, CondensedDistanceMatrix):
+        return D.rows(indices).astype(np.float64, copy=False)
+    return np.asarray(D[indices], dtype=np.float64)
+
+
+def _silhouettes(sums: np.ndarray, own: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Silhouette of every point from its summed distances to every cluster, shape (b, k).
+    Points of singleton clusters get 0.
+    """
+    rows = np.arange(len(own))
+    own_size = sizes[own]
+    a = sums[rows, own] / np.maximum(own_size - 1, 1)
+    means = sums / np.maximum(sizes, 1)
+    means[rows, own] = np.inf
+    means[:, sizes == 0] = np.inf
+    b = means.min(axis=1)
+    scale = np.maximum(a, b)
+    s = np.where(scale > 0, (b - a) / np.where(scale > 0, scale, 1), 0)
+    return np.where(own_size > 1, s, 0)
+
+
+def evaluate_clusterings(D, medoids: List, block_size: int = 256, sample_size: int = None, confidence: float = 0.95,
+                         random_state: int = None) -> List[ClusterEvaluation]:
+    """
+    Evaluate several k-medoids clusterings of the same points in one blocked pass over the distances.
+
+    Labels, inertia and removal losses come from the medoid rows alone. Then the
+    rows of the evaluated points are read ``block_size`` at a time: a product with
+    the cluster indicators of each clustering gives every point's summed distance to
+    every cluster, hence its silhouette, and the FasterPAM swap evaluation scores the
+    points of the block as replacement medoids (Schubert and Rousseeuw, 2021).
+    Memory stays at O((block_size + largest k) * n) values for any storage.
+
+    With ``sample_size`` set, only a uniform sample of points is read: the mean
+    silhouette becomes an estimate with a normal confidence interval (including the
+    finite population correction) and swaps are only tried with sampled candidates.
+
+    Args:
+        D (np.ndarray or CondensedDistanceMatrix): Square distance matrix, possibly an ``np.memmap``,
+            or a condensed one, in memory or memory-mapped.
+        medoids (list): Medoid indices of every clustering to evaluate.
+        block_size (int): Rows read at once.
+        sample_size (int, optional): Number of points evaluated, all by default.
+        confidence (float): Level of the silhouette confidence intervals.
+        random_state (int, optional): Seed of the sample.
+
+    Returns:
+        list: One ``ClusterEvaluation`` per clustering, in the given order.
+    """
+    D = _as_storage(D)
+    n = len(D)
+    medoids = [np.array(m, dtype=np.int64).ravel() for m in medoids]
+    for m in medoids:
+        if not 0 < len(m) <= n or len(np.unique(m)) != len(m) or m.min() < 0 or m.max() >= n:
+            raise ValueError("Medoids must be between 1 and n distinct point indices.")
+    if sample_size is None or sample_size >= n:
+        points = np.arange(n)
+    elif sample_size < 2:
+        raise ValueError("At least two points must be sampled.")
+    else:
+        points = np.sort(np.random.default_rng(random_state).choice(n, sample_size, replace=False))
+
+    # Nearest two medoids of every point
+    states = []
+    for m in medoids:
+        nearest, dn, ds = _nearest_two(_rows(D, m).T, np.arange(len(m)))
+        removal = np.bincount(nearest, weights=ds - dn, minlength=len(m)) if len(m) > 1 else np.full(1, np.inf)
+        states.append((nearest, dn, ds, removal))
+    sizes = [np.bincount(nearest, minlength=len(m)) for m, (nearest, _, _, _) in zip(medoids, states)]
+    silhouettes = [np.zeros(len(points)) for _ in medoids]
+    swaps = [(np.inf, -1, -1) for _ in medoids]
+    rows = np.arange(n)
+
+    for start in range(0, len(points), block_size):
+        block_points = points[start:start + block_size]
+        block = _rows(D, block_points)
+        for c, (m, (nearest, dn, ds, removal)) in enumerate(zip(medoids, states)):
+            k = len(m)
+            if k > 1:
+                # Dense float64 so that the sums per cluster are BLAS products; only one clustering's (n, k)
+                # indicators exist at a time, and rebuilding them costs O(n * k) against O(block_size * n * k)
+                indicators = np.zeros((n, k))
+                indicators[rows, nearest] = 1
+                silhouettes[c][start:start + len(block_points)] = _silhouettes(block @ indicators, nearest[block_points],
+                                                                               sizes[c])
+
+            # Change of the inertia when candidate x replaces medoid j, for every (x, j)
+            if k == 1:
+                change = block.sum(axis=1, keepdims=True) - dn.sum()
+            else:
+                closer = block < dn
+                gain = np.where(closer, dn - ds, np.where(block < ds, block - ds, 0))
+                change = removal + (gain @ indicators) + np.where(closer, block - dn, 0).sum(axis=1, keepdims=True)
+            change[np.isin(block_points, m)] = np.inf
+            x, j = np.unravel_index(np.argmin(change), change.shape)
+            if change[x, j] < swaps[c][0]:
+                swaps[c] = (float(change[x, j]), int(j), int(block_points[x]))
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    evaluations = []
+    for m, (nearest, dn, _, removal), s, (change, j, x) in zip(medoids, states, silhouettes, swaps):
+        if len(m) == 1:
+            silhouette, interval = np.nan, (np.nan, np.nan)
+        else:
+            silhouette = float(s.mean())
+            correction = (n - len(points)) / (n - 1)
+            half_width = z * s.std(ddof=1) / np.sqrt(len(points)) * np.sqrt(correction)
+            interval = (silhouette - half_width, silhouette + half_width)
+        evaluations.append(ClusterEvaluation(len(m), m, nearest, float(dn.sum()), silhouette, interval, removal,
+                                             (j, x), change if j >= 0 else np.nan, len(points)))
+    return evaluations
+
+
+def k_sweep(D, ks, block_size: int = 256, cluster_size: int = 1000, sample_size: int = None, confidence: float = 0.95,
+            max_iter: int = 100, random_state: int = None) -> List[ClusterEvaluation]:
+    """
+    Cluster for every candidate number of clusters and evaluate all of them in one pass.
+
+    Medoids come from ``fasterpam`` on the distances between ``cluster_size`` sampled
+    points (all of them when there are fewer), read in blocks, so clustering needs
+    ``cluster_size^2`` values instead of ``n^2``; the medoids are then scored on every
+    point with ``evaluate_clusterings``. A negative ``best_swap_change`` tells that the
+    sample missed a better medoid.
+
+    Args:
+        D (np.ndarray or CondensedDistanceMatrix): Distances, see ``evaluate_clusterings``.
+        ks (list): Candidate numbers of clusters.
+        block_size (int): Rows read at once.
+        cluster_size (int): Points clustered with FasterPAM.
+        sample_size (int, optional): Points evaluated, see ``evaluate_clusterings``.
+        confidence (float): Level of the silhouette confidence intervals.
+        max_iter (int): Largest number of FasterPAM passes.
+        random_state (int, optional): Seed of both samples.
+
+    Returns:
+        list: One ``ClusterEvaluation`` per value of ks, in the given order.
+    """
+    D = _as_storage(D)
+    n = len(D)
+    if any(not 0 < k <= min(n, cluster_size) for k in ks):
+        raise ValueError("Every k must be between 1 and the number of clustered points.")
+    rng = np.random.default_rng(random_state)
+    sample = np.arange(n) if cluster_size >= n else np.sort(rng.choice(n, cluster_size, replace=False))
+    sub = np.empty((len(sample), len(sample)))
+    for start in range(0, len(sample), block_size):
+        sub[start:start + block_size] = _rows(D, sample[start:start + block_size])[:, sample]
+    # BUILD alone is already optimal for a single medoid
+    medoids = [sample[build_medoids(sub, k) if k == 1 else fasterpam(sub, k, max_iter=max_iter)[0]] for k in ks]
+    return evaluate_clusterings(D, medoids, block_size, sample_size, confidence, rng.integers(2 ** 32))
+
+
+def elbow(evaluations: List[ClusterEvaluation]) -> int:
+    """
+    Number of clusters at the elbow of the inertia curve.
+
+    The elbow is the point furthest below the straight line between the first and
+    last points of the curve, after scaling both axes to [0, 1]. When a value of k
+    was evaluated more than once, its lowest inertia is used.
+
+    Args:
+        evaluations (list): Evaluations for at least two distinct values of k.
+
+    Returns:
+        int: Number of clusters at the elbow.
+
+    Raises:
+        ValueError: If fewer than two distinct values of k are given.
+    """
+    best = {}
+    for evaluation in evaluations:
+        if evaluation.k not in best or evaluation.inertia < best[evaluation.k].inertia:
+            best[evaluation.k] = evaluation
+    if len(best) < 2:
+        raise ValueError("The elbow needs at least two distinct values of k.")
+    ordered = sorted(best.values(), key=lambda evaluation: evaluation.k)
+    ks = np.array([evaluation.k for evaluation in ordered], dtype=np.float64)
+    inertia = np.array([evaluation.inertia for evaluation in ordered])
+    x = (ks - ks[0]) / (ks[-1] - ks[0])
+    spread = inertia[0] - inertia[-1]
+    y = (inertia - inertia[-1]) / spread if spread > 0 else np.zeros_like(inertia)
+    # Distance below the chord from (0, 1) to (1, 0)
+    return ordered[int(np.argmax(1 - x - y))].k
@@ -0,0 +1,237 @@
+import numpy as np
+from typing import List, Tuple, NamedTuple
+
+from data.utils.cohort import apply_nutrient_weights, validate_nutrients
+from data.utils.modified_mdtw import events_to_arrays, lb_mass, lb_norms, mdtw_lower_bound
+
+
+class FastMDTWResult(NamedTuple):
+    """
+    Outcome of an approximate MDTW computation.
+
+    Attributes:
+        distance (float): Cost of the best warping path found inside the window, an upper
+            bound on the exact distance.
+        lower_bound (float): Lower bound on the exact distance from ``lb_mass`` and ``lb_norms``,
+            or the full ``mdtw_lower_bound`` cascade.
+        error_bound (float): ``distance - lower_bound``, the largest possible overestimate.
+        n_cells (int): DP cells evaluated over all resolutions.
+    """
+    distance: float
+    lower_bound: float
+    error_bound: float
+    n_cells: int
+
+
+def coarsen(t: np.ndarray, V: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Halve a sequence by merging adjacent pairs of events.
+
+    Nutrients of merged events are summed and their time is the mean weighted by
+    nutrient mass, or the plain mean for events without mass. An odd last event is
+    kept as is.
+
+    Args:
+        t (np.ndarray): Event times, shape (m,).
+        V (np.ndarray): Nutrients, shape (m, d).
+
+    Returns:
+        tuple: Times of shape (ceil(m / 2),) and nutrients of shape (ceil(m / 2), d).
+    """
+    starts = np.arange(0, len(t), 2)
+    nutrients = np.add.reduceat(V, starts, axis=0)
+    mass = V.sum(axis=1)
+    total = np.add.reduceat(mass, starts)
+    weighted = np.add.reduceat(t * mass, starts)
+    counts = np.diff(np.append(starts, len(t)))
+    mean = np.add.reduceat(t, starts) / counts
+    times = np.where(total > 0, weighted / np.where(total > 0, total, 1), mean)
+    return times, nutrients
+
+
+def _project_window(path: np.ndarray, m1: int, m2: int, radius: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Columns allowed in every DP row at full resolution, from a warping path found at half resolution.
+
+    Coarse DP state (I, J) covers full-resolution state (2I, 2J), so every coarse step
+    expands to the rectangle between the images of its two states. The rectangles
+    are then widened by ``radius`` cells in every direction.
+    """
+    i = np.minimum(2 * path[:, 0], m1)
+    j = np.minimum(2 * path[:, 1], m2)
+    rows = np.arange(m1 + 1)
+    # The path is monotone: the first step reaching a row gives its first column, the last step leaving it the last
+    lo = j[:-1][np.searchsorted(i[1:], rows, side='left')]
+    hi = j[1:][np.searchsorted(i[:-1], rows, side='right') - 1]
+    if radius > 0:
+        # Sliding minimum and maximum over 2 * radius + 1 rows, then widen the columns
+        windows = np.lib.stride_tricks.sliding_window_view
+        lo = windows(np.pad(lo, radius, mode='edge'), 2 * radius + 1).min(axis=1) - radius
+        hi = windows(np.pad(hi, radius, mode='edge'), 2 * radius + 1).max(axis=1) + radius
+    return np.clip(lo, 0, m2), np.clip(hi, 0, m2)
+
+
+def _windowed_dp(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray,
+                 lo: np.ndarray, hi: np.ndarray, delta: float, beta: float, alpha: float, max_time_gap: float = None,
+                 return_path: bool = True) -> Tuple[float, np.ndarray, int]:
+    """
+    Run the MDTW recurrence over a band of DP states covering ``lo[i] <= j <= hi[i]`` in every row i.
+
+    The band has the width of the widest row, so every row is a fixed-size slice and
+    all local costs are gathered in one vectorized pass. Band cells outside the
+    window are valid states too, so the result is still the cost of a warping path.
+    Rows are solved as in ``_mdtw_dp``; for the path, the move into every band
+    state is kept as one byte.
+
+    Returns:
+        tuple: Distance, DP states of the optimal path from (0, 0) to (m1, m2) as an
+        array of shape (length, 2) or None, and the number of cells evaluated.
+    """
+    m1, m2 = len(t1), len(t2)
+    width = int(np.max(hi - lo)) + 1
+    start = np.minimum(lo, m2 + 1 - width)
+    offsets = np.zeros(m2 + 1)
+    np.cumsum(sq2, out=offsets[1:])
+
+    # Local cost of matching event i - 1 with event j - 1, for every band state (i, j) with i >= 1
+    columns = start[1:, None] + np.arange(width) - 1
+    events = np.maximum(columns, 0)
+    cross = np.einsum('ikd,id->ik', V2[events], V1)
+    time_gap = np.abs(t1[:, None] - t2[events])
+    costs = np.maximum(sq1[:, None] + sq2[events] - 2 * cross, 0) + 2 * beta * cross * (time_gap / delta) ** alpha
+    costs[columns < 0] = np.inf
+    if max_time_gap is not None:
+        costs[time_gap > max_time_gap] = np.inf
+    band_offsets = offsets[start[:, None] + np.arange(width)]
+
+    # Moves into each state: 0 from above (i to empty), 1 diagonal (match), 2 from the left (j to empty)
+    moves = np.full((m1 + 1, width), 2, dtype=np.int8) if return_path else None
+    padded = np.full(2 * width + 1, np.inf)
+    prev = band_offsets[0].copy()
+    for i in range(1, m1 + 1):
+        shift = start[i] - start[i - 1]
+        padded[1:width + 1] = prev
+        vertical = padded[shift + 1:shift + width + 1] + sq1[i - 1]
+        diagonal = padded[shift:shift + width] + costs[i - 1]
+        candidate = np.minimum(vertical, diagonal)
+        candidate -= band_offsets[i]
+        curr = np.minimum.accumulate(candidate)
+        if return_path:
+            moves[i] = np.where(curr < candidate, 2, diagonal < vertical)
+        curr += band_offsets[i]
+        prev = curr
+    distance = float(prev[m2 - start[m1]])
+    n_cells = (m1 + 1) * width
+    if not return_path:
+        return distance, None, n_cells
+
+    path = [(m1, m2)]
+    i, j = m1, m2
+    while i > 0 or j > 0:
+        move = moves[i, j - start[i]]
+        if move == 2:
+            j -= 1
+        elif move == 1:
+            i, j = i - 1, j - 1
+        else:
+            i -= 1
+        path.append((i, j))
+    return distance, np.array(path[::-1], dtype=np.int64), n_cells
+
+
+def _fast_mdtw(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray, radius: int,
+               delta: float, beta: float, alpha: float, max_time_gap: float, return_path: bool) -> Tuple[float, np.ndarray, int]:
+    m1, m2 = len(t1), len(t2)
+    min_size = radius + 2
+    if m1 <= min_size or m2 <= min_size:
+        lo = np.zeros(m1 + 1, dtype=np.int64)
+        hi = np.full(m1 + 1, m2, dtype=np.int64)
+        return _windowed_dp(t1, V1, sq1, t2, V2, sq2, lo, hi, delta, beta, alpha, max_time_gap, return_path)
+
+    ct1, cV1 = coarsen(t1, V1)
+    ct2, cV2 = coarsen(t2, V2)
+    _, coarse_path, coarse_cells = _fast_mdtw(ct1, cV1, np.einsum('ij,ij->i', cV1, cV1), ct2, cV2, np.einsum('ij,ij->i', cV2, cV2),
+                                              radius, delta, beta, alpha, max_time_gap, True)
+    lo, hi = _project_window(coarse_path, m1, m2, radius)
+    distance, path, n_cells = _windowed_dp(t1, V1, sq1, t2, V2, sq2, lo, hi, delta, beta, alpha, max_time_gap, return_path)
+    return distance, path, n_cells + coarse_cells
+
+
+def fast_mdtw(t1: np.ndarray, V1: np.ndarray, t2: np.ndarray, V2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2,
+              radius: int = 1, max_time_gap: float = None, tight_bound: bool = False) -> FastMDTWResult:
+    """
+    Approximate the modified DTW distance between two long sequences given as stacked arrays.
+
+    In the spirit of FastDTW (Salvador and Chan, 2007), both sequences are halved
+    with ``coarsen`` until they are short, solved exactly there, and the warping
+    path found at each resolution is projected onto the next finer one, widened by
+    ``radius`` cells, and used as the window of the finer DP. Each DP runs over a
+    band as wide as the widest window row, so time and memory grow linearly in the
+    sequence lengths when the warping path has no long runs of empty matches.
+
+    The distance is the cost of a valid warping path and therefore never below the
+    exact one; it is exact when the window contains an optimal path, which a radius
+    of about the sequence length guarantees. ``error_bound`` bounds the overestimate
+    against ``lb_mass`` and ``lb_norms``, which cost O(m log m); ``tight_bound`` adds
+    ``lb_time``, which is quadratic like the exact DP. No validation is performed.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence, shape (m1,).
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        t2 (np.ndarray): Event times of the second sequence, shape (m2,).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        radius (int): Cells added around the projected path at each resolution.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        tight_bound (bool): Compute the lower bound with the full ``mdtw_lower_bound`` cascade.
+
+    Returns:
+        FastMDTWResult: Approximate distance, lower bound, error bound and DP cells evaluated.
+    """
+    if radius < 0:
+        raise ValueError("The radius must be non-negative.")
+    sq1 = np.einsum('ij,ij->i', V1, V1)
+    sq2 = np.einsum('ij,ij->i', V2, V2)
+    if len(t1) == 0 or len(t2) == 0:
+        distance = float(np.sum(sq1) + np.sum(sq2))
+        return FastMDTWResult(distance, distance, 0.0, 0)
+    distance, _, n_cells = _fast_mdtw(t1, V1, sq1, t2, V2, sq2, radius, delta, beta, alpha, max_time_gap, False)
+    if tight_bound:
+        lower_bound = mdtw_lower_bound(t1, V1, t2, V2, delta, beta, alpha, sq1, sq2)
+    else:
+        lower_bound = max(lb_mass(V1, V2), lb_norms(sq1, sq2))
+    lower_bound = min(lower_bound, distance)
+    return FastMDTWResult(distance, lower_bound, distance - lower_bound, n_cells)
+
+
+def mdtw_distance_fast(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2,
+                       radius: int = 1, max_time_gap: float = None, tight_bound: bool = False, validate: bool = True,
+                       W=None) -> FastMDTWResult:
+    """
+    Approximate the modified DTW distance between two sequences of events, see ``fast_mdtw``.
+
+    Args:
+        ER1 (list): First sequence of events (time, nutrients).
+        ER2 (list): Second sequence of events (time, nutrients).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        radius (int): Cells added around the projected path at each resolution.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        tight_bound (bool): Compute the lower bound with the full ``mdtw_lower_bound`` cascade.
+        validate (bool): Check the nutrient values; pass False for sequences that come from
+            ``prepare_person``.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        FastMDTWResult: Approximate distance, lower bound, error bound and DP cells evaluated.
+    """
+    t1, V1 = events_to_arrays(ER1)
+    t2, V2 = events_to_arrays(ER2)
+    if validate:
+        validate_nutrients(V1, V2)
+    if W is not None:
+        V1, V2 = apply_nutrient_weights(V1, W), apply_nutrient_weights(V2, W)
+    return fast_mdtw(t1, V1, t2, V2, delta, beta, alpha, radius, max_time_gap, tight_bound)
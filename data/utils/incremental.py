@@ -0,0 +1,163 @@
+import numpy as np
+from typing import List, Union
+
+from data.utils.cohort import PackedCohort, prepare_cohort
+from data.utils.condensed import CondensedDistanceMatrix, condensed_size, condensed_index
+from data.utils.modified_mdtw import mdtw_distance_one_to_many
+
+
+def _as_cohort(persons: Union[PackedCohort, dict, List[dict]]) -> PackedCohort:
+    if isinstance(persons, PackedCohort):
+        return persons
+    if isinstance(persons, dict):
+        return PackedCohort.from_prepared(persons)
+    return prepare_cohort(persons)
+
+
+class IncrementalDistanceMatrix:
+    """
+    Condensed distance matrix that grows and shrinks with the cohort.
+
+    ``add`` computes only the pairs involving new persons and ``remove`` compacts
+    the storage; neither recomputes existing pairs. Person ``i`` of ``cohort``
+    always owns row and column ``i`` of ``matrix``.
+    """
+
+    def __init__(self, delta: float = 23, beta: float = 1, alpha: float = 2, max_time_gap: float = None, tile_size: int = 128,
+                 W=None):
+        """
+        Args:
+            delta (float): Time scaling factor.
+            beta (float): Weighting factor for time difference.
+            alpha (float): Exponent for time difference scaling.
+            max_time_gap (float, optional): Largest time difference allowed between matched events.
+            tile_size (int): Number of candidates sent to the batched kernel at once.
+            W (array-like, optional): Nutrient weight matrix, see ``local_distance``; applied once
+                to every added person, so ``cohort`` holds weighted nutrients.
+        """
+        self.delta = delta
+        self.beta = beta
+        self.alpha = alpha
+        self.max_time_gap = max_time_gap
+        self.tile_size = tile_size
+        self.W = W
+        self.cohort = prepare_cohort([])
+        self.distances = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.cohort)
+
+    @property
+    def ids(self) -> list:
+        return self.cohort.ids.tolist()
+
+    @property
+    def matrix(self) -> CondensedDistanceMatrix:
+        return CondensedDistanceMatrix(self.distances, len(self))
+
+    def index_of(self, person_id) -> int:
+        return self.cohort.index_of(person_id)
+
+    def _row_distances(self, cohort: PackedCohort, i: int, indices: np.ndarray) -> np.ndarray:
+        values = np.empty(len(indices))
+        for start in range(0, len(indices), self.tile_size):
+            chunk = indices[start:start + self.tile_size]
+            values[start:start + len(chunk)] = mdtw_distance_one_to_many(
+                cohort, i, chunk, self.delta, self.beta, self.alpha, max_time_gap=self.max_time_gap)
+        return values
+
+    def add(self, persons: Union[PackedCohort, dict, List[dict]]) -> None:
+        """
+        Append persons and compute their distances to everyone.
+
+        Args:
+            persons (PackedCohort, dict or list): New persons, packed, as ``prepare_person`` output
+                keyed by id, or as raw person dictionaries.
+
+        Raises:
+            ValueError: If an id is already present or repeated.
+        """
+        new = _as_cohort(persons).weighted(self.W)
+        ids = self.cohort.ids.tolist() + new.ids.tolist()
+        if len(set(ids)) != len(ids):
+            raise ValueError("Person ids must be unique.")
+
+        n_old = len(self.cohort)
+        cohort = self.cohort.concat(new) if n_old else new
+        n = len(cohort)
+        distances = np.empty(condensed_size(n))
+        new_indices = np.arange(n_old, n)
+
+        for i in range(n):
+            start = condensed_index(n, i, i + 1)
+            if i < n_old:
+                # Existing pairs move to the wider row, new columns are computed
+                old_start = condensed_index(n_old, i, i + 1)
+                n_kept = n_old - i - 1
+                distances[start:start + n_kept] = self.distances[old_start:old_start + n_kept]
+                distances[start + n_kept:start + n - i - 1] = self._row_distances(cohort, i, new_indices)
+            else:
+                distances[start:start + n - i - 1] = self._row_distances(cohort, i, np.arange(i + 1, n))
+
+        self.cohort = cohort
+        self.distances = distances
+
+    def remove(self, ids: list) -> None:
+        """
+        Drop persons and compact the storage.
+
+        Args:
+            ids (list): Ids of the persons to remove.
+
+        Raises:
+            KeyError: If an id is not present.
+        """
+        drop = {self.index_of(person_id) for person_id in ids}
+        keep = np.array([i for i in range(len(self)) if i not in drop], dtype=np.int64)
+        n_old, n = len(self), len(keep)
+        distances = np.empty(condensed_size(n))
+
+        for row, i in enumerate(keep):
+            old_start = condensed_index(n_old, i, i + 1)
+            columns = keep[row + 1:]
+            start = condensed_index(n, row, row + 1)
+            distances[start:start + len(columns)] = self.distances[old_start + columns - i - 1]
+
+        self.cohort = self.cohort.subset(keep)
+        self.distances = distances
+
+    def save(self, path: str) -> None:
+        """
+        Write the cohort, distances and parameters to an ``.npz`` file.
+
+        Args:
+            path (str): Destination file.
+        """
+        cohort = self.cohort
+        parameters = [self.delta, self.beta, self.alpha, np.nan if self.max_time_gap is None else self.max_time_gap]
+        np.savez(path, ids=cohort.ids, times=cohort.times, nutrients=cohort.nutrients, offsets=cohort.offsets,
+                 sq_norms=cohort.sq_norms, distances=self.distances, parameters=np.array(parameters),
+                 W=np.zeros(0) if self.W is None else np.asarray(self.W, dtype=np.float64),
+                 weight_factor=np.zeros(0) if cohort.weight_factor is None else cohort.weight_factor)
+
+    @classmethod
+    def load(cls, path: str, tile_size: int = 128) -> "IncrementalDistanceMatrix":
+        """
+        Read a matrix written by ``save``.
+
+        Args:
+            path (str): Source file.
+            tile_size (int): Number of candidates sent to the batched kernel at once.
+
+        Returns:
+            IncrementalDistanceMatrix: Loaded matrix.
+        """
+        with np.load(path) as arrays:
+            delta, beta, alpha, max_time_gap = arrays['parameters'].tolist()
+            W = arrays['W'] if 'W' in arrays.files and arrays['W'].size else None
+            matrix = cls(delta, beta, alpha, None if np.isnan(max_time_gap) else max_time_gap, tile_size, W)
+            factor = arrays['weight_factor'] if 'weight_factor' in arrays.files and arrays['weight_factor'].size else None
+            matrix.cohort = PackedCohort(arrays['ids'], arrays['times'], arrays['nutrients'], arrays['offsets'],
+                                         arrays['sq_norms'], factor)
+            matrix.distances = arrays['distances']
+        return matrix
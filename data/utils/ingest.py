@@ -0,0 +1,253 @@
+import bz2
+import gzip
+import lzma
+import os
+import pickle
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+from itertools import groupby
+from typing import List, Dict, Iterator, Iterable, Tuple
+
+from data.utils.cohort import PackedCohort, PackedCohortWriter, prepare_cohort
+from data.utils.modified_mdtw import prepare_person
+
+_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def infer_format(path: str) -> str:
+    """
+    Infer the format of an event log from its file name, ignoring a compression suffix.
+
+    Args:
+        path (str): File name ending in .csv, .jsonl, .ndjson, .json, .parquet or .pq.
+
+    Returns:
+        str: 'csv', 'jsonl' or 'parquet'.
+
+    Raises:
+        ValueError: If the suffix is not recognized.
+    """
+    name = path.lower()
+    for suffix in ('.gz', '.bz2', '.xz', '.zst', '.zip'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    for suffix, file_format in (('.csv', 'csv'), ('.jsonl', 'jsonl'), ('.ndjson', 'jsonl'), ('.json', 'jsonl'),
+                                ('.parquet', 'parquet'), ('.pq', 'parquet')):
+        if name.endswith(suffix):
+            return file_format
+    raise ValueError(f"Cannot infer the format of {path}; pass format='csv', 'jsonl' or 'parquet'.")
+
+
+def open_text(path: str, mode: str = 'rt'):
+    """
+    Open a text file, through gzip, bz2 or lzma when its suffix says it is compressed.
+
+    Args:
+        path (str): File to open.
+        mode (str): 'rt' or 'wt'.
+
+    Returns:
+        file: Text file object without newline translation, as the csv module expects.
+    """
+    opener = _OPENERS.get(os.path.splitext(path)[1].lower(), open)
+    return opener(path, mode, newline='')
+
+
+def read_event_chunks(path: str, format: str = None, chunksize: int = 100_000) -> Iterator[pd.DataFrame]:
+    """
+    Read a long-format event log in chunks, one row per eating event.
+
+    Args:
+        path (str): CSV, JSON-lines or Parquet file; compressed CSV and JSON-lines are supported.
+        format (str, optional): 'csv', 'jsonl' or 'parquet', inferred from the file name by default.
+        chunksize (int): Number of rows per chunk.
+
+    Yields:
+        pd.DataFrame: Consecutive chunks of the file.
+    """
+    file_format = format or infer_format(path)
+    if file_format == 'csv':
+        with pd.read_csv(path, chunksize=chunksize) as reader:
+            yield from reader
+    elif file_format == 'jsonl':
+        with pd.read_json(path, lines=True, chunksize=chunksize, convert_dates=False) as reader:
+            yield from reader
+    elif file_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Reading Parquet files requires pyarrow.") from error
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unknown format {file_format!r}; expected 'csv', 'jsonl' or 'parquet'.")
+
+
+def _group_sorted(events: Iterable[Tuple], seen: set) -> Iterator[Tuple[object, List[Tuple]]]:
+    for person_id, rows in groupby(events, key=lambda event: event[0]):
+        if person_id in seen:
+            raise ValueError(f"Rows of person {person_id} are not contiguous; use sorted_input=False.")
+        seen.add(person_id)
+        yield person_id, list(rows)
+
+
+def _partition(person_id, n_partitions: int, level: int) -> int:
+    """
+    Spill file of a person at a given re-partitioning level. The CRC of the id is stable
+    across processes, unlike ``hash`` of a string, and each level uses other digits of it.
+    """
+    return zlib.crc32(str(person_id).encode()) // n_partitions ** level % n_partitions
+
+
+def _spill(events: Iterable[Tuple], directory: str, buffer_rows: int, n_partitions: int,
+           level: int) -> List[Tuple[str, int]]:
+    directory = tempfile.mkdtemp(dir=directory)
+    paths = [os.path.join(directory, f"partition_{k}.pkl") for k in range(n_partitions)]
+    counts = [0] * n_partitions
+    buffer = []
+
+    def spill():
+        partitions = {}
+        for event in buffer:
+            partitions.setdefault(_partition(event[0], n_partitions, level), []).append(event)
+        for k, rows in partitions.items():
+            with open(paths[k], 'ab') as file:
+                pickle.dump(rows, file, protocol=pickle.HIGHEST_PROTOCOL)
+            counts[k] += len(rows)
+        buffer.clear()
+
+    for event in events:
+        buffer.append(event)
+        if len(buffer) >= buffer_rows:
+            spill()
+    spill()
+    return [(path, count) for path, count in zip(paths, counts) if count]
+
+
+def _read_spilled(path: str) -> Iterator[Tuple]:
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                rows = pickle.load(file)
+            except EOFError:
+                break
+            yield from rows
+
+
+def _group_partitions(events: Iterable[Tuple], directory: str, buffer_rows: int, n_partitions: int,
+                      level: int = 0, n_rows: int = None) -> Iterator[Tuple[object, List[Tuple]]]:
+    for path, count in _spill(events, directory, buffer_rows, n_partitions, level):
+        # Split partitions that would not fit in the buffer again, unless the last split did not
+        # separate anything (a single person) or the CRC has no digits left
+        if count > buffer_rows and (n_rows is None or count < n_rows) and n_partitions ** (level + 1) < 2 ** 32:
+            yield from _group_partitions(_read_spilled(path), directory, buffer_rows, n_partitions, level + 1, count)
+        else:
+            persons = {}
+            for event in _read_spilled(path):
+                persons.setdefault(event[0], []).append(event)
+            yield from persons.items()
+        os.remove(path)
+
+
+def _group_spilled(events: Iterable[Tuple], buffer_rows: int, n_partitions: int,
+                   spill_dir: str = None) -> Iterator[Tuple[object, List[Tuple]]]:
+    with tempfile.TemporaryDirectory(dir=spill_dir) as directory:
+        yield from _group_partitions(events, directory, buffer_rows, n_partitions)
+
+
+def iter_persons(path: str, format: str = None, person_column: str = 'person_id', time_column: str = 'time',
+                 nutrient_columns: List[str] = None, sorted_input: bool = True, chunksize: int = 100_000,
+                 buffer_rows: int = 1_000_000, n_partitions: int = 64, spill_dir: str = None) -> Iterator[Dict]:
+    """
+    Stream persons out of a long-format event log.
+
+    With ``sorted_input`` the rows of each person must be contiguous and only the
+    current chunk and one person's rows are held in memory, plus the set of ids
+    already seen, which grows by one id per person and is what detects rows that
+    are not contiguous. Otherwise rows are buffered up to ``buffer_rows`` and
+    spilled to ``n_partitions`` temporary files by a CRC of the person id; a file
+    holding more than ``buffer_rows`` rows is split again into ``n_partitions``
+    files, so every partition grouped in memory fits in the buffer unless a single
+    person has more rows than that. Peak memory is thus about ``buffer_rows`` rows
+    whatever the size of the input.
+
+    Args:
+        path (str): CSV, JSON-lines or Parquet file.
+        format (str, optional): 'csv', 'jsonl' or 'parquet', inferred from the file name by default.
+        person_column (str): Column holding the person id.
+        time_column (str): Column holding the event time.
+        nutrient_columns (list, optional): Nutrient columns, every other column by default.
+        sorted_input (bool): Whether the rows are grouped by person.
+        chunksize (int): Number of rows read at a time.
+        buffer_rows (int): Rows buffered before spilling, for unsorted input.
+        n_partitions (int): Number of spill files a partition is split into, for unsorted input.
+        spill_dir (str, optional): Parent directory of the spill files.
+
+    Yields:
+        dict: Person in the ``{'person_id': ..., 'records': [{'time': ..., 'nutrients': [...]}]}`` form
+        expected by ``prepare_person``, in input order for sorted input.
+
+    Raises:
+        ValueError: If ``sorted_input`` is set and a person's rows are not contiguous.
+    """
+    def events():
+        columns = nutrient_columns
+        for chunk in read_event_chunks(path, format, chunksize):
+            if columns is None:
+                columns = [column for column in chunk.columns if column not in (person_column, time_column)]
+            times = chunk[time_column].to_numpy(dtype=np.float64).tolist()
+            nutrients = chunk[columns].to_numpy(dtype=np.float64).tolist()
+            yield from zip(chunk[person_column].tolist(), times, nutrients)
+
+    if sorted_input:
+        groups = _group_sorted(events(), set())
+    else:
+        groups = _group_spilled(events(), buffer_rows, n_partitions, spill_dir)
+
+    for person_id, rows in groups:
+        yield {'person_id': person_id, 'records': [{'time': t, 'nutrients': v} for _, t, v in rows]}
+
+
+def iter_prepared_persons(path: str, **kwargs) -> Iterator[Tuple[object, Dict]]:
+    """
+    Stream prepared persons out of a long-format event log.
+
+    Args:
+        path (str): CSV, JSON-lines or Parquet file.
+        **kwargs: Passed to ``iter_persons``.
+
+    Yields:
+        tuple: Person id and the output of ``prepare_person``.
+    """
+    for person in iter_persons(path, **kwargs):
+        yield person['person_id'], prepare_person(person)
+
+
+def ingest_cohort(path: str, directory: str, batch_size: int = 10_000, **kwargs) -> PackedCohort:
+    """
+    Prepare a long-format event log straight into an on-disk packed cohort.
+
+    Persons are prepared ``batch_size`` at a time with ``prepare_cohort`` and
+    appended through ``PackedCohortWriter``.
+
+    Args:
+        path (str): CSV, JSON-lines or Parquet file.
+        directory (str): Output directory of the cohort.
+        batch_size (int): Number of persons prepared at a time.
+        **kwargs: Passed to ``iter_persons``.
+
+    Returns:
+        PackedCohort: The written cohort, memory-mapped.
+    """
+    with PackedCohortWriter(directory) as writer:
+        batch = []
+        for person in iter_persons(path, **kwargs):
+            batch.append(person)
+            if len(batch) >= batch_size:
+                writer.append(prepare_cohort(batch))
+                batch = []
+        if batch:
+            writer.append(prepare_cohort(batch))
+    return PackedCohort.open(directory)
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class JobStats:
+    """
+    Progress, counters and phase timings of a distance computation job.
+
+    Pass an instance as ``stats`` to ``calculate_distance_matrix`` or
+    ``MDTWIndex.query_batch``. Counters are summed over all workers:
+
+    - ``pairs``: pairs whose distance is final, computed or read from the cache.
+    - ``dp_cells``: cells of the DP grids evaluated by the MDTW kernel.
+    - ``pairs_pruned``: pairs skipped because a lower bound exceeded the cutoff.
+    - ``pairs_skipped``: pruned pairs of ``MDTWIndex`` dropped with a whole tree node.
+    - ``pairs_abandoned``: pairs whose DP stopped early at the cutoff.
+    - ``cache_hits`` and ``cache_misses``: lookups in a ``DistanceCache``.
+
+    ``progress(pairs_done, total_pairs, pairs_per_second)`` is called at most once
+    every ``interval`` seconds and when the job ends. ``export(record)`` receives
+    the ``as_dict`` snapshot with an ``event`` field, 'progress' or 'done', at the
+    same moments; ``JsonLinesLogger`` writes these records to a file.
+    """
+
+    COUNTERS = ('pairs', 'dp_cells', 'pairs_pruned', 'pairs_skipped', 'pairs_abandoned', 'cache_hits', 'cache_misses')
+
+    def __init__(self, progress: callable = None, export: callable = None, interval: float = 1.0):
+        """
+        Args:
+            progress (callable, optional): Called as progress(pairs_done, total_pairs, pairs_per_second).
+            export (callable, optional): Called with a dictionary snapshot of the statistics.
+            interval (float): Smallest number of seconds between two progress reports.
+        """
+        self.progress = progress
+        self.export = export
+        self.interval = interval
+        self.total_pairs = 0
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.phases = {}
+        self._start = None
+        self._last_report = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def start(self, total_pairs: int) -> None:
+        """
+        Begin a job of ``total_pairs`` pairs; counters and phases of earlier jobs are kept.
+        """
+        self.total_pairs += total_pairs
+        if self._start is None:
+            self._start = time.perf_counter()
+        self._last_report = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return 0.0 if self._start is None else time.perf_counter() - self._start
+
+    @property
+    def pairs_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.counters['pairs'] / elapsed if elapsed > 0 else 0.0
+
+    def update(self, counts: Dict[str, int]) -> None:
+        """
+        Add counts, e.g. ``{'pairs': 128, 'dp_cells': 4096}``, and report progress when due.
+        """
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            now = time.perf_counter()
+            due = self._last_report is not None and now - self._last_report >= self.interval
+            if due:
+                self._last_report = now
+        if due:
+            self._report('progress')
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Add the wall time of the enclosed block to phase ``name``.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self) -> None:
+        """
+        Send the final progress report and export record.
+        """
+        self._report('done')
+
+    def _report(self, event: str) -> None:
+        if self.progress is not None:
+            self.progress(self.counters['pairs'], self.total_pairs, self.pairs_per_second)
+        if self.export is not None:
+            self.export(dict(self.as_dict(), event=event))
+
+    def as_dict(self) -> dict:
+        """
+        Snapshot of the statistics.
+
+        Returns:
+            dict: Total pairs, elapsed seconds, pairs per second, every counter and
+            the seconds spent in each phase.
+        """
+        return dict(total_pairs=self.total_pairs, elapsed=self.elapsed, pairs_per_second=self.pairs_per_second,
+                    **self.counters, phases=dict(self.phases))
+
+
+class JsonLinesLogger:
+    """
+    Export hook appending every record as one JSON line, with a wall-clock timestamp.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Log file, appended to.
+        """
+        self.path = path
+
+    def __call__(self, record: dict) -> None:
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(dict(record, timestamp=time.time())) + "\n")
@@ -0,0 +1,286 @@
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple, Union, NamedTuple
+
+from data.utils.cohort import PackedCohort
+from data.utils.modified_mdtw import calculate_distance_matrix, mdtw_distance_one_to_many
+
+
+class KMedoidsResult(NamedTuple):
+    """
+    Outcome of a k-medoids clustering.
+
+    Attributes:
+        medoid_ids (list): Ids of the medoids.
+        medoids (np.ndarray): Cohort indices of the medoids, shape (k,).
+        labels (np.ndarray): Index into ``medoids`` of every person's nearest medoid, shape (n,).
+        inertia (float): Sum of the distances of every person to its medoid.
+        n_distance_calls (int): Number of pairwise MDTW distances computed.
+    """
+    medoid_ids: list
+    medoids: np.ndarray
+    labels: np.ndarray
+    inertia: float
+    n_distance_calls: int
+
+
+class LazyDistances:
+    """
+    MDTW distances over a packed cohort, computed on demand.
+
+    Full rows (one person against everyone) are kept in a least recently used cache
+    of ``max_cached_rows`` rows, so memory stays at ``max_cached_rows * n`` values.
+    ``n_calls`` counts every pair actually computed.
+    """
+
+    def __init__(self, cohort: PackedCohort, delta: float = 23, beta: float = 1, alpha: float = 2, max_time_gap: float = None,
+                 max_cached_rows: int = 64, tile_size: int = 128):
+        """
+        Args:
+            cohort (PackedCohort): Packed cohort.
+            delta (float): Time scaling factor.
+            beta (float): Weighting factor for time difference.
+            alpha (float): Exponent for time difference scaling.
+            max_time_gap (float, optional): Largest time difference allowed between matched events.
+            max_cached_rows (int): Largest number of full rows kept.
+            tile_size (int): Number of candidates sent to the batched kernel at once.
+        """
+        self.cohort = cohort
+        self.params = dict(delta=delta, beta=beta, alpha=alpha, max_time_gap=max_time_gap)
+        self.max_cached_rows = max_cached_rows
+        self.tile_size = tile_size
+        self.n_calls = 0
+        self._rows = OrderedDict()
+
+    def row(self, i: int) -> np.ndarray:
+        """
+        Distances from person ``i`` to every person.
+        """
+        i = int(i)
+        if i in self._rows:
+            self._rows.move_to_end(i)
+            return self._rows[i]
+        n = len(self.cohort)
+        others = np.delete(np.arange(n), i)
+        row = np.zeros(n)
+        for start in range(0, len(others), self.tile_size):
+            chunk = others[start:start + self.tile_size]
+            row[chunk] = mdtw_distance_one_to_many(self.cohort, i, chunk, **self.params)
+        self.n_calls += len(others)
+        self._rows[i] = row
+        if len(self._rows) > self.max_cached_rows:
+            self._rows.popitem(last=False)
+        return row
+
+    def pairwise(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Square distance matrix between the given persons.
+        """
+        self.n_calls += len(indices) * (len(indices) - 1) // 2
+        return calculate_distance_matrix(self.cohort.subset(indices), tile_size=self.tile_size, **self.params)
+
+
+def _nearest_two(D: np.ndarray, medoids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    to_medoids = D[:, medoids]
+    order = np.argsort(to_medoids, axis=1)[:, :2]
+    nearest = order[:, 0]
+    rows = np.arange(len(D))
+    second = to_medoids[rows, order[:, 1]] if len(medoids) > 1 else np.full(len(D), np.inf)
+    return nearest, to_medoids[rows, nearest], second
+
+
+def _swap_changes(d: np.ndarray, nearest: np.ndarray, dn: np.ndarray, ds: np.ndarray, removal: np.ndarray) -> np.ndarray:
+    """
+    Change of the total distance when the point at distances ``d`` replaces each medoid,
+    from the nearest and second nearest medoid of every point (FasterPAM).
+    """
+    k = len(removal)
+    closer = d < dn
+    between = ~closer & (d < ds)
+    return (removal + np.sum(d[closer] - dn[closer])
+            + np.bincount(nearest[closer], weights=dn[closer] - ds[closer], minlength=k)
+            + np.bincount(nearest[between], weights=d[between] - ds[between], minlength=k))
+
+
+def build_medoids(D: np.ndarray, n_clusters: int) -> np.ndarray:
+    """
+    Greedy BUILD initialization: repeatedly add the medoid that lowers the total distance most.
+
+    Args:
+        D (np.ndarray): Square distance matrix.
+        n_clusters (int): Number of medoids.
+
+    Returns:
+        np.ndarray: Indices of the medoids.
+    """
+    medoids = [int(np.argmin(D.sum(axis=0)))]
+    closest = D[:, medoids[0]].copy()
+    for _ in range(1, n_clusters):
+        totals = np.minimum(D, closest[:, None]).sum(axis=0)
+        totals[medoids] = np.inf
+        medoids.append(int(np.argmin(totals)))
+        np.minimum(closest, D[:, medoids[-1]], out=closest)
+    return np.array(medoids, dtype=np.int64)
+
+
+def fasterpam(D: np.ndarray, n_clusters: int = None, medoids: np.ndarray = None, max_iter: int = 100) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    FasterPAM k-medoids on a square distance matrix.
+
+    Each candidate is evaluated against all medoids at once from the nearest and
+    second nearest medoid distances, and the best improving swap for a candidate is
+    applied immediately (Schubert and Rousseeuw, 2021).
+
+    Args:
+        D (np.ndarray): Square distance matrix.
+        n_clusters (int, optional): Number of medoids, required without ``medoids``.
+        medoids (np.ndarray, optional): Initial medoids; ``build_medoids`` is used otherwise.
+        max_iter (int): Largest number of passes over the candidates.
+
+    Returns:
+        tuple: Medoid indices, label of every point and the total distance.
+    """
+    D = np.asarray(D, dtype=np.float64)
+    n = len(D)
+    medoids = build_medoids(D, n_clusters) if medoids is None else np.array(medoids, dtype=np.int64)
+    k = len(medoids)
+    if not 0 < k <= n:
+        raise ValueError("The number of clusters must be between 1 and the number of points.")
+    nearest, dn, ds = _nearest_two(D, medoids)
+    removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+
+    # Visit candidates cyclically until a full round brings no improvement
+    since_swap = 0
+    for step in range(max_iter * n):
+        if since_swap >= n:
+            break
+        x = step % n
+        since_swap += 1
+        if x in medoids:
+            continue
+        change = _swap_changes(D[:, x], nearest, dn, ds, removal)
+        best = int(np.argmin(change))
+        if change[best] < -1e-12 * max(1.0, dn.sum()):
+            medoids[best] = x
+            nearest, dn, ds = _nearest_two(D, medoids)
+            removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+            since_swap = 0
+    return medoids, nearest, float(dn.sum())
+
+
+def _assign(distances: LazyDistances, medoids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    to_medoids = np.stack([distances.row(m) for m in medoids], axis=1)
+    labels = np.argmin(to_medoids, axis=1)
+    return labels, to_medoids[np.arange(len(labels)), labels]
+
+
+def _swap_pass(distances: LazyDistances, medoids: np.ndarray, candidates: np.ndarray) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Apply improving FasterPAM swaps between the medoids and the candidates, scored on the whole
+    cohort from their rows, until none is left.
+
+    Returns:
+        tuple: Sorted medoid indices, label of every person and the total distance.
+    """
+    medoids = np.array(medoids, dtype=np.int64)
+    k = len(medoids)
+    to_medoids = np.stack([distances.row(m) for m in medoids], axis=1)
+    nearest, dn, ds = _nearest_two(to_medoids, np.arange(k))
+    removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+    improved = True
+    while improved:
+        improved = False
+        for x in candidates:
+            if x in medoids:
+                continue
+            d = distances.row(x)
+            change = _swap_changes(d, nearest, dn, ds, removal)
+            best = int(np.argmin(change))
+            if change[best] < -1e-12 * max(1.0, dn.sum()):
+                medoids[best] = x
+                to_medoids[:, best] = d
+                nearest, dn, ds = _nearest_two(to_medoids, np.arange(k))
+                removal = np.bincount(nearest, weights=ds - dn, minlength=k)
+                improved = True
+    order = np.argsort(medoids)
+    return medoids[order], np.argsort(order)[nearest], float(dn.sum())
+
+
+def clara(prepared_data: Union[dict, PackedCohort], n_clusters: int, delta: float = 23, beta: float = 1, alpha: float = 2,
+          max_time_gap: float = None, n_samples: int = 5, sample_size: int = None, max_iter: int = 100, max_cached_rows: int = None,
+          random_state: int = None, tile_size: int = 128, W=None) -> KMedoidsResult:
+    """
+    CLARA k-medoids under MDTW without building the full distance matrix.
+
+    Every round draws a sample, always containing the best medoids found so far,
+    clusters it with ``fasterpam`` on its own distance matrix and scores the medoids
+    on the whole cohort. Only the sample matrices and one row per medoid are
+    computed, i.e. about ``n_samples * (sample_size^2 / 2 + k * n)`` distances instead
+    of ``n^2 / 2``. Medoid rows are cached, so medoids kept between rounds cost nothing.
+    A final FasterPAM swap pass on the whole cohort tries the medoids of the other
+    rounds in place of the best ones, from their cached rows. When the cohort is not
+    larger than the sample, this is exact FasterPAM.
+
+    Args:
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        n_clusters (int): Number of clusters.
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        n_samples (int): Number of sampling rounds.
+        sample_size (int, optional): Persons per sample, ``80 + 4 * n_clusters + 4 * sqrt(n)`` by default,
+            at most ``n / sqrt(4 * n_samples)``.
+        max_iter (int): Largest number of FasterPAM passes per sample.
+        max_cached_rows (int, optional): Medoid rows kept in memory, ``n_samples * n_clusters`` by default,
+            enough for the medoids of every round.
+        random_state (int, optional): Seed of the sampling.
+        tile_size (int): Number of candidates sent to the batched kernel at once.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        KMedoidsResult: Medoids, labels, inertia and number of distance calls.
+
+    Raises:
+        ValueError: If n_clusters is not between 1 and the number of persons, n_samples
+            is not positive or sample_size is smaller than n_clusters.
+    """
+    if n_samples < 1:
+        raise ValueError("The number of samples must be positive.")
+    if sample_size is not None and sample_size < n_clusters:
+        raise ValueError("The sample size must be at least the number of clusters.")
+    cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+    cohort = cohort.weighted(W)
+    n = len(cohort)
+    if not 0 < n_clusters <= n:
+        raise ValueError("The number of clusters must be between 1 and the number of persons.")
+    if sample_size is None:
+        # Grows with n to keep the medoids close to FasterPAM on the whole cohort, while the
+        # sample matrices of all rounds hold at most an eighth of its pairs
+        sample_size = min(80 + 4 * n_clusters + int(4 * np.sqrt(n)), int(n / np.sqrt(4 * n_samples)))
+        sample_size = max(sample_size, n_clusters)
+    sample_size = min(n, sample_size)
+    distances = LazyDistances(cohort, delta, beta, alpha, max_time_gap, max_cached_rows or n_samples * n_clusters, tile_size)
+    rng = np.random.default_rng(random_state)
+
+    best = None
+    candidates = []
+    for _ in range(n_samples if sample_size < n else 1):
+        if best is None:
+            sample = np.sort(rng.choice(n, sample_size, replace=False))
+        else:
+            others = rng.choice(np.setdiff1d(np.arange(n), best[0]), sample_size - n_clusters, replace=False)
+            sample = np.sort(np.concatenate([best[0], others]))
+        sample_medoids = fasterpam(distances.pairwise(sample), n_clusters, max_iter=max_iter)[0]
+        medoids = np.sort(sample[sample_medoids])
+        candidates.extend(medoids)
+        labels, to_medoid = _assign(distances, medoids)
+        inertia = float(to_medoid.sum())
+        if best is None or inertia < best[2]:
+            best = (medoids, labels, inertia)
+
+    medoids, labels, inertia = best
+    if sample_size < n:
+        medoids, labels, inertia = _swap_pass(distances, medoids, np.unique(candidates))
+    return KMedoidsResult(cohort.ids[medoids].tolist(), medoids, labels, inertia, distances.n_calls)
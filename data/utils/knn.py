@@ -0,0 +1,494 @@
+import heapq
+import numpy as np
+from joblib import Parallel, delayed
+from typing import List, Dict, Tuple, Union, NamedTuple
+
+from data.utils.cohort import PackedCohort
+from data.utils.instrument import JobStats
+from data.utils.modified_mdtw import (LOCAL_COST_BLOCK_SIZE, events_to_arrays, validate_nutrients, mdtw_distance_batch)
+
+# Number of equal time bins over the stored event times summarized by every tree node
+TIME_BINS = 24
+# Heap entry kinds of the best-first search; persons come first on equal bounds
+_PERSON, _NODE = 0, 1
+
+
+class KNNResult(NamedTuple):
+    """
+    Answer to a k-nearest-neighbour query.
+
+    Attributes:
+        ids (list): Ids of the nearest persons, closest first.
+        distances (np.ndarray): Their MDTW distances to the query.
+        n_pruned (int): Candidates skipped because a lower bound exceeded the k-th best distance.
+        n_abandoned (int): Candidates whose DP was abandoned early.
+        n_computed (int): Candidates whose DP ran to completion.
+        n_skipped (int): Pruned candidates skipped with their whole tree node, without a bound of their own.
+    """
+    ids: list
+    distances: np.ndarray
+    n_pruned: int
+    n_abandoned: int
+    n_computed: int
+    n_skipped: int
+
+
+class MDTWIndex:
+    """
+    Exact k-nearest-neighbour search under MDTW over a prepared cohort.
+
+    Stored persons are split recursively at the median of their sorted event norms,
+    along the rank that varies most, into a binary tree whose leaves hold at most
+    ``leaf_size`` persons. Every node keeps envelopes of its persons: the range of
+    each sorted norm, of the nutrient totals and of the lengths, and the largest
+    event norm and per-person norm sum in each of ``TIME_BINS`` time bins. These give
+    lower bounds on ``lb_norms``, ``lb_mass`` and ``lb_time`` valid for every person
+    below the node.
+
+    A query walks the tree best first. Nodes whose bound exceeds the current k-th
+    best distance are skipped with all their persons; the persons of the leaves
+    reached get their own bounds, and are then visited in increasing bound order,
+    in batches through ``mdtw_distance_batch`` with the k-th best distance as
+    cutoff. The search ends when the smallest pending bound exceeds it.
+
+    MDTW is not a metric, so pivot bounds from the triangle inequality do not
+    apply; the tree relies on the bounds alone. The fraction of persons reached
+    falls as the cohort grows, for k = 5 about 22% of 2,000, 10% of 20,000 and 7%
+    of 100,000 synthetic persons, and latency is then dominated by the DPs that
+    no bound prunes. Node bounds use coarse time bins, so small ``delta`` values,
+    where ``lb_time`` does most of the pruning, reach more of the tree. The node
+    envelopes take about ``(2 * L + 2 * d + 2 * TIME_BINS + 2) * 16 / leaf_size``
+    bytes per person, for the longest length L and d nutrients.
+    """
+
+    def __init__(self, prepared_data: Union[dict, PackedCohort], delta: float = 23, beta: float = 1, alpha: float = 2, max_time_gap: float = None,
+                 batch_size: int = 64, W=None, leaf_size: int = 32):
+        """
+        Args:
+            prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+                or the same cohort in packed form.
+            delta (float): Time scaling factor.
+            beta (float): Weighting factor for time difference.
+            alpha (float): Exponent for time difference scaling.
+            max_time_gap (float, optional): Largest time difference allowed between matched events.
+            batch_size (int): Largest number of candidates sent to the batched kernel at once.
+            W (array-like, optional): Nutrient weight matrix, see ``local_distance``; applied once
+                to the stored cohort and to every query. Queries of a cohort weighted beforehand
+                get its weights without passing W.
+            leaf_size (int): Largest number of persons in a leaf of the tree.
+
+        Raises:
+            ValueError: If leaf_size is not positive.
+        """
+        if leaf_size < 1:
+            raise ValueError("leaf_size must be positive.")
+        cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+        self.cohort = cohort.weighted(W)
+        self.W = W
+        self.delta = delta
+        self.beta = beta
+        self.alpha = alpha
+        self.max_time_gap = max_time_gap
+        self.batch_size = batch_size
+
+        cohort = self.cohort
+        lengths = cohort.lengths
+        owner = np.repeat(np.arange(len(cohort)), lengths)
+        norms = np.sqrt(cohort.sq_norms)
+
+        # Per-person norms sorted in decreasing order, zero padded to the longest person
+        order = np.lexsort((-norms, owner))
+        rank = np.arange(len(norms)) - np.repeat(cohort.offsets[:-1], lengths)
+        self._sorted_norms = np.zeros((len(cohort), max(int(lengths.max(initial=0)), 1)))
+        self._sorted_norms[owner, rank] = norms[order]
+
+        self._totals = np.zeros((len(cohort), cohort.n_features))
+        np.add.at(self._totals, owner, cohort.nutrients)
+        self._sq_totals = np.bincount(owner, weights=cohort.sq_norms, minlength=len(cohort))
+        self._build_tree(leaf_size)
+
+    def _build_tree(self, leaf_size: int) -> None:
+        """
+        Split the persons into the tree and summarize every node, see the class docstring.
+        """
+        cohort = self.cohort
+        n = len(cohort)
+        # Nodes in creation order, each owning the persons perm[start:stop]; the root is node 0
+        perm = np.arange(n)
+        starts, stops, depths, left, right = [0], [n], [0], [-1], [-1]
+        pending = [0] if n > leaf_size else []
+        while pending:
+            node = pending.pop()
+            start, stop = starts[node], stops[node]
+            features = self._sorted_norms[perm[start:stop]]
+            order = np.argsort(features[:, np.argmax(features.var(axis=0))], kind='stable')
+            perm[start:stop] = perm[start:stop][order]
+            middle = (start + stop) // 2
+            for bounds, children in (((start, middle), left), ((middle, stop), right)):
+                children[node] = len(starts)
+                starts.append(bounds[0])
+                stops.append(bounds[1])
+                depths.append(depths[node] + 1)
+                left.append(-1)
+                right.append(-1)
+                if bounds[1] - bounds[0] > leaf_size:
+                    pending.append(children[node])
+        self._perm = perm
+        self._starts, self._stops = np.array(starts), np.array(stops)
+        self._left, self._right = np.array(left), np.array(right)
+
+        # Time bins over the stored events; bounds only need every event inside its bin
+        lengths = cohort.lengths
+        t0 = float(cohort.times.min()) if len(cohort.times) else 0.0
+        span = float(cohort.times.max()) - t0 if len(cohort.times) else 0.0
+        self._bin_width = span / TIME_BINS if span > 0 else 1.0
+        self._bin_starts = t0 + self._bin_width * np.arange(TIME_BINS)
+        owner = np.repeat(np.arange(n), lengths)
+        bins = np.minimum(((cohort.times - t0) / self._bin_width).astype(np.int64), TIME_BINS - 1)
+        norms = np.sqrt(cohort.sq_norms)
+
+        # Leaf envelopes first, as the leaves cut perm into contiguous runs; in that order
+        # every run ends where the next begins, as reduceat expects
+        leaves = np.flatnonzero(self._left < 0)
+        leaves = leaves[np.argsort(self._starts[leaves])]
+        leaf_of = np.empty(n, dtype=np.int64)
+        leaf_of[perm] = np.repeat(np.arange(len(leaves)), self._stops[leaves] - self._starts[leaves])
+        n_nodes = len(starts)
+
+        def reduce(ufunc, values):
+            envelope = np.zeros((n_nodes,) + values.shape[1:])
+            if n:
+                envelope[leaves] = ufunc.reduceat(values[perm], self._starts[leaves], axis=0)
+            return envelope
+
+        self._norms_low = reduce(np.minimum, self._sorted_norms)
+        self._norms_high = reduce(np.maximum, self._sorted_norms)
+        self._totals_low = reduce(np.minimum, self._totals)
+        self._totals_high = reduce(np.maximum, self._totals)
+        self._length_high = reduce(np.maximum, lengths.astype(np.float64))
+        self._sq_totals_low = reduce(np.minimum, self._sq_totals)
+        self._bin_norms = np.zeros((n_nodes, TIME_BINS))
+        np.maximum.at(self._bin_norms, (leaves[leaf_of[owner]], bins), norms)
+        # Norm sum of every person in every bin, then its largest value over the leaf
+        person_bins, inverse = np.unique(owner * TIME_BINS + bins, return_inverse=True)
+        sums = np.bincount(inverse, weights=norms, minlength=len(person_bins))
+        self._bin_sums = np.zeros((n_nodes, TIME_BINS))
+        np.maximum.at(self._bin_sums, (leaves[leaf_of[person_bins // TIME_BINS]], person_bins % TIME_BINS), sums)
+
+        # Then the parents, deepest first
+        depths = np.array(depths)
+        for depth in range(int(depths.max(initial=0)) - 1, -1, -1):
+            parents = np.flatnonzero((depths == depth) & (self._left >= 0))
+            children = (self._left[parents], self._right[parents])
+            for envelope, ufunc in ((self._norms_low, np.minimum), (self._norms_high, np.maximum),
+                                    (self._totals_low, np.minimum), (self._totals_high, np.maximum),
+                                    (self._length_high, np.maximum), (self._sq_totals_low, np.minimum),
+                                    (self._bin_norms, np.maximum), (self._bin_sums, np.maximum)):
+                envelope[parents] = ufunc(envelope[children[0]], envelope[children[1]])
+
+    def _node_bounds(self, nodes: np.ndarray, t: np.ndarray, V: np.ndarray, sq: np.ndarray) -> np.ndarray:
+        """
+        Lower bounds between a query and every person below each of the given nodes.
+
+        Each bound of ``_candidate_bounds`` is relaxed to the node envelopes: the sorted
+        norms and nutrient totals of a person lie within the node ranges, and the
+        time-discounted savings of its matches within those of the binned maxima.
+        """
+        width = max(self._sorted_norms.shape[1], len(sq))
+        query_norms = np.zeros(width)
+        query_norms[:len(sq)] = np.sort(np.sqrt(sq))[::-1]
+        low = np.zeros((len(nodes), width))
+        high = np.zeros((len(nodes), width))
+        low[:, :self._norms_low.shape[1]] = self._norms_low[nodes]
+        high[:, :self._norms_high.shape[1]] = self._norms_high[nodes]
+        bounds = np.sum(np.maximum(0, np.maximum(low - query_norms, query_norms - high)) ** 2, axis=1)
+        if len(sq) == 0:
+            return bounds
+
+        gap = np.maximum(0, np.maximum(self._totals_low[nodes] - V.sum(axis=0), V.sum(axis=0) - self._totals_high[nodes]))
+        np.maximum(bounds, np.einsum('ij,ij->i', gap, gap) / (self._length_high[nodes] + len(sq)), out=bounds)
+
+        # Largest weight between every query event and any time of every bin; a relative slack
+        # keeps events whose bin index was rounded across the edge inside their bin
+        distance = np.maximum(self._bin_starts[None, :] - t[:, None], t[:, None] - self._bin_starts[None, :] - self._bin_width)
+        distance = np.maximum(0, distance - 1e-9 * self._bin_width)
+        weight = np.maximum(0, 1 - self.beta * (distance / self.delta) ** self.alpha)
+        query_norms = np.sqrt(sq)
+        saving_rows = 2 * np.max(weight[None, :, :] * self._bin_norms[nodes][:, None, :], axis=2) @ query_norms
+        saving_cols = 2 * self._bin_sums[nodes] @ np.max(weight * query_norms[:, None], axis=0)
+        bound_time = np.sum(sq) + self._sq_totals_low[nodes] - np.minimum(saving_rows, saving_cols)
+        return np.maximum(bounds, bound_time)
+
+    def __len__(self) -> int:
+        return len(self.cohort)
+
+    def _candidate_bounds(self, t: np.ndarray, V: np.ndarray, sq: np.ndarray, persons: np.ndarray) -> np.ndarray:
+        """
+        Lower bounds between a query and the given stored persons, vectorized over them.
+
+        Computes ``lb_mass``, ``lb_norms`` and ``lb_time`` for all persons at once;
+        the time bound is evaluated over chunks of stored events to bound memory.
+        """
+        cohort = self.cohort
+        lengths = cohort.offsets[persons + 1] - cohort.offsets[persons]
+        width = max(self._sorted_norms.shape[1], len(sq))
+        query_norms = np.zeros(width)
+        query_norms[:len(sq)] = np.sort(np.sqrt(sq))[::-1]
+        stored_norms = np.zeros((len(persons), width))
+        stored_norms[:, :self._sorted_norms.shape[1]] = self._sorted_norms[persons]
+        bounds = np.sum((stored_norms - query_norms) ** 2, axis=1)
+        # reduceat cannot express empty persons; lb_norms is already exact for them
+        if len(sq) == 0 or np.any(lengths == 0):
+            return bounds
+
+        diff = self._totals[persons] - V.sum(axis=0)
+        np.maximum(bounds, np.einsum('ij,ij->i', diff, diff) / (lengths + len(sq)), out=bounds)
+
+        # lb_time: bound the saving of every match by time-discounted norm products,
+        # over the events of the given persons laid out one after the other
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        events = np.repeat(cohort.offsets[persons] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        times = cohort.times[events]
+        query_norms = np.sqrt(sq)
+        stored_norms = np.sqrt(cohort.sq_norms[events])
+        totals = np.sum(sq) + self._sq_totals[persons]
+        block = max(1, LOCAL_COST_BLOCK_SIZE // len(sq))
+        start = 0
+        while start < len(persons):
+            # Whole persons, about `block` events at a time
+            stop = max(int(np.searchsorted(offsets, offsets[start] + block, side='right')) - 1, start + 1)
+            stop = min(stop, len(persons))
+            e0, e1 = offsets[start], offsets[stop]
+            segments = offsets[start:stop] - e0
+            weight = np.maximum(0, 1 - self.beta * (np.abs(t[:, None] - times[None, e0:e1]) / self.delta) ** self.alpha)
+            saving_rows = 2 * query_norms @ np.maximum.reduceat(weight * stored_norms[None, e0:e1], segments, axis=1)
+            saving_cols = 2 * np.add.reduceat(stored_norms[e0:e1] * np.max(weight * query_norms[:, None], axis=0), segments)
+            bound_time = totals[start:stop] - np.minimum(saving_rows, saving_cols)
+            np.maximum(bounds[start:stop], bound_time, out=bounds[start:stop])
+            start = stop
+        return bounds
+
+    def query(self, person: Union[dict, List[Tuple[float, List[float]]]], k: int = 1, stats: JobStats = None) -> KNNResult:
+        """
+        Find the k stored persons closest to a query person.
+
+        Args:
+            person (dict or list): Output of ``prepare_person``, or a sequence of events (time, nutrients).
+            k (int): Number of neighbours.
+            stats (JobStats, optional): Receives the pair, pruning, abandoning and DP cell counts.
+
+        Returns:
+            KNNResult: Neighbours and pruning statistics.
+        """
+        events = list(person.items()) if isinstance(person, dict) else person
+        t, V = events_to_arrays(events)
+        if len(V) == 0:
+            V = np.zeros((0, self.cohort.n_features))
+        # Stored nutrients may be weighted, so only the dimension is compared with them
+        validate_nutrients(V)
+        if len(V) and len(self.cohort.nutrients) and V.shape[1] != self.cohort.n_features:
+            raise ValueError("Mismatch in feature dimensions.")
+        if self.cohort.weight_factor is not None and len(V):
+            V = V @ self.cohort.weight_factor
+        indices, distances, *counts = self._search(t, V, np.einsum('ij,ij->i', V, V), k, stats)
+        return KNNResult(self.cohort.ids[indices].tolist(), distances, *counts)
+
+    def _search(self, t: np.ndarray, V: np.ndarray, sq: np.ndarray, k: int,
+                stats: JobStats = None) -> Tuple[np.ndarray, np.ndarray, int, int, int, int]:
+        """
+        Best-first search for the k stored persons closest to prepared, weighted query arrays.
+
+        Returns:
+            tuple: Indices and distances of the neighbours, closest first, and the pruned,
+            abandoned, computed and skipped candidate counts.
+        """
+        # (bound, kind, item) of the tree nodes and persons still to visit
+        queue = [(float(self._node_bounds(np.zeros(1, dtype=np.int64), t, V, sq)[0]), _NODE, 0)] if len(self) else []
+        heap = []  # (-distance, -index) of the best k so far
+        n_bounded = n_abandoned = n_computed = dp_cells = 0
+
+        # Persons go through the batched kernel; batches start at k and double,
+        # so the cutoff tightens quickly before large batches are issued
+        size = k
+        while queue:
+            kth_best = -heap[0][0] if len(heap) == k else np.inf
+            nodes, node_bounds, persons = [], [], []
+            while queue and queue[0][0] <= kth_best and len(nodes) < size and len(persons) < size:
+                bound, kind, item = heapq.heappop(queue)
+                if kind == _PERSON:
+                    persons.append(item)
+                else:
+                    nodes.append(item)
+                    node_bounds.append(bound)
+            if not nodes and not persons:
+                break
+
+            # Replace the nodes by their children, or leaves by their persons; a bound
+            # below a node is never looser than the bound of the node itself, and entries
+            # bounded above the k-th best distance are dropped as it can only decrease
+            nodes, node_bounds = np.array(nodes, dtype=np.int64), np.array(node_bounds)
+            internal = self._left[nodes] >= 0
+            if internal.any():
+                children = np.concatenate((self._left[nodes[internal]], self._right[nodes[internal]]))
+                bounds = np.maximum(self._node_bounds(children, t, V, sq), np.tile(node_bounds[internal], 2))
+                keep = bounds <= kth_best
+                for bound, child in zip(bounds[keep].tolist(), children[keep].tolist()):
+                    heapq.heappush(queue, (bound, _NODE, child))
+            leaves = nodes[~internal]
+            if len(leaves):
+                sizes = self._stops[leaves] - self._starts[leaves]
+                members = self._perm[np.repeat(self._starts[leaves] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())]
+                bounds = np.maximum(self._candidate_bounds(t, V, sq, members), np.repeat(node_bounds[~internal], sizes))
+                n_bounded += len(members)
+                keep = bounds <= kth_best
+                for bound, idx in zip(bounds[keep].tolist(), members[keep].tolist()):
+                    heapq.heappush(queue, (bound, _PERSON, idx))
+            if not persons:
+                continue
+
+            candidates = np.array(persons, dtype=np.int64)
+            times, nutrients, sq_norms, lengths = self.cohort.padded(candidates)
+            distances = mdtw_distance_batch(t, V, times, nutrients, lengths, self.delta, self.beta, self.alpha, sq, sq_norms,
+                                            max_time_gap=self.max_time_gap, cutoff=kth_best)
+            dp_cells += len(t) * int(lengths.sum())
+            for idx, distance in zip(candidates.tolist(), distances.tolist()):
+                if distance == np.inf:
+                    n_abandoned += 1
+                    continue
+                n_computed += 1
+                if len(heap) < k:
+                    heapq.heappush(heap, (-distance, -idx))
+                elif distance < -heap[0][0]:
+                    heapq.heapreplace(heap, (-distance, -idx))
+            size = min(2 * size, self.batch_size)
+        n_pruned = len(self) - n_abandoned - n_computed
+        n_skipped = len(self) - n_bounded
+        if stats is not None:
+            stats.update({'pairs': len(self), 'pairs_pruned': n_pruned, 'pairs_skipped': n_skipped,
+                          'pairs_abandoned': n_abandoned, 'dp_cells': dp_cells})
+
+        best = sorted((-neg_distance, -neg_idx) for neg_distance, neg_idx in heap)
+        indices = np.array([idx for _, idx in best], dtype=np.int64)
+        return indices, np.array([distance for distance, _ in best]), n_pruned, n_abandoned, n_computed, n_skipped
+
+    def query_batch(self, persons: Union[Dict, List], k: int = 1, stats: JobStats = None) -> List[KNNResult]:
+        """
+        Answer several k-nearest-neighbour queries.
+
+        Args:
+            persons (dict or list): Dictionary of prepared persons, or a list of queries as accepted by ``query``.
+            k (int): Number of neighbours.
+            stats (JobStats, optional): Receives the counts of all queries; exported when they end.
+
+        Returns:
+            list: One KNNResult per query, in input order.
+        """
+        queries = persons.values() if isinstance(persons, dict) else persons
+        if stats is None:
+            return [self.query(person, k) for person in queries]
+        stats.start(len(queries) * len(self))
+        results = [self.query(person, k, stats) for person in queries]
+        stats.finish()
+        return results
+
+    def _neighbour_rows(self, rows: np.ndarray, k: int, stats: JobStats = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest other stored persons of every given stored person.
+
+        Each person is searched for k + 1 neighbours and then dropped from them. When it
+        ties at distance zero with more than k duplicates it may be missing from the
+        result; the last neighbour is dropped instead, which has the same distance.
+        """
+        indices = np.empty((len(rows), k), dtype=np.int64)
+        distances = np.empty((len(rows), k))
+        for position, i in enumerate(rows):
+            found, found_distances = self._search(*self.cohort.person(i), k + 1, stats)[:2]
+            keep = found != i
+            if keep.all():
+                keep[-1] = False
+            indices[position] = found[keep]
+            distances[position] = found_distances[keep]
+        return indices, distances
+
+    def kneighbors(self, k: int = 5, n_jobs: int = 1, block_size: int = 256, stats: JobStats = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k nearest neighbours of every stored person among the others.
+
+        Every person is answered with the best-first search of ``query``: candidates
+        in increasing lower-bound order, a bounded heap of the k best so far, and the
+        current k-th distance as both pruning threshold and early-abandoning cutoff.
+        Memory stays at O(n * k) besides one block of rows per worker.
+
+        Args:
+            k (int): Neighbours per person, excluding the person itself.
+            n_jobs (int): Number of joblib workers, -1 for all cores.
+            block_size (int): Persons per joblib task.
+            stats (JobStats, optional): Receives the search counts; with ``n_jobs=1`` only.
+
+        Returns:
+            tuple: Distances and indices of the neighbours, both of shape (n, k), closest first.
+
+        Raises:
+            ValueError: If k is not between 1 and n - 1.
+        """
+        n = len(self)
+        if not 0 < k < n:
+            raise ValueError("k must be between 1 and the number of persons minus one.")
+        blocks = [np.arange(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+        if stats is not None:
+            stats.start(n * n)
+        if n_jobs == 1:
+            parts = [self._neighbour_rows(rows, k, stats) for rows in blocks]
+        else:
+            parts = Parallel(n_jobs=n_jobs)(delayed(self._neighbour_rows)(rows, k) for rows in blocks)
+        if stats is not None:
+            stats.finish()
+        return np.concatenate([part[1] for part in parts]), np.concatenate([part[0] for part in parts])
+
+    def knn_graph(self, k: int = 5, n_jobs: int = 1, block_size: int = 256, stats: JobStats = None):
+        """
+        Sparse k-nearest-neighbour graph of the stored persons, from ``kneighbors``.
+
+        Args:
+            k (int): Neighbours per person, excluding the person itself.
+            n_jobs (int): Number of joblib workers, -1 for all cores.
+            block_size (int): Persons per joblib task.
+            stats (JobStats, optional): Receives the search counts; with ``n_jobs=1`` only.
+
+        Returns:
+            scipy.sparse.csr_matrix: Matrix of shape (n, n) whose row i holds the distances from
+            person i to its k nearest neighbours, closest first. Zero distances are stored
+            explicitly, so every row has exactly k entries.
+        """
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError as error:
+            raise ImportError("Building a sparse kNN graph requires scipy.") from error
+        distances, indices = self.kneighbors(k, n_jobs, block_size, stats)
+        n = len(self)
+        return csr_matrix((distances.ravel(), indices.ravel(), np.arange(0, n * k + 1, k)), shape=(n, n))
+
+
+def knn_graph(prepared_data: Union[dict, PackedCohort], k: int = 5, delta: float = 23, beta: float = 1, alpha: float = 2,
+              max_time_gap: float = None, n_jobs: int = 1, W=None):
+    """
+    Sparse k-nearest-neighbour graph of a cohort under MDTW, see ``MDTWIndex.knn_graph``.
+
+    The result can go to estimators accepting a precomputed sparse neighbourhood graph,
+    e.g. ``metric='precomputed'`` in scikit-learn's DBSCAN, HDBSCAN or SpectralEmbedding.
+
+    Args:
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        k (int): Neighbours per person, excluding the person itself.
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        n_jobs (int): Number of joblib workers, -1 for all cores.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        scipy.sparse.csr_matrix: Distances to the k nearest neighbours of every person.
+    """
+    return MDTWIndex(prepared_data, delta, beta, alpha, max_time_gap, W=W).knn_graph(k, n_jobs)
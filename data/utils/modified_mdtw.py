@@ -1,11 +1,206 @@
 import numpy as np
 from itertools import zip_longest
-from typing import List, Dict, Tuple
+from functools import partial
+from contextlib import nullcontext
+from typing import List, Dict, Tuple, Union
 
-def mdtw_distance_optimized(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2) -> float:
+from data.utils.cohort import PackedCohort, apply_nutrient_weights, nutrient_weight_factor, validate_nutrients
+from data.utils.cache import DistanceCache, cohort_hashes, pair_keys, parameters_key
+from data.utils.condensed import CondensedDistanceMatrix
+from data.utils.instrument import JobStats
+from data.utils.parallel import parallel_distance_matrix, parallel_condensed_matrix
+
+def events_to_arrays(ER: List[Tuple[float, List[float]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stack a sequence of events into contiguous time and nutrient arrays.
+
+    Args:
+        ER (list): Sequence of events (time, nutrients).
+
+    Returns:
+        tuple: Times of shape (m,) and nutrients of shape (m, d) as float64 arrays.
+    """
+    if len(ER) == 0:
+        return np.zeros(0), np.zeros((0, 0))
+    times = np.array([t for t, _ in ER], dtype=np.float64)
+    nutrient_lengths = {len(v) for _, v in ER}
+    if len(nutrient_lengths) != 1:
+        raise ValueError("Mismatch in feature dimensions.")
+    nutrients = np.array([v for _, v in ER], dtype=np.float64).reshape(len(ER), -1)
+    return times, nutrients
+
+
+def local_cost_matrix(t1: np.ndarray, V1: np.ndarray, t2: np.ndarray, V2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2, sq1: np.ndarray = None, sq2: np.ndarray = None) -> np.ndarray:
+    """
+    Calculate the local distance between every pair of events of two sequences at once.
+
+    Entry (i, j) equals ``local_distance((t1[i], V1[i]), (t2[j], V2[j]), delta, beta, alpha)``.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence, shape (m1,).
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        t2 (np.ndarray): Event times of the second sequence, shape (m2,).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        sq1 (np.ndarray, optional): Precomputed squared norms of V1.
+        sq2 (np.ndarray, optional): Precomputed squared norms of V2.
+
+    Returns:
+        np.ndarray: Local cost matrix of shape (m1, m2).
+    """
+    if sq1 is None:
+        sq1 = np.einsum('ij,ij->i', V1, V1)
+    if sq2 is None:
+        sq2 = np.einsum('ij,ij->i', V2, V2)
+    cross = V1 @ V2.T
+    # ||vi - vj||^2 expanded; clip the rounding noise so costs stay non-negative
+    value_diff = np.maximum(sq1[:, None] + sq2[None, :] - 2 * cross, 0)
+    time_diff = (np.abs(t1[:, None] - t2[None, :]) / delta) ** alpha
+    return value_diff + 2 * beta * cross * time_diff
+
+
+# Upper bound on the number of local costs held in memory at once by the kernels
+LOCAL_COST_BLOCK_SIZE = 16384
+
+
+def exact_time_gap(delta: float = 23, beta: float = 1, alpha: float = 2) -> float:
+    """
+    Smallest ``max_time_gap`` for which the banded MDTW distance is exact.
+
+    Matching events i and j costs ``||vi - vj||^2 + 2 * beta * vi.vj * (|ti - tj| / delta) ** alpha``,
+    while matching both with empty costs ``||vi||^2 + ||vj||^2 = ||vi - vj||^2 + 2 * vi.vj``.
+    Once ``beta * (gap / delta) ** alpha >= 1`` a match is never cheaper than the two
+    empty matches that can replace it on the path, so excluding it does not change
+    the optimum. Smaller gaps give an upper bound on the exact distance.
+
+    Args:
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+
+    Returns:
+        float: Time gap in the unit of the event times.
+    """
+    if beta <= 0 or alpha <= 0:
+        return np.inf
+    return delta * beta ** (-1 / alpha)
+
+
+def _mdtw_dp(t1: np.ndarray, V1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, V2: np.ndarray, sq2: np.ndarray, delta: float, beta: float, alpha: float,
+             max_time_gap: float = None, cutoff: float = None) -> float:
+    """
+    Run the MDTW recurrence over two non-empty stacked sequences.
+
+    Local costs are computed a block of rows at a time with ``local_cost_matrix``,
+    restricted to the columns inside the time band when ``max_time_gap`` is set.
+    Each row is then solved with NumPy operations only: the diagonal and vertical
+    moves are element-wise, and the horizontal chain ``curr[j] = min(a[j], curr[j-1] + sq2[j])``
+    becomes a running minimum after shifting by the cumulative empty costs.
+
+    Every warping path crosses every row and all costs are non-negative, so the
+    sweep stops as soon as a whole row exceeds ``cutoff``.
+
+    Returns:
+        float: Modified DTW distance, or ``np.inf`` when it exceeds cutoff.
+    """
+    # The recurrence is symmetric, so sweep over the shorter sequence
+    if len(t1) > len(t2):
+        t1, V1, sq1, t2, V2, sq2 = t2, V2, sq2, t1, V1, sq1
+    m1, m2 = len(t1), len(t2)
+    block_rows = max(1, LOCAL_COST_BLOCK_SIZE // m2)
+
+    if max_time_gap is None:
+        band_start = np.zeros(m1, dtype=np.int64)
+        band_stop = np.full(m1, m2, dtype=np.int64)
+    elif np.all(t2[1:] >= t2[:-1]):
+        band_start = np.searchsorted(t2, t1 - max_time_gap, side='left')
+        band_stop = np.searchsorted(t2, t1 + max_time_gap, side='right')
+    else:
+        # Unsorted times: compute every column and mask
+        band_start = np.zeros(m1, dtype=np.int64)
+        band_stop = np.full(m1, m2, dtype=np.int64)
+
+    offsets = np.zeros(m2 + 1)
+    np.cumsum(sq2, out=offsets[1:])
+    prev_row = offsets.copy()
+    curr_row = np.empty(m2 + 1)
+
+    for start in range(0, m1, block_rows):
+        stop = min(start + block_rows, m1)
+        c0, c1 = band_start[start:stop].min(), band_stop[start:stop].max()
+        if c1 > c0:
+            local_costs = local_cost_matrix(t1[start:stop], V1[start:stop], t2[c0:c1], V2[c0:c1], delta, beta, alpha, sq1[start:stop], sq2[c0:c1])
+            if max_time_gap is not None:
+                local_costs[np.abs(t1[start:stop, None] - t2[None, c0:c1]) > max_time_gap] = np.inf
+        for i in range(start, stop):
+            curr_row[0] = prev_row[0] + sq1[i]
+            np.add(prev_row[1:], sq1[i], out=curr_row[1:])
+            if c1 > c0:
+                np.minimum(curr_row[c0 + 1:c1 + 1], prev_row[c0:c1] + local_costs[i - start], out=curr_row[c0 + 1:c1 + 1])
+            curr_row -= offsets
+            np.minimum.accumulate(curr_row, out=curr_row)
+            curr_row += offsets
+            prev_row, curr_row = curr_row, prev_row
+            if cutoff is not None and prev_row.min() > cutoff:
+                return np.inf
+
+    return float(prev_row[m2])
+
+
+def mdtw_distance_vectorized(t1: np.ndarray, V1: np.ndarray, t2: np.ndarray, V2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2, sq1: np.ndarray = None, sq2: np.ndarray = None,
+                             max_time_gap: float = None, cutoff: float = None) -> float:
+    """
+    Calculate the modified DTW distance between two sequences given as stacked arrays.
+
+    No validation is performed; nutrients are expected to be normalized already.
+    With ``max_time_gap`` set, events further apart in time than the gap are never
+    matched with each other (they can still be matched with empty) and their local
+    costs are not computed. The result is exact when ``max_time_gap >= exact_time_gap(delta, beta, alpha)``
+    and an upper bound on the exact distance otherwise.
+
+    With ``cutoff`` set, the DP is abandoned once the distance is known to exceed it;
+    search loops can pass their best distance so far.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence, shape (m1,).
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        t2 (np.ndarray): Event times of the second sequence, shape (m2,).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        sq1 (np.ndarray, optional): Precomputed squared norms of V1.
+        sq2 (np.ndarray, optional): Precomputed squared norms of V2.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        cutoff (float, optional): Distances above this value are not needed.
+
+    Returns:
+        float: Modified DTW distance, or ``np.inf`` when it exceeds cutoff.
+    """
+    if sq1 is None:
+        sq1 = np.einsum('ij,ij->i', V1, V1)
+    if sq2 is None:
+        sq2 = np.einsum('ij,ij->i', V2, V2)
+    if len(t1) == 0 or len(t2) == 0:
+        distance = float(np.sum(sq1) + np.sum(sq2))
+    else:
+        distance = _mdtw_dp(t1, V1, sq1, t2, V2, sq2, delta, beta, alpha, max_time_gap, cutoff)
+
+    if cutoff is not None and distance > cutoff:
+        return np.inf
+    return distance
+
+
+def mdtw_distance_optimized(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2,
+                            max_time_gap: float = None, cutoff: float = None, validate: bool = True, W=None) -> float:
     """
     Calculate the modified DTW distance between two sequences of events
-    with optimized memory usage.
+    with a vectorized kernel.
+
+    The events are stacked and validated once, local costs are computed in
+    vectorized blocks of rows and the DP keeps only two rows of the cost matrix.
     
     Args:
         ER1 (list): First sequence of events (time, nutrients).
@@ -13,55 +208,240 @@ def mdtw_distance_optimized(ER1: List[Tuple[float, List[float]]], ER2: List[Tupl
         delta (float): Time scaling factor.
         beta (float): Weighting factor for time difference.
         alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events,
+            see ``mdtw_distance_vectorized``.
+        cutoff (float, optional): Stop early and return ``np.inf`` once the distance exceeds this value.
+        validate (bool): Check the nutrient values; pass False for sequences that come from
+            ``prepare_person``, which already validated them.
+        W (array-like, optional): Nutrient weight matrix, identity by default. Local costs become
+            (vi - vj)^T W (vi - vj) + 2 beta vi^T W vj (|ti - tj| / delta)^alpha and empty matches v^T W v.
          
     Returns:
         float: Modified DTW distance.
     """
-    m1 = len(ER1)
-    m2 = len(ER2)
-    
-    # Only store two rows of the cost matrix at a time
-    prev_row = np.zeros(m2 + 1, dtype=np.float32)
-    curr_row = np.zeros(m2 + 1, dtype=np.float32)
-    
-    # Initialize first row (matching ER2 elements with empty)
-    for j in range(1, m2 + 1):
-        tj, vj = ER2[j-1]
-        empty_cost = np.dot(vj, vj)  # Compute once and reuse
-        prev_row[j] = prev_row[j-1] + empty_cost
-    
-    # Process rows one at a time
-    for i in range(1, m1 + 1):
-        ti, vi = ER1[i-1]
-        vi_dot = np.dot(vi, vi)  # Pre-compute for reuse
-        
-        # First column (matching ER1 elements with empty)
-        curr_row[0] = prev_row[0] + vi_dot
-        
-        # Fill current row
-        for j in range(1, m2 + 1):
-            tj, vj = ER2[j-1]
-            
-            # Calculate local distance only when needed
-            local_dist = local_distance(
-                (ti, vi), (tj, vj), delta, beta, alpha
-            )
-            
-            # Calculate DTW options
-            match_both = prev_row[j-1] + local_dist
-            match_i_to_empty = prev_row[j] + vi_dot
-            match_j_to_empty = curr_row[j-1] + np.dot(vj, vj)
-            
-            # Choose minimum path
-            curr_row[j] = min(match_both, match_i_to_empty, match_j_to_empty)
-        
-        # Swap rows for next iteration
-        prev_row, curr_row = curr_row, prev_row
-    
-    # Final result is in prev_row due to the last swap
-    return prev_row[m2]
+    t1, V1 = events_to_arrays(ER1)
+    t2, V2 = events_to_arrays(ER2)
+    if validate:
+        validate_nutrients(V1, V2)
+    if W is not None:
+        V1, V2 = apply_nutrient_weights(V1, W), apply_nutrient_weights(V2, W)
+    return mdtw_distance_vectorized(t1, V1, t2, V2, delta, beta, alpha, max_time_gap=max_time_gap, cutoff=cutoff)
+
+def mdtw_distance_batch(t: np.ndarray, V: np.ndarray, times: np.ndarray, nutrients: np.ndarray, lengths: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2,
+                        sq: np.ndarray = None, sq_norms: np.ndarray = None, max_time_gap: float = None, cutoff: float = None) -> np.ndarray:
+    """
+    Calculate the modified DTW distance between one sequence and a batch of padded sequences.
+
+    The DP advances one query event at a time for all B candidates together. Padded
+    events sit after each candidate's last event, so they never reach the cell that
+    holds its result. With ``cutoff`` set, candidates whose whole row exceeds it are
+    dropped from the batch and get ``np.inf``.
+
+    Args:
+        t (np.ndarray): Event times of the query, shape (m,).
+        V (np.ndarray): Nutrients of the query, shape (m, d).
+        times (np.ndarray): Padded event times of the candidates, shape (B, L).
+        nutrients (np.ndarray): Padded nutrients of the candidates, shape (B, L, d).
+        lengths (np.ndarray): Number of real events of every candidate, shape (B,).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        sq (np.ndarray, optional): Precomputed squared norms of V.
+        sq_norms (np.ndarray, optional): Precomputed squared norms of the candidates, shape (B, L).
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        cutoff (float, optional): Distances above this value are returned as ``np.inf``.
+
+    Returns:
+        np.ndarray: Distances to every candidate, shape (B,).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    batch, width = times.shape
+    if sq is None:
+        sq = np.einsum('ij,ij->i', V, V)
+    if sq_norms is None:
+        sq_norms = np.einsum('bld,bld->bl', nutrients, nutrients)
+    # Zero out padding so it adds nothing to the cumulative empty costs
+    columns = np.arange(width + 1)
+    valid = columns[None, :] <= lengths[:, None]
+    sq_norms = np.where(valid[:, 1:], sq_norms, 0)
+
+    distances = np.full(batch, np.inf)
+    active = np.arange(batch)
+    offsets = np.zeros((batch, width + 1))
+    np.cumsum(sq_norms, axis=1, out=offsets[:, 1:])
+    prev_rows = offsets.copy()
+    curr_rows = np.empty_like(prev_rows)
+
+    for i in range(len(t)):
+        cross = nutrients @ V[i]
+        gap = np.abs(t[i] - times)
+        local_costs = np.maximum(sq[i] + sq_norms - 2 * cross, 0) + 2 * beta * cross * (gap / delta) ** alpha
+        if max_time_gap is not None:
+            local_costs[gap > max_time_gap] = np.inf
+
+        curr_rows[:, 0] = prev_rows[:, 0] + sq[i]
+        np.minimum(prev_rows[:, :-1] + local_costs, prev_rows[:, 1:] + sq[i], out=curr_rows[:, 1:])
+        curr_rows -= offsets
+        np.minimum.accumulate(curr_rows, axis=1, out=curr_rows)
+        curr_rows += offsets
+        prev_rows, curr_rows = curr_rows, prev_rows
+
+        if cutoff is not None:
+            alive = np.min(np.where(valid, prev_rows, np.inf), axis=1) <= cutoff
+            if not alive.all():
+                active, valid, times, nutrients, sq_norms, lengths, offsets, prev_rows = (
+                    active[alive], valid[alive], times[alive], nutrients[alive], sq_norms[alive],
+                    lengths[alive], offsets[alive], prev_rows[alive])
+                curr_rows = np.empty_like(prev_rows)
+                if len(active) == 0:
+                    break
+
+    distances[active] = prev_rows[np.arange(len(active)), lengths]
+    if cutoff is not None:
+        distances[distances > cutoff] = np.inf
+    return distances
+
+
+def mdtw_distance_one_to_many(cohort: PackedCohort, i: int, indices, delta: float = 23, beta: float = 1, alpha: float = 2,
+                              max_time_gap: float = None, cutoff: float = None) -> np.ndarray:
+    """
+    Calculate the modified DTW distance from one person of a packed cohort to many others.
+
+    Args:
+        cohort (PackedCohort): Packed cohort, passed through ``PackedCohort.weighted`` for a nutrient weight matrix.
+        i (int): Index of the query person.
+        indices (array-like): Indices of the other persons.
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        cutoff (float, optional): Distances above this value are returned as ``np.inf``.
 
-def mdtw_distance(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2) -> float:
+    Returns:
+        np.ndarray: Distances, in the order of indices.
+    """
+    t, V, sq = cohort.person(i)
+    times, nutrients, sq_norms, lengths = cohort.padded(indices)
+    return mdtw_distance_batch(t, V, times, nutrients, lengths, delta, beta, alpha, sq, sq_norms, max_time_gap, cutoff)
+
+
+def lb_mass(V1: np.ndarray, V2: np.ndarray) -> float:
+    """
+    Lower bound on the MDTW distance from the total nutrient mass of each sequence.
+
+    The sum of the differences over matched pairs and the unmatched vectors equals
+    ``sum(V1) - sum(V2)``, and there are at most m1 + m2 such terms, so by
+    Cauchy-Schwarz the distance is at least ``||sum(V1) - sum(V2)||^2 / (m1 + m2)``.
+    It is zero for sequences normalized to the same totals.
+
+    Args:
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+
+    Returns:
+        float: Lower bound.
+    """
+    m1, m2 = len(V1), len(V2)
+    if m1 == 0 or m2 == 0:
+        return float(np.sum(V1 * V1) + np.sum(V2 * V2))
+    diff = V1.sum(axis=0) - V2.sum(axis=0)
+    return float(diff @ diff) / (m1 + m2)
+
+
+def lb_norms(sq1: np.ndarray, sq2: np.ndarray) -> float:
+    """
+    Lower bound on the MDTW distance from the per-event squared norms.
+
+    A match costs at least ``(||vi|| - ||vj||)^2`` when the time term is dropped,
+    and each event is matched at most once. Pairing the norms in sorted order
+    maximizes the saved cross terms, giving ``||sort(a) - sort(b)||^2`` with the
+    shorter norm list padded with zeros.
+
+    Args:
+        sq1 (np.ndarray): Squared norms of the first sequence's nutrient vectors.
+        sq2 (np.ndarray): Squared norms of the second sequence's nutrient vectors.
+
+    Returns:
+        float: Lower bound.
+    """
+    size = max(len(sq1), len(sq2))
+    a = np.zeros(size)
+    b = np.zeros(size)
+    a[:len(sq1)] = np.sort(np.sqrt(sq1))[::-1]
+    b[:len(sq2)] = np.sort(np.sqrt(sq2))[::-1]
+    return float(np.sum((a - b) ** 2))
+
+
+def lb_time(t1: np.ndarray, sq1: np.ndarray, t2: np.ndarray, sq2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2) -> float:
+    """
+    Lower bound on the MDTW distance from event times and per-event norms.
+
+    Matching i and j saves ``2 * vi.vj * (1 - beta * tau_ij)`` over matching both
+    with empty, at most ``g_ij = 2 * ||vi|| * ||vj|| * max(0, 1 - beta * tau_ij)``.
+    Each event is matched at most once, so the total saving is bounded by the
+    row maxima of g summed, and by the column maxima summed.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence.
+        sq1 (np.ndarray): Squared norms of the first sequence's nutrient vectors.
+        t2 (np.ndarray): Event times of the second sequence.
+        sq2 (np.ndarray): Squared norms of the second sequence's nutrient vectors.
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+
+    Returns:
+        float: Lower bound.
+    """
+    total = float(np.sum(sq1) + np.sum(sq2))
+    if len(t1) == 0 or len(t2) == 0:
+        return total
+    a, b = np.sqrt(sq1), np.sqrt(sq2)
+    weight = np.maximum(0, 1 - beta * (np.abs(t1[:, None] - t2[None, :]) / delta) ** alpha)
+    saving_rows = 2 * np.sum(a * np.max(weight * b[None, :], axis=1))
+    saving_cols = 2 * np.sum(b * np.max(weight * a[:, None], axis=0))
+    return max(total - min(saving_rows, saving_cols), 0.0)
+
+
+def mdtw_lower_bound(t1: np.ndarray, V1: np.ndarray, t2: np.ndarray, V2: np.ndarray, delta: float = 23, beta: float = 1, alpha: float = 2,
+                     sq1: np.ndarray = None, sq2: np.ndarray = None, cutoff: float = None) -> float:
+    """
+    Run the lower bounds from cheapest to most expensive and keep the largest.
+
+    All bounds assume non-negative dot products between nutrient vectors, which
+    ``prepare_person`` guarantees and ``PackedCohort.weighted`` preserves, and
+    hold with or without ``max_time_gap``. When ``cutoff`` is given the cascade
+    stops at the first bound above it, since the pair can then be skipped.
+
+    Args:
+        t1 (np.ndarray): Event times of the first sequence, shape (m1,).
+        V1 (np.ndarray): Nutrients of the first sequence, shape (m1, d).
+        t2 (np.ndarray): Event times of the second sequence, shape (m2,).
+        V2 (np.ndarray): Nutrients of the second sequence, shape (m2, d).
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        sq1 (np.ndarray, optional): Precomputed squared norms of V1.
+        sq2 (np.ndarray, optional): Precomputed squared norms of V2.
+        cutoff (float, optional): Stop as soon as a bound exceeds this value.
+
+    Returns:
+        float: Lower bound on ``mdtw_distance_vectorized`` for the same arguments.
+    """
+    if sq1 is None:
+        sq1 = np.einsum('ij,ij->i', V1, V1)
+    if sq2 is None:
+        sq2 = np.einsum('ij,ij->i', V2, V2)
+    bound = 0.0
+    for lower_bound in (lambda: lb_mass(V1, V2), lambda: lb_norms(sq1, sq2), lambda: lb_time(t1, sq1, t2, sq2, delta, beta, alpha)):
+        bound = max(bound, lower_bound())
+        if cutoff is not None and bound > cutoff:
+            break
+    return bound
+
+
+def mdtw_distance(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, List[float]]], delta: float = 23, beta: float = 1, alpha: float = 2,
+                  max_time_gap: float = None, validate: bool = True, W=None) -> float:
     """
     Calculate the modified DTW distance between two sequences of events.
     Args:
@@ -70,13 +450,24 @@ def mdtw_distance(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, L
         delta (float): Time scaling factor.
         beta (float): Weighting factor for time difference.
         alpha (float): Exponent for time difference scaling.
-    
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        validate (bool): Check the nutrient values once, with the errors of ``local_distance``;
+            pass False for sequences that come from ``prepare_person``.
+        W (array-like, optional): Nutrient weight matrix, identity by default, see ``local_distance``.
+
     Returns:
         float: Modified DTW distance.
     """
     m1 = len(ER1)
     m2 = len(ER2)
-   
+    t1, V1 = events_to_arrays(ER1)
+    t2, V2 = events_to_arrays(ER2)
+    # Nutrients are only compared when both sequences have events
+    if validate and m1 and m2:
+        validate_nutrients(V1, V2)
+    # Weighted dot products become plain ones on the transformed vectors
+    V1, V2 = apply_nutrient_weights(V1, W), apply_nutrient_weights(V2, W)
+
     # Local distance matrix including matching with empty
     deo = np.zeros((m1 + 1, m2 + 1))
 
@@ -85,13 +476,15 @@ def mdtw_distance(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, L
             if i == 0 and j == 0:
                 deo[i, j] = 0
             elif i == 0:
-                tj, vj = ER2[j-1]
-                deo[i, j] = np.dot(vj, vj)  
+                vj = V2[j-1]
+                deo[i, j] = np.dot(vj, vj)
             elif j == 0:
-                ti, vi = ER1[i-1]
+                vi = V1[i-1]
                 deo[i, j] = np.dot(vi, vi)
+            elif max_time_gap is not None and abs(t1[i-1] - t2[j-1]) > max_time_gap:
+                deo[i, j] = np.inf  # Outside the time band, only empty matches
             else:
-                deo[i, j]=local_distance(ER1[i-1], ER2[j-1], delta, beta, alpha)
+                deo[i, j] = _local_distance(t1[i-1], V1[i-1], t2[j-1], V2[j-1], delta, beta, alpha)
         
 
     # # Global cost matrix
@@ -115,7 +508,7 @@ def mdtw_distance(ER1: List[Tuple[float, List[float]]], ER2: List[Tuple[float, L
     return dER[m1, m2]  # Return the final cost
 
 
-def local_distance(eo_i: Tuple[float, List[float]], eo_j: Tuple[float, List[float]], delta: float = 23, beta: float = 1, alpha: float = 2):
+def local_distance(eo_i: Tuple[float, List[float]], eo_j: Tuple[float, List[float]], delta: float = 23, beta: float = 1, alpha: float = 2, W=None):
     """
     Calculate the local distance between two events.
     Args:
@@ -124,14 +517,17 @@ def local_distance(eo_i: Tuple[float, List[float]], eo_j: Tuple[float, List[floa
         delta (float): Time scaling factor.
         beta (float): Weighting factor for time difference.
         alpha (float): Exponent for time difference scaling.
+        W (array-like, optional): Symmetric positive semi-definite nutrient weight matrix with
+            non-negative entries, or its diagonal; identity by default. The distance is then
+            (vi - vj)^T W (vi - vj) + 2 beta vi^T W vj (|ti - tj| / delta)^alpha.
     Returns:
         float: Local distance.
     """
-    
-   
+
+
     ti, vi = eo_i
     tj, vj = eo_j
-   
+
     vi = np.array(vi)
     vj = np.array(vj)
 
@@ -140,14 +536,23 @@ def local_distance(eo_i: Tuple[float, List[float]], eo_j: Tuple[float, List[floa
     if np.any(vi < 0) or np.any(vj < 0):
         raise ValueError("Nutrient values must be non-negative.")
     if np.any(vi>1 ) or np.any(vj>1):
-        raise ValueError("Nutrient values must be in the range [0, 1].")   
-    W = np.eye(len(vi))  # Assume W = identity for now
-    value_diff = (vi - vj).T @ W @ (vi - vj)
+        raise ValueError("Nutrient values must be in the range [0, 1].")
+    if W is not None:
+        factor = nutrient_weight_factor(W)
+        vi, vj = vi @ factor, vj @ factor
+    return _local_distance(ti, vi, tj, vj, delta, beta, alpha)
+
+
+def _local_distance(ti: float, vi: np.ndarray, tj: float, vj: np.ndarray, delta: float, beta: float, alpha: float) -> float:
+    """
+    Local distance between two validated events given as arrays, with W = identity
+    or nutrients already transformed by ``nutrient_weight_factor``.
+    """
+    diff = vi - vj
+    value_diff = diff @ diff
     time_diff = (np.abs(ti - tj) / delta) ** alpha
-    scale = 2 * beta * (vi.T @ W @ vj)
-    distance = value_diff + scale * time_diff
-  
-    return distance
+    scale = 2 * beta * (vi @ vj)
+    return value_diff + scale * time_diff
 
 
 
@@ -200,7 +605,12 @@ def prepare_person(person: dict):
 
     sorted_records = sorted(person["records"], key=lambda x: x['time'])
 
-    nutrients = np.stack([np.array(record['nutrients']) for record in sorted_records])
+    nutrients = np.stack([np.array(record['nutrients'], dtype=np.float64) for record in sorted_records])
+    # Validated once here, so the distance kernels can trust prepared data
+    if np.any(nutrients < 0):
+        raise ValueError(f"Negative nutrient values for person {person['person_id']}.")
+    if not np.all(np.isfinite(nutrients)):
+        raise ValueError(f"Non-finite nutrient values for person {person['person_id']}.")
     total_nutrients = np.sum(nutrients, axis=0)
 
     # Check to avoid division by zero
@@ -219,31 +629,155 @@ def prepare_person(person: dict):
 
 
 
-def calculate_distance_matrix(prepared_data: dict, callback: callable = None)-> np.ndarray:
+def mdtw_distance_packed(cohort: PackedCohort, i: int, j: int, delta: float = 23, beta: float = 1, alpha: float = 2,
+                         max_time_gap: float = None, cutoff: float = None) -> float:
+    """
+    Calculate the modified DTW distance between two persons of a packed cohort.
+
+    Args:
+        cohort (PackedCohort): Packed cohort, passed through ``PackedCohort.weighted`` for a nutrient weight matrix.
+        i (int): Index of the first person.
+        j (int): Index of the second person.
+        delta (float): Time scaling factor.
+        beta (float): Weighting factor for time difference.
+        alpha (float): Exponent for time difference scaling.
+        max_time_gap (float, optional): Largest time difference allowed between matched events,
+            see ``mdtw_distance_vectorized``.
+        cutoff (float, optional): Stop early and return ``np.inf`` once the distance exceeds this value.
+
+    Returns:
+        float: Modified DTW distance.
+    """
+    t1, V1, sq1 = cohort.person(i)
+    t2, V2, sq2 = cohort.person(j)
+    return mdtw_distance_vectorized(t1, V1, t2, V2, delta, beta, alpha, sq1, sq2, max_time_gap, cutoff)
+
+
+def _callback_row_distances(callback: callable, sequences: list, i: int, j0: int, j1: int, counts: dict = None) -> list:
+    return [callback(sequences[i], sequences[j]) for j in range(j0, j1)]
+
+
+def _dp_cells(cohort: PackedCohort, i: int, indices) -> int:
+    lengths = cohort.lengths
+    return int(lengths[i] * lengths[indices].sum())
+
+
+def _packed_row_distances(cohort: PackedCohort, i: int, j0: int, j1: int, counts: dict = None, **params) -> np.ndarray:
+    if counts is not None:
+        counts['dp_cells'] = counts.get('dp_cells', 0) + _dp_cells(cohort, i, slice(j0, j1))
+    return mdtw_distance_one_to_many(cohort, i, np.arange(j0, j1), **params)
+
+
+class _CachedRowDistances:
+    """
+    Row segments of distances, computing only the pairs missing from the cache.
+    The cache buffers what it learns and is flushed after every chunk of tiles.
+    """
+
+    def __init__(self, cache: DistanceCache, cohort: PackedCohort, **params):
+        self.cache = cache
+        self.cohort = cohort
+        self.params = params
+        self.hashes = cohort_hashes(cohort)
+        self.parameters = parameters_key(**params)
+        if 3 * len(cohort) * (len(cohort) - 1) // 2 >= len(cache):
+            cache.preload()
+
+    def __call__(self, i: int, j0: int, j1: int, counts: dict = None) -> np.ndarray:
+        keys = pair_keys(self.hashes[i], self.hashes[j0:j1], self.parameters)
+        values = self.cache.get_many(keys)
+        missing = np.flatnonzero(np.isnan(values))
+        if len(missing):
+            values[missing] = mdtw_distance_one_to_many(self.cohort, i, j0 + missing, **self.params)
+            self.cache.put_many(keys[missing], values[missing])
+        if counts is not None:
+            counts['cache_hits'] = counts.get('cache_hits', 0) + len(keys) - len(missing)
+            counts['cache_misses'] = counts.get('cache_misses', 0) + len(missing)
+            counts['dp_cells'] = counts.get('dp_cells', 0) + _dp_cells(self.cohort, i, j0 + missing)
+        return values
+
+    def flush(self) -> None:
+        self.cache.flush()
+
+
+def calculate_distance_matrix(prepared_data: Union[dict, PackedCohort], callback: callable = None, delta: float = 23, beta: float = 1, alpha: float = 2,
+                              max_time_gap: float = None,
+                              n_jobs: int = 1, tile_size: int = 128, backend: str = 'loky',
+                              condensed: bool = False, dtype=np.float64, path: str = None,
+                              cache: DistanceCache = None, stats: JobStats = None, W=None)-> Union[np.ndarray, CondensedDistanceMatrix]:
     """
     Calculate the distance matrix for the prepared data.
+
+    The upper triangle is split into square tiles. With ``n_jobs != 1`` the tiles
+    run on a joblib pool whose workers write into a shared memory-mapped buffer.
+    With ``condensed=True`` only the n(n-1)/2 upper-triangle entries are stored,
+    optionally streamed into a memory-mapped file.
     
     Args:
-        prepared_data (dict): Dictionary containing prepared data for each person.
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        callback (callable, optional): Distance between two sequences of events (time, nutrients).
+            When omitted, every row segment of a tile goes through ``mdtw_distance_batch``
+            with delta, beta and alpha.
+        delta (float): Time scaling factor, used when no callback is given.
+        beta (float): Weighting factor for time difference, used when no callback is given.
+        alpha (float): Exponent for time difference scaling, used when no callback is given.
+        max_time_gap (float, optional): Largest time difference allowed between matched events,
+            used when no callback is given; exact when at least ``exact_time_gap(delta, beta, alpha)``.
+        n_jobs (int): Number of workers, -1 for all cores.
+        tile_size (int): Number of rows and columns per tile.
+        backend (str): joblib backend, 'loky' for processes or 'threading'.
+        condensed (bool): Return a CondensedDistanceMatrix instead of a square array.
+        dtype: np.float32 or np.float64.
+        path (str, optional): File backing the condensed matrix as an ``np.memmap``.
+        cache (DistanceCache, optional): Persistent pair cache keyed on sequence content and
+            parameters; only pairs it does not hold are computed. Preloaded, see ``DistanceCache.preload``,
+            when the build looks up at least a third as many pairs as it holds. Requires no callback.
+        stats (JobStats, optional): Receives progress, pair, DP cell and cache counters, and
+            'prepare', 'kernel' and 'write' phase timings; exported when the job ends.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``. Applied once to
+            the packed nutrients, so the kernels run unchanged; requires no callback.
         
     Returns:
-        np.ndarray: Distance matrix.
+        np.ndarray or CondensedDistanceMatrix: Distance matrix.
     """
     n = len(prepared_data)
-    distance_matrix = np.zeros((n, n))
-    
-    # Step 3: Compute pairwise distances
-    for i, (id1, records1) in enumerate(prepared_data.items()):
-        for j, (id2, records2) in enumerate(prepared_data.items()):
-            if i < j:  # Only upper triangle
-            
-                ER1 = list(records1.items())
-                ER2 = list(records2.items())
-                
-                distance_matrix[i, j] = callback(ER1, ER2)
-                distance_matrix[j, i] = distance_matrix[i, j]  # Symmetric matrix
-                
-    return distance_matrix
+
+    if cache is not None and callback is not None:
+        raise ValueError("The distance cache cannot key the parameters of a callback.")
+    if W is not None and callback is not None:
+        raise ValueError("Nutrient weights apply to the built-in kernel; pass W to the callback instead.")
+
+    with nullcontext() if stats is None else stats.phase('prepare'):
+        if callback is None:
+            cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+            # Cache keys hash the weighted nutrients, so different W never collide
+            cohort = cohort.weighted(W)
+            params = dict(delta=delta, beta=beta, alpha=alpha, max_time_gap=max_time_gap)
+            if cache is None:
+                row_distances = partial(_packed_row_distances, cohort, **params)
+            else:
+                row_distances = _CachedRowDistances(cache, cohort, **params)
+        else:
+            # Convert every person once instead of once per pair
+            if isinstance(prepared_data, PackedCohort):
+                sequences = [prepared_data.events(i) for i in range(n)]
+            else:
+                sequences = [list(records.items()) for records in prepared_data.values()]
+            row_distances = partial(_callback_row_distances, callback, sequences)
+
+    if condensed:
+        matrix = parallel_condensed_matrix(row_distances, n, n_jobs, tile_size, backend, dtype, path, stats)
+    elif path is not None:
+        raise ValueError("Memory-mapped output requires condensed=True.")
+    else:
+        matrix = parallel_distance_matrix(row_distances, n, n_jobs, tile_size, backend, dtype, stats)
+    if cache is not None:
+        cache.flush()
+        cache.release()
+    if stats is not None:
+        stats.finish()
+    return matrix
 
 # Find the time and fraction of their largest eating occasion
 def get_largest_event(record: dict) -> Tuple[float, float]:
@@ -0,0 +1,229 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from contextlib import nullcontext
+from joblib import Parallel, delayed, effective_n_jobs
+from typing import List, Dict, Tuple
+
+from data.utils.condensed import CondensedDistanceMatrix, condensed_index, n_from_condensed_size
+from data.utils.instrument import JobStats
+
+
+def upper_triangle_tiles(n: int, tile_size: int = 128) -> List[Tuple[int, int, int, int]]:
+    """
+    Split the strict upper triangle of an n x n matrix into square tiles.
+
+    Off-diagonal tiles hold tile_size**2 pairs and diagonal tiles about half of
+    that. Tiles are returned largest first so dynamic scheduling stays balanced.
+
+    Args:
+        n (int): Number of persons.
+        tile_size (int): Number of rows and columns per tile.
+
+    Returns:
+        list: Tiles as (row_start, row_stop, col_start, col_stop).
+    """
+    if tile_size < 1:
+        raise ValueError("Tile size must be positive.")
+    starts = range(0, n, tile_size)
+    tiles = [
+        (r, min(r + tile_size, n), c, min(c + tile_size, n))
+        for r in starts for c in starts if r <= c and not (r == c and min(r + tile_size, n) - r < 2)
+    ]
+    return sorted(tiles, key=lambda tile: -tile_pair_count(tile))
+
+
+def tile_pair_count(tile: Tuple[int, int, int, int]) -> int:
+    """
+    Count the upper-triangle pairs (i < j) covered by a tile.
+
+    Args:
+        tile (tuple): Tile as (row_start, row_stop, col_start, col_stop).
+
+    Returns:
+        int: Number of pairs.
+    """
+    r0, r1, c0, c1 = tile
+    if r0 == c0:
+        size = r1 - r0
+        return size * (size - 1) // 2
+    return (r1 - r0) * (c1 - c0)
+
+
+def _phase(stats: JobStats, name: str):
+    return nullcontext() if stats is None else stats.phase(name)
+
+
+def _fill_tiles(row_distances: callable, output: np.ndarray, tiles: List[Tuple[int, int, int, int]],
+                stats: JobStats = None, count: bool = False) -> Dict[str, int]:
+    """
+    Compute the pairs of the given tiles and write them into output.
+
+    A square output receives the strict upper triangle; a 1-D output is filled
+    in the condensed layout, where each row segment of a tile is contiguous.
+    With ``stats`` every row segment is counted into it as it completes; with
+    ``count`` the counts are summed and returned instead, for worker processes.
+    """
+    n = output.shape[0] if output.ndim == 2 else n_from_condensed_size(len(output))
+    totals = {}
+    for r0, r1, c0, c1 in tiles:
+        for i in range(r0, r1):
+            j0 = max(c0, i + 1)
+            if j0 >= c1:
+                continue
+            if stats is None and not count:
+                values = row_distances(i, j0, c1)
+            else:
+                counts = {'pairs': c1 - j0}
+                values = row_distances(i, j0, c1, counts=counts)
+            if output.ndim == 2:
+                output[i, j0:c1] = values
+            else:
+                start = condensed_index(n, i, j0)
+                output[start:start + c1 - j0] = values
+            if stats is not None:
+                stats.update(counts)
+            elif count:
+                for name, value in counts.items():
+                    totals[name] = totals.get(name, 0) + value
+    # Worker processes drop their copy of row_distances, and whatever it buffered, after this
+    if hasattr(row_distances, 'flush'):
+        row_distances.flush()
+    return totals
+
+
+def fill_upper_triangle(row_distances: callable, output: np.ndarray, n_jobs: int = 1, tile_size: int = 128, backend: str = 'loky',
+                        stats: JobStats = None) -> np.ndarray:
+    """
+    Fill the strict upper triangle of a square or condensed output buffer, tile by tile.
+
+    With ``n_jobs != 1`` the tiles run on a joblib pool. Worker processes write
+    straight into ``output``, which must then be an ``np.memmap`` opened for writing;
+    the threading backend can share a plain array.
+
+    Args:
+        row_distances (callable): Distances from person i to persons j0..j1-1, called as row_distances(i, j0, j1).
+            With ``stats`` it is called as row_distances(i, j0, j1, counts=counts) and may add
+            counters such as 'dp_cells' to the ``counts`` dictionary. Its ``flush()`` method, if it has
+            one, is called once a worker is done with its tiles, e.g. to write buffered results.
+        output (np.ndarray): Square buffer, or condensed buffer in scipy ``squareform`` layout.
+        n_jobs (int): Number of workers, -1 for all cores.
+        tile_size (int): Number of rows and columns per tile.
+        backend (str): joblib backend, 'loky' for processes or 'threading'.
+        stats (JobStats, optional): Receives progress and counters; process workers report
+            once per chunk of tiles.
+
+    Returns:
+        np.ndarray: The output buffer.
+    """
+    n = output.shape[0] if output.ndim == 2 else n_from_condensed_size(len(output))
+    tiles = upper_triangle_tiles(n, tile_size)
+    if stats is not None:
+        stats.start(sum(tile_pair_count(tile) for tile in tiles))
+    if n_jobs == 1 or len(tiles) <= 1:
+        _fill_tiles(row_distances, output, tiles, stats)
+        return output
+    if backend != 'threading' and not isinstance(output, np.memmap):
+        raise ValueError("Process workers need a np.memmap output buffer.")
+
+    n_workers = effective_n_jobs(n_jobs)
+    # A few chunks per worker, dealt round-robin from the largest tile down,
+    # so every chunk gets a similar number of pairs
+    n_chunks = min(len(tiles), 4 * n_workers)
+    chunks = [tiles[k::n_chunks] for k in range(n_chunks)]
+    if backend == 'threading' or stats is None:
+        Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(_fill_tiles)(row_distances, output, chunk, stats) for chunk in chunks
+        )
+    else:
+        # Worker processes hold copies of stats, so they return their counts instead
+        for counts in Parallel(n_jobs=n_jobs, backend=backend, return_as='generator_unordered')(
+                delayed(_fill_tiles)(row_distances, output, chunk, count=True) for chunk in chunks):
+            stats.update(counts)
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
+
+
+def _fill_in_memory(row_distances: callable, output: np.ndarray, n_jobs: int, tile_size: int, backend: str,
+                    stats: JobStats = None) -> np.ndarray:
+    """
+    Fill an in-memory buffer, going through a temporary memory map when process workers are used.
+    """
+    if n_jobs == 1 or backend == 'threading' or output.size == 0:
+        with _phase(stats, 'kernel'):
+            return fill_upper_triangle(row_distances, output, n_jobs, tile_size, backend, stats)
+
+    temp_folder = tempfile.mkdtemp(prefix='mdtw_')
+    try:
+        shared = np.memmap(os.path.join(temp_folder, 'distances.mmap'), dtype=output.dtype, mode='w+', shape=output.shape)
+        with _phase(stats, 'kernel'):
+            fill_upper_triangle(row_distances, shared, n_jobs, tile_size, backend, stats)
+        with _phase(stats, 'write'):
+            output[...] = shared
+        del shared
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    return output
+
+
+def parallel_distance_matrix(row_distances: callable, n: int, n_jobs: int = 1, tile_size: int = 128, backend: str = 'loky', dtype=np.float64,
+                             stats: JobStats = None) -> np.ndarray:
+    """
+    Build a dense symmetric distance matrix on a pool of workers.
+
+    Process workers share a temporary memory-mapped buffer, so results are
+    written in place instead of being pickled back.
+
+    Args:
+        row_distances (callable): Distances from person i to persons j0..j1-1, called as row_distances(i, j0, j1).
+        n (int): Number of persons.
+        n_jobs (int): Number of workers, -1 for all cores.
+        tile_size (int): Number of rows and columns per tile.
+        backend (str): joblib backend, 'loky' for processes or 'threading'.
+        dtype: Dtype of the matrix.
+        stats (JobStats, optional): Receives progress, counters and 'kernel' and 'write' phase timings.
+
+    Returns:
+        np.ndarray: Distance matrix.
+    """
+    distance_matrix = _fill_in_memory(row_distances, np.zeros((n, n), dtype=dtype), n_jobs, tile_size, backend, stats)
+
+    # Symmetric matrix
+    with _phase(stats, 'write'):
+        lower = np.tril_indices(n, -1)
+        distance_matrix[lower] = distance_matrix.T[lower]
+    return distance_matrix
+
+
+def parallel_condensed_matrix(row_distances: callable, n: int, n_jobs: int = 1, tile_size: int = 128, backend: str = 'loky',
+                              dtype=np.float64, path: str = None, stats: JobStats = None) -> CondensedDistanceMatrix:
+    """
+    Build a condensed distance matrix on a pool of workers.
+
+    With a path the distances stream into an ``np.memmap`` file that workers
+    write directly; otherwise the matrix is returned in memory.
+
+    Args:
+        row_distances (callable): Distances from person i to persons j0..j1-1, called as row_distances(i, j0, j1).
+        n (int): Number of persons.
+        n_jobs (int): Number of workers, -1 for all cores.
+        tile_size (int): Number of rows and columns per tile.
+        backend (str): joblib backend, 'loky' for processes or 'threading'.
+        dtype: np.float32 or np.float64.
+        path (str, optional): File backing the result.
+        stats (JobStats, optional): Receives progress, counters and 'kernel' and 'write' phase timings.
+
+    Returns:
+        CondensedDistanceMatrix: Condensed distance matrix.
+    """
+    matrix = CondensedDistanceMatrix.allocate(n, dtype, path)
+    if isinstance(matrix.data, np.memmap):
+        with _phase(stats, 'kernel'):
+            fill_upper_triangle(row_distances, matrix.data, n_jobs, tile_size, backend, stats)
+        with _phase(stats, 'write'):
+            matrix.flush()
+    else:
+        _fill_in_memory(row_distances, matrix.data, n_jobs, tile_size, backend, stats)
+    return matrix
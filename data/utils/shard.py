@@ -0,0 +1,387 @@
+"""
+Distance matrix jobs split into numbered work units for many machines.
+
+A job directory shared by every host holds::
+
+    manifest.json        cohort location, MDTW parameters and the tile of every unit
+    cohort/              the packed cohort, see ``PackedCohortWriter``
+    claims/unit_K.claim  created exclusively by the worker computing unit K
+    results/unit_K.npy   condensed row segments of unit K, renamed into place when complete
+
+Workers on any host run ``python -m data.utils.shard work JOB_DIR``; once every
+unit has a result, ``python -m data.utils.shard merge JOB_DIR OUTPUT`` assembles the
+condensed matrix. A unit is done exactly when its result file exists, so a crashed
+worker leaves at most a claim behind. Claims older than the lease are taken over by
+other workers, and ``reset_claims`` releases them at once after a known crash.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import numpy as np
+from typing import Dict, List, Tuple, Union
+
+from data.utils.cohort import PackedCohort, PackedCohortWriter
+from data.utils.condensed import CondensedDistanceMatrix, condensed_index
+from data.utils.modified_mdtw import mdtw_distance_one_to_many
+from data.utils.parallel import tile_pair_count, upper_triangle_tiles
+
+MANIFEST_VERSION = 1
+
+
+def _unit_name(unit: int) -> str:
+    return f"unit_{unit:06d}"
+
+
+def default_worker_id() -> str:
+    """
+    Host name and process id, unique among the workers of a job.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class DistanceJob:
+    """
+    A sharded distance matrix job stored in a directory on a shared filesystem.
+
+    Attributes:
+        directory (str): Job directory.
+        manifest (dict): Contents of ``manifest.json``.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Open an existing job; use ``create`` for a new one.
+
+        Args:
+            directory (str): Job directory.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as file:
+            self.manifest = json.load(file)
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported job manifest version {self.manifest.get('version')}.")
+        self._cohort = None
+
+    @classmethod
+    def create(cls, directory: str, prepared_data: Union[dict, PackedCohort, str], delta: float = 23, beta: float = 1, alpha: float = 2,
+               max_time_gap: float = None, tile_size: int = 1024, dtype=np.float64, W=None) -> "DistanceJob":
+        """
+        Write the manifest and cohort of a new job.
+
+        Args:
+            directory (str): Job directory, created if missing; must not hold a job already.
+            prepared_data (dict, PackedCohort or str): Dictionary containing prepared data for each person,
+                the same cohort in packed form, or the directory of a cohort written by
+                ``PackedCohortWriter``, which is then used in place.
+            delta (float): Time scaling factor.
+            beta (float): Weighting factor for time difference.
+            alpha (float): Exponent for time difference scaling.
+            max_time_gap (float, optional): Largest time difference allowed between matched events.
+            tile_size (int): Number of rows and columns per work unit.
+            dtype: np.float32 or np.float64, for the results and the merged matrix.
+            W (array-like, optional): Nutrient weight matrix, see ``local_distance``; applied to a
+                copy of the cohort written into the job.
+
+        Returns:
+            DistanceJob: The new job.
+        """
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, "manifest.json")):
+            raise ValueError(f"{directory} already holds a job.")
+        if isinstance(prepared_data, str) and W is None:
+            cohort_path = os.path.abspath(prepared_data)
+            n = len(PackedCohort.open(cohort_path))
+        else:
+            if isinstance(prepared_data, str):
+                cohort = PackedCohort.open(prepared_data)
+            elif isinstance(prepared_data, PackedCohort):
+                cohort = prepared_data
+            else:
+                cohort = PackedCohort.from_prepared(prepared_data)
+            cohort_path = "cohort"
+            with PackedCohortWriter(os.path.join(directory, cohort_path)) as writer:
+                writer.append(cohort.weighted(W))
+            n = len(cohort)
+
+        for name in ("claims", "results"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'n': n,
+            'cohort': cohort_path,
+            'parameters': {'delta': delta, 'beta': beta, 'alpha': alpha, 'max_time_gap': max_time_gap},
+            'weights': None if W is None else np.asarray(W, dtype=np.float64).tolist(),
+            'dtype': np.dtype(dtype).name,
+            'tile_size': tile_size,
+            'units': [list(tile) for tile in upper_triangle_tiles(n, tile_size)],
+        }
+        # Write then rename, so workers never read a partial manifest
+        temporary = os.path.join(directory, "manifest.json.tmp")
+        with open(temporary, 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(temporary, os.path.join(directory, "manifest.json"))
+        return cls(directory)
+
+    def __len__(self) -> int:
+        return len(self.manifest['units'])
+
+    @property
+    def n(self) -> int:
+        return self.manifest['n']
+
+    @property
+    def cohort(self) -> PackedCohort:
+        """
+        The job's cohort, memory-mapped on first use.
+        """
+        if self._cohort is None:
+            self._cohort = PackedCohort.open(os.path.join(self.directory, self.manifest['cohort']))
+        return self._cohort
+
+    def unit(self, unit: int) -> Tuple[int, int, int, int]:
+        """
+        Tile of a unit as (row_start, row_stop, col_start, col_stop).
+        """
+        return tuple(self.manifest['units'][unit])
+
+    def _claim_path(self, unit: int) -> str:
+        return os.path.join(self.directory, "claims", _unit_name(unit) + ".claim")
+
+    def _result_path(self, unit: int) -> str:
+        return os.path.join(self.directory, "results", _unit_name(unit) + ".npy")
+
+    def is_done(self, unit: int) -> bool:
+        return os.path.exists(self._result_path(unit))
+
+    def pending_units(self) -> List[int]:
+        """
+        Units without a result, claimed or not.
+        """
+        done = set(os.listdir(os.path.join(self.directory, "results")))
+        return [unit for unit in range(len(self)) if _unit_name(unit) + ".npy" not in done]
+
+    def claim(self, unit: int, worker_id: str, lease_seconds: float = None) -> bool:
+        """
+        Try to claim a unit.
+
+        The claim file is created with ``O_CREAT | O_EXCL``, which exactly one worker
+        wins. A claim older than ``lease_seconds`` is first renamed away, which again
+        only one worker can do, and then claimed anew. A worker that reads the age of a
+        claim just before another takes it over may still take the fresh claim; the
+        unit is then computed twice with identical results.
+
+        Args:
+            unit (int): Unit number.
+            worker_id (str): Recorded in the claim file.
+            lease_seconds (float, optional): Age after which a claim is considered abandoned;
+                claims are never taken over when omitted.
+
+        Returns:
+            bool: Whether the unit now belongs to this worker.
+        """
+        path = self._claim_path(unit)
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if lease_seconds is None:
+                return False
+            try:
+                if time.time() - os.path.getmtime(path) < lease_seconds:
+                    return False
+                stale = f"{path}.{worker_id}.stale"
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return False
+            os.remove(stale)
+            return self.claim(unit, worker_id)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({'worker': worker_id, 'time': time.time()}, file)
+        return True
+
+    def compute_unit(self, unit: int) -> np.ndarray:
+        """
+        Distances of a unit's pairs, as its condensed row segments concatenated in row order.
+        """
+        r0, r1, c0, c1 = self.unit(unit)
+        values = np.empty(tile_pair_count((r0, r1, c0, c1)), dtype=self.manifest['dtype'])
+        position = 0
+        for i in range(r0, r1):
+            j0 = max(c0, i + 1)
+            if j0 >= c1:
+                continue
+            values[position:position + c1 - j0] = mdtw_distance_one_to_many(self.cohort, i, np.arange(j0, c1), **self.manifest['parameters'])
+            position += c1 - j0
+        return values
+
+    def _write_result(self, unit: int, values: np.ndarray, worker_id: str) -> None:
+        temporary = os.path.join(self.directory, "results", f".{_unit_name(unit)}.{worker_id}.tmp.npy")
+        with open(temporary, 'wb') as file:
+            np.save(file, values)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self._result_path(unit))
+
+    def run_worker(self, worker_id: str = None, lease_seconds: float = 3600, max_units: int = None) -> int:
+        """
+        Claim and compute pending units until none is left.
+
+        Args:
+            worker_id (str, optional): Name of this worker, ``default_worker_id()`` by default.
+            lease_seconds (float, optional): Take over claims older than this, see ``claim``;
+                must exceed the time one unit takes.
+            max_units (int, optional): Stop after computing this many units.
+
+        Returns:
+            int: Number of units computed.
+        """
+        worker_id = worker_id or default_worker_id()
+        computed = 0
+        for unit in self.pending_units():
+            if max_units is not None and computed >= max_units:
+                break
+            if self.is_done(unit) or not self.claim(unit, worker_id, lease_seconds):
+                continue
+            # Another worker may have finished the unit between the listing and the claim
+            if not self.is_done(unit):
+                self._write_result(unit, self.compute_unit(unit), worker_id)
+                computed += 1
+            try:
+                os.remove(self._claim_path(unit))
+            except FileNotFoundError:
+                pass
+        return computed
+
+    def reset_claims(self) -> int:
+        """
+        Release every claim of an unfinished unit, after all workers have stopped.
+
+        Returns:
+            int: Number of claims released.
+        """
+        released = 0
+        claims = os.path.join(self.directory, "claims")
+        for name in os.listdir(claims):
+            if not name.endswith(".claim") or os.path.exists(os.path.join(self.directory, "results", name[:-len(".claim")] + ".npy")):
+                continue
+            os.remove(os.path.join(claims, name))
+            released += 1
+        return released
+
+    def status(self) -> Dict[str, int]:
+        """
+        Counts of units by state.
+
+        Returns:
+            dict: Total, done, claimed (pending with a claim) and open units.
+        """
+        pending = self.pending_units()
+        claimed = sum(os.path.exists(self._claim_path(unit)) for unit in pending)
+        return {'units': len(self), 'done': len(self) - len(pending), 'claimed': claimed, 'open': len(pending) - claimed}
+
+    def merge(self, path: str = None, condensed: bool = True) -> Union[np.ndarray, CondensedDistanceMatrix]:
+        """
+        Assemble the distance matrix from the unit results.
+
+        Args:
+            path (str, optional): File backing the condensed matrix as an ``np.memmap``.
+            condensed (bool): Return a CondensedDistanceMatrix instead of a square array.
+
+        Returns:
+            np.ndarray or CondensedDistanceMatrix: Distance matrix.
+
+        Raises:
+            ValueError: If a unit has no result yet.
+        """
+        pending = self.pending_units()
+        if pending:
+            raise ValueError(f"{len(pending)} units have no result yet, e.g. {pending[:5]}.")
+        if path is not None and not condensed:
+            raise ValueError("Memory-mapped output requires condensed=True.")
+        n = self.n
+        matrix = CondensedDistanceMatrix.allocate(n, self.manifest['dtype'], path)
+        for unit in range(len(self)):
+            r0, r1, c0, c1 = self.unit(unit)
+            values = np.load(self._result_path(unit))
+            position = 0
+            for i in range(r0, r1):
+                j0 = max(c0, i + 1)
+                if j0 >= c1:
+                    continue
+                start = condensed_index(n, i, j0)
+                matrix.data[start:start + c1 - j0] = values[position:position + c1 - j0]
+                position += c1 - j0
+        if path is not None:
+            matrix.flush()
+        return matrix if condensed else matrix.to_dense()
+
+
+def run_local_workers(directory: str, n_workers: int, lease_seconds: float = 3600) -> int:
+    """
+    Run several worker processes on this machine, standing in for separate hosts.
+
+    Args:
+        directory (str): Job directory.
+        n_workers (int): Number of worker processes.
+        lease_seconds (float): Passed to ``DistanceJob.run_worker``.
+
+    Returns:
+        int: Number of units computed over all workers.
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(n_workers) as pool:
+        counts = pool.starmap(_run_worker, [(directory, f"{default_worker_id()}-{k}", lease_seconds) for k in range(n_workers)])
+    return sum(counts)
+
+
+def _run_worker(directory: str, worker_id: str, lease_seconds: float) -> int:
+    return DistanceJob(directory).run_worker(worker_id, lease_seconds)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a sharded MDTW distance matrix job.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help="Create a job for a cohort written by PackedCohortWriter.")
+    create.add_argument('directory')
+    create.add_argument('cohort')
+    create.add_argument('--delta', type=float, default=23)
+    create.add_argument('--beta', type=float, default=1)
+    create.add_argument('--alpha', type=float, default=2)
+    create.add_argument('--max-time-gap', type=float)
+    create.add_argument('--tile-size', type=int, default=1024)
+    create.add_argument('--dtype', default='float64', choices=['float32', 'float64'])
+    work = commands.add_parser('work', help="Compute pending units.")
+    work.add_argument('directory')
+    work.add_argument('--worker-id')
+    work.add_argument('--lease-seconds', type=float, default=3600)
+    work.add_argument('--max-units', type=int)
+    for name, help in (('status', "Count units by state."), ('reset', "Release the claims of unfinished units.")):
+        commands.add_parser(name, help=help).add_argument('directory')
+    merge = commands.add_parser('merge', help="Assemble the condensed matrix into a memory-mapped file.")
+    merge.add_argument('directory')
+    merge.add_argument('output')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        job = DistanceJob.create(args.directory, args.cohort, args.delta, args.beta, args.alpha, args.max_time_gap, args.tile_size, args.dtype)
+        print(f"{len(job)} units for {job.n} persons")
+    elif args.command == 'work':
+        print(f"{DistanceJob(args.directory).run_worker(args.worker_id, args.lease_seconds, args.max_units)} units computed")
+    elif args.command == 'status':
+        print(json.dumps(DistanceJob(args.directory).status()))
+    elif args.command == 'reset':
+        print(f"{DistanceJob(args.directory).reset_claims()} claims released")
+    else:
+        try:
+            DistanceJob(args.directory).merge(args.output)
+        except ValueError as error:
+            print(error)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
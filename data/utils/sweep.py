@@ -0,0 +1,143 @@
+import os
+import itertools
+import numpy as np
+from typing import List, Dict, Tuple, Union
+
+from data.utils.cohort import PackedCohort
+from data.utils.condensed import CondensedDistanceMatrix, condensed_index
+
+
+def parameter_grid(grid: Union[Dict[str, list], List[Tuple[float, float, float]]]) -> List[Tuple[float, float, float]]:
+    """
+    Expand a parameter grid into (delta, beta, alpha) settings.
+
+    Args:
+        grid (dict or list): Either ``{'delta': [...], 'beta': [...], 'alpha': [...]}``, expanded
+            as a Cartesian product (missing keys take the defaults 23, 1 and 2), or a list of
+            (delta, beta, alpha) tuples used as is.
+
+    Returns:
+        list: Settings as (delta, beta, alpha) tuples.
+    """
+    if isinstance(grid, dict):
+        unknown = set(grid) - {'delta', 'beta', 'alpha'}
+        if unknown:
+            raise ValueError(f"Unknown parameters in grid: {sorted(unknown)}.")
+        return list(itertools.product(grid.get('delta', [23]), grid.get('beta', [1]), grid.get('alpha', [2])))
+    return [tuple(setting) for setting in grid]
+
+
+def mdtw_distance_batch_sweep(t: np.ndarray, V: np.ndarray, times: np.ndarray, nutrients: np.ndarray, lengths: np.ndarray,
+                              settings: List[Tuple[float, float, float]], sq: np.ndarray = None, sq_norms: np.ndarray = None,
+                              max_time_gap: float = None) -> np.ndarray:
+    """
+    Calculate the modified DTW distance between one sequence and a batch of padded
+    sequences for several (delta, beta, alpha) settings at once.
+
+    The value difference ``||vi - vj||^2``, the cross term ``vi.vj`` and ``|ti - tj|``
+    do not depend on the parameters; they are computed once per query event and only
+    ``2 * beta * vi.vj * (|ti - tj| / delta) ** alpha`` is evaluated per setting. The DP
+    then runs over a (settings, batch) grid, see ``mdtw_distance_batch``.
+
+    Args:
+        t (np.ndarray): Event times of the query, shape (m,).
+        V (np.ndarray): Nutrients of the query, shape (m, d).
+        times (np.ndarray): Padded event times of the candidates, shape (B, L).
+        nutrients (np.ndarray): Padded nutrients of the candidates, shape (B, L, d).
+        lengths (np.ndarray): Number of real events of every candidate, shape (B,).
+        settings (list): (delta, beta, alpha) tuples.
+        sq (np.ndarray, optional): Precomputed squared norms of V.
+        sq_norms (np.ndarray, optional): Precomputed squared norms of the candidates, shape (B, L).
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+
+    Returns:
+        np.ndarray: Distances of shape (S, B).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    batch, width = times.shape
+    delta, beta, alpha = (np.asarray(column, dtype=np.float64)[:, None, None] for column in zip(*settings))
+    if sq is None:
+        sq = np.einsum('ij,ij->i', V, V)
+    if sq_norms is None:
+        sq_norms = np.einsum('bld,bld->bl', nutrients, nutrients)
+    valid = np.arange(1, width + 1)[None, :] <= lengths[:, None]
+    sq_norms = np.where(valid, sq_norms, 0)
+
+    offsets = np.zeros((batch, width + 1))
+    np.cumsum(sq_norms, axis=1, out=offsets[:, 1:])
+    prev_rows = np.broadcast_to(offsets, (len(settings), batch, width + 1)).copy()
+    curr_rows = np.empty_like(prev_rows)
+
+    for i in range(len(t)):
+        cross = nutrients @ V[i]
+        gap = np.abs(t[i] - times)
+        value_diff = np.maximum(sq[i] + sq_norms - 2 * cross, 0)
+        local_costs = value_diff + 2 * beta * cross * (gap / delta) ** alpha
+        if max_time_gap is not None:
+            local_costs[:, gap > max_time_gap] = np.inf
+
+        curr_rows[:, :, 0] = prev_rows[:, :, 0] + sq[i]
+        np.minimum(prev_rows[:, :, :-1] + local_costs, prev_rows[:, :, 1:] + sq[i], out=curr_rows[:, :, 1:])
+        curr_rows -= offsets
+        np.minimum.accumulate(curr_rows, axis=2, out=curr_rows)
+        curr_rows += offsets
+        prev_rows, curr_rows = curr_rows, prev_rows
+
+    return prev_rows[:, np.arange(batch), lengths]
+
+
+def _setting_filename(setting: Tuple[float, float, float], dtype) -> str:
+    delta, beta, alpha = setting
+    return f"mdtw_delta={delta:g}_beta={beta:g}_alpha={alpha:g}.{np.dtype(dtype).name}"
+
+
+def calculate_distance_matrix_sweep(prepared_data: Union[dict, PackedCohort], grid: Union[Dict[str, list], List[Tuple[float, float, float]]],
+                                    condensed: bool = False, dtype=np.float64, path: str = None, max_time_gap: float = None,
+                                    tile_size: int = 128, W=None) -> Dict[Tuple[float, float, float], Union[np.ndarray, CondensedDistanceMatrix]]:
+    """
+    Calculate one distance matrix per (delta, beta, alpha) setting of a grid in a single pass.
+
+    Every pair is visited once: its parameter-independent terms are shared by all
+    settings and the DPs of all settings advance together. With ``path`` the
+    condensed matrices stream into one memory-mapped file per setting in that
+    directory, named after the setting.
+
+    Args:
+        prepared_data (dict or PackedCohort): Dictionary containing prepared data for each person,
+            or the same cohort in packed form.
+        grid (dict or list): Parameter grid, see ``parameter_grid``.
+        condensed (bool): Return CondensedDistanceMatrix objects instead of square arrays.
+        dtype: np.float32 or np.float64.
+        path (str, optional): Directory for memory-mapped condensed output; implies condensed.
+        max_time_gap (float, optional): Largest time difference allowed between matched events.
+        tile_size (int): Number of candidates sent to the kernel at once.
+        W (array-like, optional): Nutrient weight matrix, see ``local_distance``.
+
+    Returns:
+        dict: Distance matrix for every (delta, beta, alpha) setting.
+    """
+    cohort = prepared_data if isinstance(prepared_data, PackedCohort) else PackedCohort.from_prepared(prepared_data)
+    cohort = cohort.weighted(W)
+    settings = parameter_grid(grid)
+    n = len(cohort)
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        matrices = [CondensedDistanceMatrix.allocate(n, dtype, os.path.join(path, _setting_filename(setting, dtype))) for setting in settings]
+    else:
+        matrices = [CondensedDistanceMatrix.allocate(n, dtype) for _ in settings]
+
+    for i in range(n - 1):
+        t, V, sq = cohort.person(i)
+        for j0 in range(i + 1, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+            times, nutrients, sq_norms, lengths = cohort.padded(np.arange(j0, j1))
+            distances = mdtw_distance_batch_sweep(t, V, times, nutrients, lengths, settings, sq, sq_norms, max_time_gap)
+            start = condensed_index(n, i, j0)
+            for matrix, row in zip(matrices, distances):
+                matrix.data[start:start + j1 - j0] = row
+
+    for matrix in matrices:
+        matrix.flush()
+    if not condensed and path is None:
+        return {setting: matrix.to_dense() for setting, matrix in zip(settings, matrices)}
+    return dict(zip(settings, matrices))
@@ -0,0 +1,275 @@
+"""
+Vectorized synthetic cohorts for load testing.
+
+Persons are drawn in fixed blocks of ``SEED_BLOCK_SIZE``, each from its own
+``np.random.Generator`` spawned from one ``np.random.SeedSequence``. Person k is
+therefore the same whatever the chunk size or number of workers. Each person
+follows an archetype that sets the number of meals, the hours they fall in and the
+portion size.
+"""
+import csv
+import json
+import numpy as np
+from joblib import Parallel, delayed
+from typing import Iterator, List, NamedTuple, Tuple
+
+from data.utils.cohort import PackedCohort, PackedCohortWriter
+from data.utils.ingest import infer_format, open_text
+
+# Number of persons drawn from one random generator
+SEED_BLOCK_SIZE = 4096
+
+
+def _hour_profile(*peaks: Tuple[float, float, float], base: float = 0.02) -> Tuple[float, ...]:
+    """
+    Relative weight of every hour of the day, as a sum of circular Gaussian bumps (hour, width, height).
+    """
+    hours = np.arange(24)
+    weights = np.full(24, base)
+    for hour, width, height in peaks:
+        distance = np.minimum(np.abs(hours - hour), 24 - np.abs(hours - hour))
+        weights += height * np.exp(-0.5 * (distance / width) ** 2)
+    return tuple(weights / weights.sum())
+
+
+class Archetype(NamedTuple):
+    """
+    Eating behaviour of a group of synthetic persons.
+
+    Attributes:
+        name (str): Name of the archetype.
+        min_meals (int): Fewest eating events per day.
+        max_meals (int): Most eating events per day.
+        hour_weights (tuple): Relative probability of each of the 24 hours.
+        portion_scale (float): Factor on the amounts of every event.
+    """
+    name: str
+    min_meals: int
+    max_meals: int
+    hour_weights: Tuple[float, ...]
+    portion_scale: float = 1.0
+
+
+ARCHETYPES = {
+    'regular': Archetype('regular', 3, 4, _hour_profile((8, 1, 1), (13, 1, 1), (19, 1.5, 1))),
+    'skipper': Archetype('skipper', 1, 2, _hour_profile((13, 1.5, 1), (20, 1.5, 1), base=0.005), 1.5),
+    'snacker': Archetype('snacker', 6, 10, _hour_profile((8, 1, 0.3), (13, 1, 0.3), (19, 1.5, 0.3), base=0.05), 0.4),
+    'night_eater': Archetype('night_eater', 2, 5, _hour_profile((22, 1.5, 1), (2, 2, 1), base=0.01)),
+}
+
+
+class SyntheticChunk(NamedTuple):
+    """
+    Raw events of consecutive synthetic persons.
+
+    Attributes:
+        ids (np.ndarray): Person ids, shape (n,).
+        archetypes (np.ndarray): Archetype name of every person, shape (n,).
+        times (np.ndarray): Event times in hours, sorted within each person, shape (N,).
+        nutrients (np.ndarray): Raw, unnormalized amounts, shape (N, d).
+        offsets (np.ndarray): Start of each person's events, shape (n + 1,).
+    """
+    ids: np.ndarray
+    archetypes: np.ndarray
+    times: np.ndarray
+    nutrients: np.ndarray
+    offsets: np.ndarray
+
+
+def _resolve_archetypes(archetypes) -> Tuple[List[Archetype], np.ndarray]:
+    if archetypes is None:
+        archetypes = {'regular': 1.0}
+    if not isinstance(archetypes, dict):
+        archetypes = dict.fromkeys(archetypes, 1.0)
+    unknown = [name for name in archetypes if isinstance(name, str) and name not in ARCHETYPES]
+    if unknown:
+        raise ValueError(f"Unknown archetypes {unknown}; expected one of {sorted(ARCHETYPES)}.")
+    resolved = [ARCHETYPES[name] if isinstance(name, str) else name for name in archetypes]
+    weights = np.array(list(archetypes.values()), dtype=np.float64)
+    for archetype in resolved:
+        if not 1 <= archetype.min_meals <= archetype.max_meals:
+            raise ValueError(f"Archetype {archetype.name} needs 1 <= min_meals <= max_meals.")
+        if len(archetype.hour_weights) != 24 or min(archetype.hour_weights) < 0:
+            raise ValueError(f"Archetype {archetype.name} needs 24 non-negative hour weights.")
+    if len(weights) == 0 or np.any(weights < 0) or weights.sum() <= 0:
+        raise ValueError("Archetype weights must be non-negative with a positive sum.")
+    return resolved, weights / weights.sum()
+
+
+def _generate_block(seed: np.random.SeedSequence, block: int, start: int, stop: int, archetypes: List[Archetype],
+                    proportions: np.ndarray, n_days: int, n_nutrients: int, min_amount: float, max_amount: float) -> SyntheticChunk:
+    """
+    Persons ``start`` to ``stop`` of seed block ``block``, drawn in a few vectorized calls.
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (block,)))
+    size = SEED_BLOCK_SIZE
+    n_slots = 24 * n_days
+
+    kind = rng.choice(len(archetypes), size=size, p=proportions)
+    min_meals = np.array([archetype.min_meals for archetype in archetypes])[kind]
+    max_meals = np.array([archetype.max_meals for archetype in archetypes])[kind]
+    counts = np.minimum(rng.integers(min_meals * n_days, max_meals * n_days + 1), n_slots)
+
+    # Weighted sampling of distinct hours without replacement: keep the largest keys u^(1/w)
+    hour_weights = np.tile(np.array([archetype.hour_weights for archetype in archetypes]), n_days)
+    with np.errstate(divide='ignore'):
+        keys = np.log(rng.random((size, n_slots))) / hour_weights[kind]
+    order = np.argsort(-keys, axis=1)
+    chosen = np.zeros((size, n_slots), dtype=bool)
+    np.put_along_axis(chosen, order, np.arange(n_slots) < counts[:, None], axis=1)
+    owner, hour = np.nonzero(chosen)
+
+    scale = np.array([archetype.portion_scale for archetype in archetypes])[kind][owner]
+    nutrients = rng.uniform(min_amount, max_amount, size=(len(owner), n_nutrients)) * scale[:, None]
+
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    e0, e1 = offsets[start], offsets[stop]
+    first = block * SEED_BLOCK_SIZE + 1
+    ids = np.array([f"person_{k}" for k in range(first + start, first + stop)])
+    names = np.array([archetype.name for archetype in archetypes])[kind[start:stop]]
+    return SyntheticChunk(ids, names, hour[e0:e1].astype(np.float64), nutrients[e0:e1], offsets[start:stop + 1] - e0)
+
+
+def _slice(chunk: SyntheticChunk, start: int, stop: int) -> SyntheticChunk:
+    e0, e1 = chunk.offsets[start], chunk.offsets[stop]
+    return SyntheticChunk(chunk.ids[start:stop], chunk.archetypes[start:stop], chunk.times[e0:e1], chunk.nutrients[e0:e1],
+                          chunk.offsets[start:stop + 1] - e0)
+
+
+def _concat(chunks: List[SyntheticChunk]) -> SyntheticChunk:
+    if len(chunks) == 1:
+        return chunks[0]
+    lengths = np.concatenate([np.diff(chunk.offsets) for chunk in chunks])
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return SyntheticChunk(np.concatenate([chunk.ids for chunk in chunks]), np.concatenate([chunk.archetypes for chunk in chunks]),
+                          np.concatenate([chunk.times for chunk in chunks]), np.concatenate([chunk.nutrients for chunk in chunks]), offsets)
+
+
+def iter_synthetic_chunks(num_people: int, chunk_size: int = SEED_BLOCK_SIZE, archetypes=None, n_nutrients: int = 1, n_days: int = 1,
+                          min_amount: float = 200, max_amount: float = 800, seed: int = 42, n_jobs: int = 1) -> Iterator[SyntheticChunk]:
+    """
+    Stream a synthetic cohort in chunks of raw events.
+
+    Every person eats at distinct whole hours over ``n_days`` days. The number of
+    events, their hours and portion sizes follow the person's archetype, and every
+    nutrient amount is uniform in ``[min_amount, max_amount)`` times the portion scale.
+
+    Args:
+        num_people (int): Number of persons.
+        chunk_size (int): Persons per chunk; does not change the persons drawn.
+        archetypes (dict or list, optional): Archetype names from ``ARCHETYPES`` or ``Archetype``
+            objects, mapped to their proportion of the cohort; a list weighs them equally.
+            Only 'regular' by default.
+        n_nutrients (int): Number of nutrients per event.
+        n_days (int): Number of days covered by every person.
+        min_amount (float): Smallest nutrient amount before the portion scale.
+        max_amount (float): Largest nutrient amount before the portion scale.
+        seed (int): Root of the ``np.random.SeedSequence``.
+        n_jobs (int): Number of joblib workers drawing seed blocks; does not change the persons drawn.
+
+    Yields:
+        SyntheticChunk: Raw events of up to ``chunk_size`` consecutive persons.
+    """
+    if chunk_size < 1 or n_nutrients < 1 or n_days < 1:
+        raise ValueError("chunk_size, n_nutrients and n_days must be positive.")
+    if not 0 < min_amount <= max_amount:
+        raise ValueError("Nutrient amounts need 0 < min_amount <= max_amount.")
+    resolved, proportions = _resolve_archetypes(archetypes)
+    root = np.random.SeedSequence(seed)
+
+    # Every seed block is drawn once, then cut into chunks in order
+    arguments = [(root, block, 0, min(SEED_BLOCK_SIZE, num_people - block * SEED_BLOCK_SIZE), resolved, proportions,
+                  n_days, n_nutrients, min_amount, max_amount)
+                 for block in range(-(-num_people // SEED_BLOCK_SIZE))]
+    if n_jobs == 1:
+        blocks = (_generate_block(*args) for args in arguments)
+    else:
+        blocks = Parallel(n_jobs=n_jobs, return_as='generator')(delayed(_generate_block)(*args) for args in arguments)
+
+    buffered, n_buffered = [], 0
+    for block in blocks:
+        start = 0
+        while start < len(block.ids):
+            stop = min(start + chunk_size - n_buffered, len(block.ids))
+            buffered.append(_slice(block, start, stop))
+            n_buffered, start = n_buffered + stop - start, stop
+            if n_buffered == chunk_size:
+                yield _concat(buffered)
+                buffered, n_buffered = [], 0
+    if buffered:
+        yield _concat(buffered)
+
+
+def normalize_chunk(chunk: SyntheticChunk) -> PackedCohort:
+    """
+    Normalize every person's nutrients by their totals, as ``prepare_cohort`` does.
+
+    Args:
+        chunk (SyntheticChunk): Raw events.
+
+    Returns:
+        PackedCohort: Prepared persons.
+    """
+    lengths = np.diff(chunk.offsets)
+    totals = np.add.reduceat(chunk.nutrients, chunk.offsets[:-1], axis=0) if len(lengths) else chunk.nutrients[:0]
+    return PackedCohort(chunk.ids, chunk.times, chunk.nutrients / np.repeat(totals, lengths, axis=0), chunk.offsets)
+
+
+def generate_cohort(num_people: int, directory: str = None, chunk_size: int = SEED_BLOCK_SIZE, **kwargs) -> PackedCohort:
+    """
+    Generate a prepared synthetic cohort in packed form.
+
+    Args:
+        num_people (int): Number of persons.
+        directory (str, optional): Stream the cohort chunk by chunk into this directory through
+            ``PackedCohortWriter`` and return it memory-mapped; kept in memory otherwise.
+        chunk_size (int): Persons generated at a time.
+        **kwargs: Passed to ``iter_synthetic_chunks``.
+
+    Returns:
+        PackedCohort: Prepared cohort.
+    """
+    chunks = iter_synthetic_chunks(num_people, chunk_size, **kwargs)
+    if directory is not None:
+        with PackedCohortWriter(directory) as writer:
+            for chunk in chunks:
+                writer.append(normalize_chunk(chunk))
+        return PackedCohort.open(directory)
+    chunks = list(chunks)
+    if not chunks:
+        return PackedCohort([], np.zeros(0), np.zeros((0, kwargs.get('n_nutrients', 1))), np.zeros(1, dtype=np.int64))
+    return normalize_chunk(_concat(chunks))
+
+
+def write_event_log(path: str, num_people: int, format: str = None, chunk_size: int = SEED_BLOCK_SIZE, **kwargs) -> None:
+    """
+    Stream a raw synthetic cohort to a long-format event log readable by ``ingest.iter_persons``.
+
+    Rows hold ``person_id``, ``time``, ``archetype`` and one ``nutrient_<k>`` column per
+    nutrient; pass ``nutrient_columns`` to ``iter_persons`` when reading it back.
+
+    Args:
+        path (str): CSV or JSON-lines file, optionally gzip, bz2 or xz compressed.
+        num_people (int): Number of persons.
+        format (str, optional): 'csv' or 'jsonl', inferred from the file name by default.
+        chunk_size (int): Persons generated and written at a time.
+        **kwargs: Passed to ``iter_synthetic_chunks``.
+    """
+    file_format = format or infer_format(path)
+    if file_format not in ('csv', 'jsonl'):
+        raise ValueError(f"Cannot write format {file_format!r}; expected 'csv' or 'jsonl'.")
+    columns = [f"nutrient_{k}" for k in range(kwargs.get('n_nutrients', 1))]
+    with open_text(path, 'wt') as file:
+        writer = csv.writer(file) if file_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(['person_id', 'time', 'archetype'] + columns)
+        for chunk in iter_synthetic_chunks(num_people, chunk_size, **kwargs):
+            owner = np.repeat(np.arange(len(chunk.ids)), np.diff(chunk.offsets))
+            for person_id, archetype, time, nutrients in zip(chunk.ids[owner].tolist(), chunk.archetypes[owner].tolist(),
+                                                             chunk.times.tolist(), chunk.nutrients.tolist()):
+                if writer is not None:
+                    writer.writerow([person_id, time, archetype] + nutrients)
+                else:
+                    file.write(json.dumps(dict(person_id=person_id, time=time, archetype=archetype, **dict(zip(columns, nutrients)))) + "\n")
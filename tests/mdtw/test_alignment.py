@@ -0,0 +1,81 @@
+import pytest
+import numpy as np
+
+from data.utils.alignment import FIRST_TO_EMPTY, MATCH, SECOND_TO_EMPTY, align_to_medoids, mdtw_alignment, mdtw_alignment_vectorized
+from data.utils.cohort import prepare_cohort
+from data.utils.kmedoids import clara
+from data.utils.modified_mdtw import generate_synthetic_data, mdtw_distance, mdtw_distance_packed, mdtw_distance_vectorized
+
+
+def _sequences(rng, m1, m2, d=3):
+    t1, t2 = np.sort(rng.uniform(0, 48, m1)), np.sort(rng.uniform(0, 48, m2))
+    V1 = rng.dirichlet(np.ones(d), m1) / max(m1, 1)
+    V2 = rng.dirichlet(np.ones(d), m2) / max(m2, 1)
+    return t1, V1.reshape(m1, d), t2, V2.reshape(m2, d)
+
+
+def _check_path(alignment, m1, m2):
+    """Every event appears exactly once, in order, and the operations agree with the indices."""
+    first, second = alignment.first, alignment.second
+    assert np.array_equal(first[first >= 0], np.arange(m1)) and np.array_equal(second[second >= 0], np.arange(m2))
+    assert np.all((first >= 0) | (second >= 0))
+    assert np.array_equal(alignment.operations == MATCH, (first >= 0) & (second >= 0))
+    assert np.array_equal(alignment.operations == FIRST_TO_EMPTY, second < 0)
+    assert np.array_equal(alignment.operations == SECOND_TO_EMPTY, first < 0)
+    assert np.isclose(alignment.costs.sum(), alignment.distance)
+
+
+@pytest.mark.parametrize("max_time_gap", [None, 4.0])
+def test_alignment_is_optimal(max_time_gap):
+    rng = np.random.default_rng(0)
+    for m1, m2 in [(0, 3), (4, 0), (1, 7), (13, 9), (40, 57)]:
+        t1, V1, t2, V2 = _sequences(rng, m1, m2)
+        expected = mdtw_distance_vectorized(t1, V1, t2, V2, max_time_gap=max_time_gap)
+        for max_cells in (4, 100, 10 ** 6):
+            alignment = mdtw_alignment_vectorized(t1, V1, t2, V2, max_time_gap=max_time_gap, max_cells=max_cells)
+            _check_path(alignment, m1, m2)
+            assert np.isclose(alignment.distance, expected)
+            if max_time_gap is not None:
+                matched = alignment.operations == MATCH
+                assert np.all(np.abs(t1[alignment.first[matched]] - t2[alignment.second[matched]]) <= max_time_gap)
+
+
+def test_alignment_of_events():
+    ER1 = [(8, [0.5, 0.0]), (13, [0.05, 0.0]), (20, [0.1, 0.0])]
+    ER2 = [(8, [0.5, 0.0]), (20, [0.1, 0.0])]
+    alignment = mdtw_alignment(ER1, ER2)
+    _check_path(alignment, 3, 2)
+    assert np.isclose(alignment.distance, mdtw_distance(ER1, ER2))
+    # Identical meals are matched, the extra one goes to empty
+    assert alignment.first.tolist() == [0, 1, 2] and alignment.second.tolist() == [0, -1, 1]
+    assert alignment.costs[0] == 0 and np.isclose(alignment.costs[1], 0.05 ** 2)
+
+    W = np.array([2.0, 1.0])
+    assert np.isclose(mdtw_alignment(ER1, ER2, W=W).distance, mdtw_distance(ER1, ER2, W=W))
+    assert mdtw_alignment([], ER2).operations.tolist() == [SECOND_TO_EMPTY] * 2
+    with pytest.raises(ValueError):
+        mdtw_alignment(ER1, [(8, [0.5])])
+
+
+def test_align_to_medoids():
+    cohort = prepare_cohort(generate_synthetic_data(num_people=30, min_meals=1, max_meals=6))
+    result = clara(cohort, 3, random_state=0)
+    alignments = list(align_to_medoids(cohort, result.medoids, result.labels, block_size=7))
+
+    assert len(alignments) == len(cohort)
+    for i, alignment in enumerate(alignments):
+        medoid = result.medoids[result.labels[i]]
+        _check_path(alignment, cohort.lengths[i], cohort.lengths[medoid])
+        assert np.isclose(alignment.distance, mdtw_distance_packed(cohort, i, medoid))
+        if i == medoid:
+            assert alignment.distance == 0 and np.all(alignment.operations == MATCH)
+
+    parallel = list(align_to_medoids(cohort, result.medoids, result.labels, n_jobs=2, block_size=7))
+    assert all(np.array_equal(a.first, b.first) and np.array_equal(a.second, b.second) for a, b in zip(alignments, parallel))
+
+
+@pytest.mark.parametrize("medoids,labels", [([0, 1], [0, 1]), ([0, 1], [0, 2, 1]), ([0, 5], [0, 1, 1])])
+def test_invalid_clusters_give_error(medoids, labels):
+    cohort = prepare_cohort(generate_synthetic_data(num_people=3))
+    with pytest.raises(ValueError):
+        align_to_medoids(cohort, medoids, labels)
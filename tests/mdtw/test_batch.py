@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.modified_mdtw import (mdtw_distance_batch, mdtw_distance_one_to_many, mdtw_distance_packed,
+                                      generate_synthetic_data)
+
+
+@pytest.fixture
+def cohort():
+    """Generate a packed cohort with two nutrients and varied lengths."""
+    data = generate_synthetic_data(num_people=30, min_meals=1, max_meals=9)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'].append(float((k + record['time']) % 5 + 1))
+    return prepare_cohort(data)
+
+
+@pytest.mark.parametrize("max_time_gap", [None, 3])
+def test_batch_matches_pairwise(cohort, max_time_gap):
+    """Test that the batched kernel agrees with one call per pair, whatever the padding."""
+    for i in [0, 7, 29]:
+        expected = [mdtw_distance_packed(cohort, i, j, delta=5, max_time_gap=max_time_gap) for j in range(len(cohort))]
+        result = mdtw_distance_one_to_many(cohort, i, np.arange(len(cohort)), delta=5, max_time_gap=max_time_gap)
+        assert np.allclose(result, expected)
+
+
+def test_batch_with_cutoff(cohort):
+    """Test that candidates above the cutoff get infinity and the others are exact."""
+    expected = np.array([mdtw_distance_packed(cohort, 3, j) for j in range(len(cohort))])
+    cutoff = np.median(expected)
+    result = mdtw_distance_one_to_many(cohort, 3, np.arange(len(cohort)), cutoff=cutoff)
+
+    assert np.allclose(result[expected <= cutoff], expected[expected <= cutoff])
+    assert np.all(result[expected > cutoff] == np.inf)
+
+
+def test_batch_with_empty_sequences():
+    V = np.array([[0.4, 0.5], [0.6, 0.5]])
+    t = np.array([8.0, 19.0])
+    times = np.array([[8.0, 12.0], [0.0, 0.0]])
+    nutrients = np.array([V, np.zeros((2, 2))])
+
+    result = mdtw_distance_batch(t, V, times, nutrients, np.array([2, 0]))
+    assert result[1] == np.sum(V ** 2)
+    assert np.all(mdtw_distance_batch(np.zeros(0), np.zeros((0, 2)), times, nutrients, np.array([2, 0])) == [np.sum(V ** 2), 0])
+
+
+def test_padded(cohort):
+    """Test that padding keeps each person's events and zero fills the rest."""
+    times, nutrients, sq_norms, lengths = cohort.padded([4, 1, 9])
+
+    assert times.shape == (3, lengths.max())
+    for row, i in enumerate([4, 1, 9]):
+        t, V, sq = cohort.person(i)
+        assert np.array_equal(times[row, :lengths[row]], t)
+        assert np.array_equal(nutrients[row, :lengths[row]], V)
+        assert np.array_equal(sq_norms[row, :lengths[row]], sq)
+        assert not nutrients[row, lengths[row]:].any()
@@ -0,0 +1,71 @@
+import pytest
+
+from data.utils.benchmark import (benchmark_events, compare_to_baseline, load_baseline, main, measure, run_approximation_benchmarks,
+                                  run_benchmarks, run_cache_benchmarks, save_baseline)
+from data.utils.modified_mdtw import validate_nutrients, events_to_arrays
+
+
+def test_benchmark_events():
+    """Test that benchmark sequences have the requested shape and are normalized."""
+    events = benchmark_events(30, 3)
+    times, nutrients = events_to_arrays(events)
+
+    assert nutrients.shape == (30, 3)
+    assert times.tolist() == sorted(times.tolist())
+    assert nutrients.sum(axis=0) == pytest.approx([1, 1, 1])
+    validate_nutrients(nutrients)
+
+
+def test_run_benchmarks_and_baseline(tmp_path):
+    results = run_benchmarks(lengths=(4, 30), n_features=(2,), matrix_sizes=(5,), repeat=1, reference_max_length=10)
+
+    assert set(results) == {'local_distance[n_features=2]', 'mdtw_distance[length=4,n_features=2]',
+                            'mdtw_distance_optimized[length=4,n_features=2]', 'mdtw_distance_optimized[length=30,n_features=2]',
+                            'calculate_distance_matrix[n=5]'}
+    assert all(result['seconds'] > 0 and result['peak_bytes'] > 0 for result in results.values())
+
+    path = str(tmp_path / "baseline.json")
+    save_baseline(results, path)
+    assert load_baseline(path) == results
+
+
+def test_run_approximation_benchmarks():
+    results = run_approximation_benchmarks(lengths=(40,), radii=(1, 40), repeat=1)
+
+    assert set(results) == {'mdtw_distance_optimized[length=40,n_features=1]', 'mdtw_distance_fast[length=40,radius=1]',
+                            'mdtw_distance_fast[length=40,radius=40]'}
+    large_radius = results['mdtw_distance_fast[length=40,radius=40]']
+    assert large_radius['relative_error'] == pytest.approx(0, abs=1e-9)
+    assert 0 <= results['mdtw_distance_fast[length=40,radius=1]']['relative_error'] <= large_radius['relative_error_bound'] + 1e-9
+
+
+def test_run_cache_benchmarks():
+    results = run_cache_benchmarks(sizes=(20,), repeat=1)
+
+    assert set(results) == {'calculate_distance_matrix[n=20]', 'calculate_distance_matrix[n=20,cache=cold]',
+                            'calculate_distance_matrix[n=20,cache=warm]'}
+    assert all(results[f'calculate_distance_matrix[n=20,cache={name}]']['relative_time'] > 0 for name in ('cold', 'warm'))
+
+
+def test_compare_to_baseline():
+    baseline = {'a': {'seconds': 1.0, 'peak_bytes': 100}, 'b': {'seconds': 1.0, 'peak_bytes': 100}}
+    results = {'a': {'seconds': 1.2, 'peak_bytes': 100}, 'b': {'seconds': 1.0, 'peak_bytes': 200}, 'c': {'seconds': 9.0, 'peak_bytes': 1}}
+
+    assert compare_to_baseline(results, baseline, threshold=0.5) == ['b peak_bytes: 200 vs baseline 100 (+100%)']
+    assert len(compare_to_baseline(results, baseline, threshold=0.1)) == 2
+    assert compare_to_baseline(results, baseline, threshold=0.1, memory_threshold=2) == ['a seconds: 1.2 vs baseline 1 (+20%)']
+
+
+def test_main_fails_on_regression(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    arguments = ['--lengths', '3', '--n-features', '1', '--matrix-sizes', '4', '--fast-lengths', '20', '--radii', '1', '--cache-sizes', '4',
+                 '--repeat', '1']
+    assert main(arguments + ['--save', path]) == 0
+
+    save_baseline({name: {'seconds': 1e-12, 'peak_bytes': 1} for name in load_baseline(path)}, path)
+    assert main(arguments + ['--baseline', path]) == 1
+
+
+def test_measure():
+    result = measure(sorted, list(range(1000)), repeat=2, number=3)
+    assert result['peak_bytes'] >= 8000
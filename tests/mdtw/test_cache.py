@@ -0,0 +1,119 @@
+import pytest
+import numpy as np
+
+from data.utils.cache import DistanceCache, sequence_hash, pair_key, pair_keys, parameters_key
+from data.utils.cohort import prepare_cohort
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data, mdtw_distance_optimized
+
+
+@pytest.fixture
+def persons():
+    """Generate raw synthetic persons."""
+    return generate_synthetic_data(num_people=12, min_meals=1, max_meals=5)
+
+
+def test_keys_are_stable_and_symmetric():
+    t, V = np.array([8.0, 13.0]), np.array([[0.4], [0.6]])
+    h1, h2 = sequence_hash(t, V), sequence_hash(t, V * 0.5)
+
+    assert h1 == sequence_hash(t.copy(), V.copy())
+    assert h1 != h2
+    assert pair_key(h1, h2, parameters_key(23, 1, 2)) == pair_key(h2, h1, parameters_key(23, 1, 2))
+    assert pair_key(h1, h2, parameters_key(23, 1, 2)) != pair_key(h1, h2, parameters_key(23, 1, 3))
+    assert parameters_key(23, 1, 2) != parameters_key(23, 1, 2, max_time_gap=5)
+
+
+def test_lookups_with_and_without_preload(tmp_path):
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    keys = pair_keys(np.arange(1, 50, dtype=np.uint64), 7, parameters_key(23, 1, 2))
+    assert np.array_equal(keys, pair_keys(7, np.arange(1, 50, dtype=np.uint64), parameters_key(23, 1, 2)))
+    cache.put_many(keys[:30], np.arange(30) / 7)
+    cache.flush()
+    queried = np.concatenate([keys, keys[:5]])
+
+    stored = cache.get_many(queried)
+    cache.preload()
+    preloaded = cache.get_many(queried)
+    for values in (stored, preloaded):
+        assert np.array_equal(values[:30], np.arange(30) / 7) and np.array_equal(values[49:], np.arange(5) / 7)
+        assert np.isnan(values[30:49]).all()
+    assert cache.stats() == {'hits': 70, 'misses': 38, 'evictions': 0, 'entries': 30}
+
+
+def test_matrix_build_uses_cache(persons, tmp_path):
+    """Test that a second build is served from the cache and gives the same matrix."""
+    cohort = prepare_cohort(persons)
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    n_pairs = len(cohort) * (len(cohort) - 1) // 2
+
+    first = calculate_distance_matrix(cohort, delta=5, cache=cache)
+    assert cache.stats() == {'hits': 0, 'misses': n_pairs, 'evictions': 0, 'entries': n_pairs}
+
+    second = calculate_distance_matrix(cohort, delta=5, cache=DistanceCache(str(tmp_path / "cache.sqlite")))
+    assert np.array_equal(first, second)
+    assert np.allclose(first, calculate_distance_matrix(cohort, delta=5))
+    assert cache.stats()['hits'] == n_pairs
+
+
+def test_only_changed_pairs_are_computed(persons, tmp_path):
+    """Test that changing one person only recomputes the pairs it belongs to."""
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    calculate_distance_matrix(prepare_cohort(persons), cache=cache)
+    persons[3]['records'][0]['nutrients'][0] += 50
+    persons.append(generate_synthetic_data(num_people=13)[-1])
+
+    result = calculate_distance_matrix(prepare_cohort(persons), cache=cache)
+    stats = cache.stats()
+    assert stats['misses'] == 12 * 11 // 2 + 11 + 12
+    assert stats['hits'] == 12 * 11 // 2 - 11
+    assert np.allclose(result, calculate_distance_matrix(prepare_cohort(persons)))
+
+
+def test_small_build_searches_large_cache(persons, tmp_path):
+    """Test that a build looking up few of the cached pairs gets them without preloading."""
+    cohort = prepare_cohort(persons)
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    calculate_distance_matrix(cohort, cache=cache)
+    subset = cohort.subset(np.arange(4))
+
+    result = calculate_distance_matrix(subset, cache=cache)
+    assert cache.stats()['hits'] == 6
+    assert np.allclose(result, calculate_distance_matrix(subset))
+
+
+def test_eviction_bounds_size(persons, tmp_path):
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"), max_entries=20)
+    calculate_distance_matrix(prepare_cohort(persons), cache=cache, tile_size=4)
+
+    stats = cache.stats()
+    assert stats['entries'] <= 20
+    assert stats['evictions'] == 12 * 11 // 2 - stats['entries']
+
+
+def test_cache_with_process_workers(persons, tmp_path):
+    cohort = prepare_cohort(persons)
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    result = calculate_distance_matrix(cohort, cache=cache, n_jobs=2, tile_size=4)
+
+    assert np.allclose(result, calculate_distance_matrix(cohort))
+    assert cache.stats()['entries'] == 12 * 11 // 2
+
+
+@pytest.mark.parametrize("buffer_size", [1 << 18, 3])
+def test_cache_with_threads(persons, tmp_path, buffer_size):
+    """Test that threads sharing a cache use their own connections, flushing often or not."""
+    cohort = prepare_cohort(persons)
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"), buffer_size=buffer_size)
+    expected = calculate_distance_matrix(cohort)
+    for _ in range(2):
+        result = calculate_distance_matrix(cohort, cache=cache, n_jobs=2, tile_size=4, backend='threading')
+        assert np.array_equal(result, expected)
+
+    stats = cache.stats()
+    assert stats['entries'] == 12 * 11 // 2
+    assert stats['hits'] + stats['misses'] == 2 * 12 * 11 // 2 and stats['hits'] >= 12 * 11 // 2
+
+
+def test_cache_with_callback_gives_error(persons, tmp_path):
+    with pytest.raises(ValueError):
+        calculate_distance_matrix(prepare_cohort(persons), mdtw_distance_optimized, cache=DistanceCache(str(tmp_path / "c.sqlite")))
@@ -0,0 +1,83 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import PackedCohort, prepare_cohort
+from data.utils.modified_mdtw import (calculate_distance_matrix, generate_synthetic_data, prepare_person,
+                                      mdtw_distance_optimized, mdtw_distance_packed)
+
+
+@pytest.fixture
+def persons():
+    """Generate raw synthetic persons with two nutrients and unsorted records."""
+    data = generate_synthetic_data(num_people=8, min_meals=1, max_meals=6)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'].append(float(k + 1 + record['time']))
+        person['records'].reverse()
+    return data
+
+
+def test_prepare_cohort_matches_prepare_person(persons):
+    """Test that bulk preparation gives the same sequences as prepare_person."""
+    cohort = prepare_cohort(persons)
+    prepared_data = {person['person_id']: prepare_person(person) for person in persons}
+
+    assert len(cohort) == len(persons)
+    assert cohort.n_features == 2
+    assert cohort.ids.tolist() == list(prepared_data.keys())
+    for i, records in enumerate(prepared_data.values()):
+        times, nutrients, sq_norms = cohort.person(i)
+        assert times.tolist() == list(records.keys())
+        assert np.allclose(nutrients, np.array(list(records.values())))
+        assert np.allclose(sq_norms, np.sum(nutrients ** 2, axis=1))
+
+
+def test_from_prepared_round_trip(persons):
+    """Test that packing prepared data and unpacking it is lossless."""
+    prepared_data = {person['person_id']: prepare_person(person) for person in persons}
+    cohort = PackedCohort.from_prepared(prepared_data)
+
+    assert cohort.to_prepared() == prepared_data
+    assert cohort.index_of('person_3') == 2
+
+
+def test_subset(persons):
+    """Test that a subset keeps the selected persons' events in the given order."""
+    cohort = prepare_cohort(persons)
+    subset = cohort.subset([5, 0, 3])
+
+    assert subset.ids.tolist() == ['person_6', 'person_1', 'person_4']
+    for k, i in enumerate([5, 0, 3]):
+        assert subset.events(k) == cohort.events(i)
+
+
+@pytest.mark.parametrize("records", [
+    [{'time': 8, 'nutrients': [100]}, {'time': 13, 'nutrients': [200, 300]}],
+    [{'time': 8, 'nutrients': [0, 100]}],
+    [],
+])
+def test_prepare_cohort_gives_error(records):
+    with pytest.raises(ValueError):
+        prepare_cohort([{'person_id': 'person_1', 'records': records}])
+
+
+def test_distance_matrix_accepts_packed(persons):
+    """Test that the packed and dictionary forms give the same distance matrix."""
+    prepared_data = {person['person_id']: prepare_person(person) for person in persons}
+    cohort = prepare_cohort(persons)
+
+    expected = calculate_distance_matrix(prepared_data, mdtw_distance_optimized)
+    assert np.allclose(calculate_distance_matrix(cohort), expected)
+    assert np.allclose(calculate_distance_matrix(prepared_data), expected)
+    assert np.allclose(calculate_distance_matrix(cohort, mdtw_distance_optimized), expected)
+    assert np.isclose(mdtw_distance_packed(cohort, 1, 4), expected[1, 4])
+
+
+def test_concat_save_and_load(persons, tmp_path):
+    """Test that concatenating and reloading keep every person's events."""
+    cohort = prepare_cohort(persons[:3]).concat(prepare_cohort(persons[3:]))
+    cohort.save(str(tmp_path / "cohort.npz"))
+    loaded = PackedCohort.load(str(tmp_path / "cohort.npz"))
+
+    assert loaded.to_prepared() == prepare_cohort(persons).to_prepared()
+    assert len(prepare_cohort([]).concat(cohort)) == len(persons)
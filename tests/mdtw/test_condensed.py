@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.condensed import CondensedDistanceMatrix, condensed_index, n_from_condensed_size
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+
+
+@pytest.fixture
+def cohort():
+    """Generate a packed cohort for testing."""
+    return prepare_cohort(generate_synthetic_data(num_people=13, min_meals=1, max_meals=5))
+
+
+@pytest.mark.parametrize("n", [2, 5, 13])
+def test_condensed_index_matches_triu_order(n):
+    """Test that the condensed index follows the scipy squareform layout."""
+    rows, cols = np.triu_indices(n, 1)
+    assert [condensed_index(n, i, j) for i, j in zip(rows, cols)] == list(range(len(rows)))
+    assert n_from_condensed_size(len(rows)) == n
+
+
+def test_invalid_condensed_size():
+    with pytest.raises(ValueError):
+        n_from_condensed_size(4)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_condensed_matches_dense(cohort, dtype):
+    """Test that the condensed output holds the upper triangle of the dense matrix."""
+    dense = calculate_distance_matrix(cohort)
+    condensed = calculate_distance_matrix(cohort, condensed=True, dtype=dtype, tile_size=4)
+
+    assert condensed.dtype == dtype
+    assert np.asarray(condensed).shape == (13 * 12 // 2,)
+    assert np.allclose(condensed.to_dense(), dense, rtol=1e-6)
+    assert np.allclose(condensed.row(4), dense[4], rtol=1e-6)
+    assert np.allclose(condensed.rows([12, 0, 4]), dense[[12, 0, 4]], rtol=1e-6)
+    assert np.isclose(condensed[7, 2], dense[7, 2], rtol=1e-6)
+    assert condensed[3, 3] == 0
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_condensed_memmap(cohort, tmp_path, n_jobs):
+    """Test that the condensed matrix can be streamed into a memory-mapped file and reopened."""
+    path = str(tmp_path / "distances.f32")
+    dense = calculate_distance_matrix(cohort)
+    calculate_distance_matrix(cohort, condensed=True, dtype=np.float32, path=path, n_jobs=n_jobs, tile_size=4)
+
+    reopened = CondensedDistanceMatrix.open(path, dtype=np.float32)
+    assert len(reopened) == 13
+    assert np.allclose(reopened.to_dense(), dense, rtol=1e-6)
+
+
+def test_dense_memmap_gives_error(cohort, tmp_path):
+    with pytest.raises(ValueError):
+        calculate_distance_matrix(cohort, path=str(tmp_path / "distances.f64"))
@@ -0,0 +1,69 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.dedup import canonicalize, quantize_cohort, calculate_deduplicated_distance_matrix
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+
+
+@pytest.fixture
+def cohort():
+    """Generate a cohort in which many persons share the same eating record."""
+    data = generate_synthetic_data(num_people=8, min_meals=1, max_meals=4)
+    persons = []
+    for k in range(30):
+        source = data[k % 8]
+        records = [{'time': r['time'], 'nutrients': [r['nutrients'][0] * (1 + k % 3)]} for r in source['records']]
+        persons.append({'person_id': f'copy_{k}', 'records': records})
+    return prepare_cohort(persons)
+
+
+def test_canonicalize_groups_identical_sequences(cohort):
+    """Test that scaled copies normalize to the same sequence and share a representative."""
+    unique, inverse = canonicalize(cohort)
+
+    assert len(unique) <= 8
+    assert unique.ids[0] == 'copy_0'
+    for i in range(len(cohort)):
+        assert unique.events(inverse[i]) == pytest.approx(cohort.events(i))
+
+
+def test_hash_collisions_do_not_merge(cohort, monkeypatch):
+    """Test that persons sharing a hash are only merged when their sequences are equal."""
+    expected_unique, expected_inverse = canonicalize(cohort)
+    monkeypatch.setattr('data.utils.dedup.cohort_hashes', lambda packed: np.zeros(len(packed), dtype=np.uint64))
+    unique, inverse = canonicalize(cohort)
+
+    assert unique.ids.tolist() == expected_unique.ids.tolist()
+    assert inverse.tolist() == expected_inverse.tolist()
+
+
+def test_deduplicated_matrix_matches_full(cohort):
+    """Test that the expanded matrix equals the matrix over every person."""
+    expected = calculate_distance_matrix(cohort, delta=5)
+    matrix = calculate_deduplicated_distance_matrix(cohort.to_prepared(), delta=5)
+
+    assert matrix.group_sizes.sum() == len(cohort)
+    assert np.allclose(matrix.to_dense(), expected)
+    assert np.allclose(matrix.to_condensed().to_dense(), expected)
+    assert np.allclose(matrix.row(11), expected[11])
+    assert np.isclose(matrix[3, 17], expected[3, 17])
+
+
+def test_quantization_merges_close_sequences():
+    persons = [
+        {'person_id': 'a', 'records': [{'time': 8.0, 'nutrients': [300]}, {'time': 13.0, 'nutrients': [700]}]},
+        {'person_id': 'b', 'records': [{'time': 8.2, 'nutrients': [301]}, {'time': 12.9, 'nutrients': [699]}]},
+        {'person_id': 'c', 'records': [{'time': 20.0, 'nutrients': [1000]}]},
+    ]
+    cohort = prepare_cohort(persons)
+
+    assert len(canonicalize(cohort)[0]) == 3
+    unique, inverse = canonicalize(cohort, time_resolution=1, nutrient_decimals=2)
+    assert len(unique) == 2
+    assert inverse.tolist() == [0, 0, 1]
+    assert quantize_cohort(cohort, time_resolution=0.5).times.tolist() == [8.0, 13.0, 8.0, 13.0, 20.0]
+
+    matrix = calculate_deduplicated_distance_matrix(cohort, time_resolution=1, nutrient_decimals=2)
+    assert matrix[0, 1] == 0
+    assert np.isclose(matrix[1, 2], calculate_distance_matrix(unique)[0, 1])
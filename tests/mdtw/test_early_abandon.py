@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.modified_mdtw import (mdtw_distance_optimized, mdtw_distance_packed, generate_synthetic_data)
+
+
+@pytest.fixture
+def sample_data():
+    """Generate sample event sequences for testing."""
+    ER1 = [(1, [0.2, 0.3, 0.5]), (3, [0.1, 0.4, 0.2]), (5, [0.3, 0.1, 0.4])]
+    ER2 = [(2, [0.3, 0.2, 0.4]), (4, [0.2, 0.3, 0.1]), (6, [0.4, 0.5, 0.2])]
+    return ER1 * 5, ER2 * 5
+
+
+def test_cutoff_above_distance_is_exact(sample_data):
+    """Test that a cutoff above the distance does not change the result."""
+    ER1, ER2 = sample_data
+    exact = mdtw_distance_optimized(ER1, ER2)
+
+    assert mdtw_distance_optimized(ER1, ER2, cutoff=exact * 1.01) == exact
+    assert mdtw_distance_optimized(ER1, ER2, cutoff=exact) == exact
+
+
+@pytest.mark.parametrize("fraction", [0.0, 0.1, 0.5, 0.99])
+def test_cutoff_below_distance_abandons(sample_data, fraction):
+    """Test that a cutoff below the distance returns infinity."""
+    ER1, ER2 = sample_data
+    exact = mdtw_distance_optimized(ER1, ER2)
+
+    assert mdtw_distance_optimized(ER1, ER2, cutoff=exact * fraction) == np.inf
+
+
+def test_cutoff_with_empty_sequence(sample_data):
+    ER1, _ = sample_data
+    exact = mdtw_distance_optimized(ER1, [])
+
+    assert mdtw_distance_optimized(ER1, [], cutoff=exact / 2) == np.inf
+    assert mdtw_distance_optimized(ER1, [], cutoff=exact) == exact
+
+
+def test_nearest_neighbour_with_running_cutoff():
+    """Test that a best-so-far search loop finds the same neighbour as a full scan."""
+    cohort = prepare_cohort(generate_synthetic_data(num_people=40, min_meals=1, max_meals=8))
+    distances = [mdtw_distance_packed(cohort, 0, j) for j in range(1, len(cohort))]
+
+    best = np.inf
+    for j in range(1, len(cohort)):
+        best = min(best, mdtw_distance_packed(cohort, 0, j, cutoff=best))
+
+    assert best == min(distances)
@@ -0,0 +1,112 @@
+import pytest
+import numpy as np
+
+from data.utils.condensed import CondensedDistanceMatrix
+from data.utils.evaluation import elbow, evaluate_clusterings, k_sweep
+from data.utils.kmedoids import fasterpam
+
+
+@pytest.fixture
+def D():
+    rng = np.random.default_rng(1)
+    points = np.concatenate([rng.normal(center, 1, (30, 2)) for center in [(0, 0), (6, 0), (0, 6)]])
+    return np.sqrt(((points[:, None] - points[None]) ** 2).sum(axis=-1))
+
+
+def _silhouette(D, labels):
+    """Straightforward mean silhouette, singleton clusters scoring 0."""
+    scores = []
+    for i in range(len(D)):
+        own = labels == labels[i]
+        if own.sum() == 1:
+            scores.append(0)
+            continue
+        a = D[i, own].sum() / (own.sum() - 1)
+        b = min(D[i, labels == c].mean() for c in np.unique(labels) if c != labels[i])
+        scores.append((b - a) / max(a, b))
+    return np.mean(scores)
+
+
+def _best_swap_change(D, medoids):
+    inertia = D[:, medoids].min(axis=1).sum()
+    changes = []
+    for j in range(len(medoids)):
+        for x in np.setdiff1d(np.arange(len(D)), medoids):
+            swapped = medoids.copy()
+            swapped[j] = x
+            changes.append(D[:, swapped].min(axis=1).sum() - inertia)
+    return min(changes)
+
+
+def test_statistics_match_direct_computation(D):
+    medoids = [np.array([0, 1, 2]), np.array([5, 40]), np.array([3, 33, 63, 64])]
+    for medoid, evaluation in zip(medoids, evaluate_clusterings(D, medoids, block_size=17)):
+        assert evaluation.k == len(medoid) and evaluation.n_evaluated == len(D)
+        assert np.array_equal(evaluation.labels, np.argmin(D[:, medoid], axis=1))
+        assert np.isclose(evaluation.inertia, D[:, medoid].min(axis=1).sum())
+        assert np.isclose(evaluation.silhouette, _silhouette(D, evaluation.labels))
+        assert evaluation.silhouette_interval[0] == evaluation.silhouette_interval[1] == evaluation.silhouette
+        assert np.isclose(evaluation.best_swap_change, _best_swap_change(D, medoid))
+        removal = [D[:, np.delete(medoid, j)].min(axis=1).sum() - evaluation.inertia for j in range(len(medoid))]
+        assert np.allclose(evaluation.removal_loss, removal)
+
+        j, x = evaluation.best_swap
+        swapped = medoid.copy()
+        swapped[j] = x
+        assert np.isclose(D[:, swapped].min(axis=1).sum() - evaluation.inertia, evaluation.best_swap_change)
+
+
+def test_storage_formats_agree(D, tmp_path):
+    medoids = [np.array([0, 40, 70]), np.array([10])]
+    expected = evaluate_clusterings(D, medoids)
+
+    condensed = CondensedDistanceMatrix.allocate(len(D), path=str(tmp_path / "condensed.bin"))
+    condensed.data[:] = D[np.triu_indices(len(D), 1)]
+    square = np.memmap(str(tmp_path / "square.bin"), dtype=np.float64, mode='w+', shape=D.shape)
+    square[:] = D
+    for storage in (condensed, condensed.data, square):
+        for a, b in zip(evaluate_clusterings(storage, medoids, block_size=8), expected):
+            assert np.array_equal(a.labels, b.labels) and np.isclose(a.inertia, b.inertia)
+            assert np.isclose(a.silhouette, b.silhouette, equal_nan=True) and a.best_swap == b.best_swap
+
+
+def test_k_sweep_and_elbow(D):
+    evaluations = k_sweep(D, [1, 2, 3, 4, 5], block_size=16)
+    assert [evaluation.k for evaluation in evaluations] == [1, 2, 3, 4, 5]
+    assert np.isnan(evaluations[0].silhouette)
+    # Without a cluster sample this is plain FasterPAM, which leaves no improving swap
+    assert all(evaluation.best_swap_change >= -1e-9 for evaluation in evaluations)
+    assert np.isclose(evaluations[2].inertia, fasterpam(D, 3)[2])
+    assert max(evaluations[1:], key=lambda evaluation: evaluation.silhouette).k == 3
+    assert elbow(evaluations) == 3
+    # A repeated k keeps its best inertia and does not move the elbow
+    assert elbow(evaluations + k_sweep(D, [5, 1], cluster_size=40, random_state=0)) == 3
+
+    sampled = k_sweep(D, [3], cluster_size=40, random_state=0)[0]
+    assert sampled.inertia >= evaluations[2].inertia - 1e-9
+
+
+def test_sampled_silhouette_interval(D):
+    medoids = k_sweep(D, [3])[0].medoids
+    exact = evaluate_clusterings(D, [medoids])[0]
+    estimate = evaluate_clusterings(D, [medoids], sample_size=40, random_state=0)[0]
+    assert estimate.n_evaluated == 40 and estimate.inertia == exact.inertia
+    low, high = estimate.silhouette_interval
+    assert low < estimate.silhouette < high and low <= exact.silhouette <= high
+
+
+@pytest.mark.parametrize("medoids", [[[]], [[0, 0]], [[90]], [[-1, 3]]])
+def test_invalid_medoids_give_error(D, medoids):
+    with pytest.raises(ValueError):
+        evaluate_clusterings(D, medoids)
+
+
+def test_invalid_inputs_give_error(D):
+    with pytest.raises(ValueError):
+        evaluate_clusterings(D[:, :10], [[0]])
+    with pytest.raises(ValueError):
+        k_sweep(D, [0])
+    with pytest.raises(ValueError):
+        elbow(k_sweep(D, [2]))
+    with pytest.raises(ValueError):
+        elbow(k_sweep(D, [2, 2]))
@@ -0,0 +1,98 @@
+import pytest
+import numpy as np
+
+from data.utils.fast_mdtw import _windowed_dp, coarsen, fast_mdtw, mdtw_distance_fast
+from data.utils.modified_mdtw import local_distance, mdtw_distance, mdtw_distance_optimized, mdtw_distance_vectorized
+
+
+def random_sequence(rng, m, dim):
+    times = np.sort(rng.uniform(0, 24 * m / 5, m))
+    return [(float(t), list(v)) for t, v in zip(times, rng.uniform(0, 1, (m, dim)))]
+
+
+def test_coarsen_keeps_mass_and_order():
+    t = np.array([0.0, 1.0, 2.0, 4.0, 7.0])
+    V = np.array([[0.1, 0.0], [0.3, 0.0], [0.0, 0.0], [0.0, 0.0], [0.2, 0.4]])
+    times, nutrients = coarsen(t, V)
+
+    assert np.allclose(nutrients.sum(axis=0), V.sum(axis=0))
+    assert np.allclose(times, [0.75, 3.0, 7.0])
+
+
+def test_full_window_path_is_optimal():
+    """Test that the path recovered by the windowed DP has the optimal cost."""
+    rng = np.random.default_rng(0)
+    ER1, ER2 = random_sequence(rng, 9, 2), random_sequence(rng, 6, 2)
+    t1, V1 = np.array([t for t, _ in ER1]), np.array([v for _, v in ER1])
+    t2, V2 = np.array([t for t, _ in ER2]), np.array([v for _, v in ER2])
+    sq1, sq2 = np.sum(V1 ** 2, axis=1), np.sum(V2 ** 2, axis=1)
+    lo, hi = np.zeros(10, dtype=np.int64), np.full(10, 6, dtype=np.int64)
+    distance, path, _ = _windowed_dp(t1, V1, sq1, t2, V2, sq2, lo, hi, 23, 1, 2)
+
+    assert np.isclose(distance, mdtw_distance(ER1, ER2))
+    assert path[0].tolist() == [0, 0] and path[-1].tolist() == [9, 6]
+    steps = np.diff(path, axis=0)
+    assert {tuple(step) for step in steps} <= {(1, 1), (1, 0), (0, 1)}
+    cost = 0.0
+    for (i, j), (di, dj) in zip(path[1:], steps):
+        if di and dj:
+            cost += local_distance(ER1[i - 1], ER2[j - 1])
+        else:
+            cost += sq1[i - 1] if di else sq2[j - 1]
+    assert np.isclose(cost, distance)
+
+
+@pytest.mark.parametrize("m1,m2", [(40, 40), (57, 23), (130, 99)])
+def test_fast_mdtw_bounds_the_exact_distance(m1, m2):
+    rng = np.random.default_rng(m1)
+    ER1, ER2 = random_sequence(rng, m1, 3), random_sequence(rng, m2, 3)
+    exact = mdtw_distance_optimized(ER1, ER2)
+    previous = np.inf
+    for radius in (0, 1, 4):
+        result = mdtw_distance_fast(ER1, ER2, radius=radius, tight_bound=True)
+        assert result.distance >= exact - 1e-9
+        assert result.lower_bound <= exact + 1e-9
+        assert np.isclose(result.error_bound, result.distance - result.lower_bound)
+        assert result.distance - exact <= result.error_bound + 1e-9
+        previous = result.distance
+    assert previous <= 1.05 * exact
+
+
+def test_large_radius_is_exact():
+    rng = np.random.default_rng(3)
+    ER1, ER2 = random_sequence(rng, 50, 2), random_sequence(rng, 31, 2)
+    result = mdtw_distance_fast(ER1, ER2, radius=50)
+    assert np.isclose(result.distance, mdtw_distance_optimized(ER1, ER2))
+
+
+def test_fast_mdtw_with_time_band():
+    rng = np.random.default_rng(4)
+    ER1, ER2 = random_sequence(rng, 60, 2), random_sequence(rng, 45, 2)
+    exact = mdtw_distance_optimized(ER1, ER2, max_time_gap=3)
+    assert mdtw_distance_fast(ER1, ER2, radius=2, max_time_gap=3).distance >= exact - 1e-9
+    assert np.isclose(mdtw_distance_fast(ER1, ER2, radius=60, max_time_gap=3).distance, exact)
+
+
+def test_fast_mdtw_with_empty_sequence():
+    rng = np.random.default_rng(5)
+    ER1 = random_sequence(rng, 10, 2)
+    result = mdtw_distance_fast(ER1, [])
+    assert result.distance == mdtw_distance_optimized(ER1, []) and result.error_bound == 0
+
+
+def test_fast_mdtw_checks_inputs():
+    with pytest.raises(ValueError):
+        mdtw_distance_fast([(1, [1.5])], [(2, [0.5])])
+    with pytest.raises(ValueError):
+        fast_mdtw(np.zeros(1), np.zeros((1, 1)), np.zeros(1), np.zeros((1, 1)), radius=-1)
+
+
+def test_fast_mdtw_evaluates_fewer_cells():
+    rng = np.random.default_rng(6)
+    ER1, ER2 = random_sequence(rng, 400, 2), random_sequence(rng, 400, 2)
+    t1, V1 = np.array([t for t, _ in ER1]), np.array([v for _, v in ER1])
+    t2, V2 = np.array([t for t, _ in ER2]), np.array([v for _, v in ER2])
+    result = fast_mdtw(t1, V1, t2, V2, radius=2)
+
+    assert result.n_cells < 400 * 400 / 3
+    assert result.distance >= mdtw_distance_vectorized(t1, V1, t2, V2) - 1e-9
@@ -0,0 +1,61 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.incremental import IncrementalDistanceMatrix
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data, prepare_person
+
+
+@pytest.fixture
+def persons():
+    """Generate raw synthetic persons."""
+    return generate_synthetic_data(num_people=20, min_meals=1, max_meals=6)
+
+
+def test_add_matches_full_build(persons):
+    """Test that adding persons in several steps gives the full matrix."""
+    matrix = IncrementalDistanceMatrix(delta=5, tile_size=3)
+    matrix.add(persons[:8])
+    matrix.add({person['person_id']: prepare_person(person) for person in persons[8:9]})
+    matrix.add(prepare_cohort(persons[9:]))
+
+    expected = calculate_distance_matrix(prepare_cohort(persons), delta=5)
+    assert matrix.ids == [person['person_id'] for person in persons]
+    assert np.allclose(matrix.matrix.to_dense(), expected)
+
+
+def test_remove_compacts(persons):
+    """Test that removing persons keeps the remaining pairs and the id mapping."""
+    matrix = IncrementalDistanceMatrix()
+    matrix.add(persons)
+    matrix.remove(['person_1', 'person_7', 'person_20'])
+
+    kept = [person for person in persons if person['person_id'] not in {'person_1', 'person_7', 'person_20'}]
+    expected = calculate_distance_matrix(prepare_cohort(kept))
+    assert len(matrix) == 17
+    assert matrix.index_of('person_8') == 5
+    assert np.allclose(matrix.matrix.to_dense(), expected)
+
+    matrix.add(persons[:1])
+    assert matrix.ids[-1] == 'person_1'
+    assert np.allclose(matrix.matrix.to_dense(), calculate_distance_matrix(prepare_cohort(kept + persons[:1])))
+
+
+def test_duplicate_ids_give_error(persons):
+    matrix = IncrementalDistanceMatrix()
+    matrix.add(persons[:5])
+    with pytest.raises(ValueError):
+        matrix.add(persons[4:6])
+    with pytest.raises(KeyError):
+        matrix.remove(['person_6'])
+
+
+def test_save_and_load(persons, tmp_path):
+    matrix = IncrementalDistanceMatrix(delta=4, max_time_gap=6)
+    matrix.add(persons[:10])
+    matrix.save(str(tmp_path / "matrix.npz"))
+
+    loaded = IncrementalDistanceMatrix.load(str(tmp_path / "matrix.npz"))
+    loaded.add(persons[10:])
+    assert (loaded.delta, loaded.max_time_gap) == (4, 6)
+    assert np.allclose(loaded.matrix.to_dense(), calculate_distance_matrix(prepare_cohort(persons), delta=4, max_time_gap=6))
@@ -0,0 +1,107 @@
+import csv
+import gzip
+import json
+import random
+import zlib
+import pytest
+import numpy as np
+
+from data.utils import ingest
+from data.utils.cohort import PackedCohort, prepare_cohort
+from data.utils.ingest import iter_persons, iter_prepared_persons, ingest_cohort
+from data.utils.modified_mdtw import generate_synthetic_data, prepare_person
+
+
+@pytest.fixture
+def persons():
+    data = generate_synthetic_data(num_people=25, min_meals=1, max_meals=6)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'].append(float(k + 1))
+    return data
+
+
+def _rows(persons):
+    return [{'person_id': person['person_id'], 'time': record['time'], 'calories': record['nutrients'][0], 'protein': record['nutrients'][1]}
+            for person in persons for record in person['records']]
+
+
+def _write(path, rows):
+    with (gzip.open(path, 'wt', newline='') if path.endswith('.gz') else open(path, 'w', newline='')) as file:
+        if '.jsonl' in path:
+            for row in rows:
+                file.write(json.dumps(row) + "\n")
+        else:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+@pytest.mark.parametrize("suffix", ["csv", "jsonl", "csv.gz", "jsonl.gz"])
+def test_sorted_input_matches_prepare_person(persons, tmp_path, suffix):
+    """Test that streamed persons equal prepare_person on the assembled records."""
+    path = str(tmp_path / f"events.{suffix}")
+    _write(path, _rows(persons))
+
+    prepared = dict(iter_prepared_persons(path))
+    assert prepared == {person['person_id']: prepare_person(person) for person in persons}
+
+
+def test_unsorted_input_is_spilled(persons, tmp_path):
+    """Test that shuffled rows are regrouped through the spill files."""
+    path = str(tmp_path / "events.csv")
+    rows = _rows(persons)
+    random.Random(0).shuffle(rows)
+    _write(path, rows)
+
+    with pytest.raises(ValueError):
+        list(iter_persons(path))
+    streamed = list(iter_persons(path, sorted_input=False, buffer_rows=20, n_partitions=4,
+                                 spill_dir=str(tmp_path)))
+    assert sorted(person['person_id'] for person in streamed) == sorted(person['person_id'] for person in persons)
+    assert {person['person_id']: prepare_person(person) for person in streamed} == \
+        {person['person_id']: prepare_person(person) for person in persons}
+
+
+@pytest.mark.parametrize("buffer_rows,n_partitions,levels", [(5, 2, None), (5, 1, [0, 1]), (1000, 2, [0])])
+def test_large_partitions_are_split_again(persons, tmp_path, monkeypatch, buffer_rows, n_partitions, levels):
+    """Test that spill files over buffer_rows are re-partitioned before being grouped in memory."""
+    path = str(tmp_path / "events.csv")
+    rows = _rows(persons)
+    random.Random(1).shuffle(rows)
+    _write(path, rows)
+
+    spills = []
+    spill = ingest._spill
+    monkeypatch.setattr(ingest, '_spill', lambda *args: spills.append(args[-1]) or spill(*args))
+    streamed = list(iter_persons(path, sorted_input=False, buffer_rows=buffer_rows, n_partitions=n_partitions,
+                                 spill_dir=str(tmp_path)))
+    assert {person['person_id']: prepare_person(person) for person in streamed} == \
+        {person['person_id']: prepare_person(person) for person in persons}
+    # Small buffers need several levels; a split that separates nothing is not repeated
+    assert max(spills) > 1 if levels is None else spills == levels
+    assert ingest._partition('person_7', 64, 0) == zlib.crc32(b'person_7') % 64
+
+
+def test_ingest_cohort_writes_packed_cohort(persons, tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    _write(path, _rows(persons))
+
+    cohort = ingest_cohort(path, str(tmp_path / "cohort"), batch_size=4, nutrient_columns=['calories', 'protein'])
+    expected = prepare_cohort(persons)
+    assert isinstance(cohort.times.base, np.memmap)
+    assert cohort.ids.tolist() == expected.ids.tolist()
+    assert np.array_equal(cohort.offsets, expected.offsets)
+    assert np.allclose(cohort.nutrients, expected.nutrients)
+    assert np.allclose(PackedCohort.open(str(tmp_path / "cohort")).sq_norms, expected.sq_norms)
+
+
+def test_invalid_person_gives_error(tmp_path):
+    path = str(tmp_path / "events.csv")
+    _write(path, [{'person_id': 'a', 'time': 8, 'calories': 0}, {'person_id': 'a', 'time': 9, 'calories': 0}])
+    with pytest.raises(ValueError):
+        list(iter_prepared_persons(path))
+    with pytest.raises(ValueError):
+        ingest_cohort(path, str(tmp_path / "cohort"))
+    with pytest.raises(ValueError):
+        list(iter_persons(str(tmp_path / "events.txt")))
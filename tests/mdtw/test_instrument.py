@@ -0,0 +1,74 @@
+import json
+import pytest
+import numpy as np
+
+from data.utils.cache import DistanceCache
+from data.utils.cohort import PackedCohort
+from data.utils.instrument import JobStats, JsonLinesLogger
+from data.utils.knn import MDTWIndex
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data, prepare_person
+
+
+@pytest.fixture
+def prepared_data():
+    data = generate_synthetic_data(num_people=30, min_meals=1, max_meals=6)
+    return {person['person_id']: prepare_person(person) for person in data}
+
+
+def _expected_cells(prepared_data):
+    lengths = np.array([len(records) for records in prepared_data.values()])
+    return int((lengths.sum() ** 2 - np.sum(lengths ** 2)) // 2)
+
+
+@pytest.mark.parametrize("n_jobs,backend", [(1, 'loky'), (2, 'threading'), (2, 'loky')])
+def test_counters_and_phases(prepared_data, n_jobs, backend):
+    """Test that every pair and DP cell is counted once, whatever the workers."""
+    reports = []
+    stats = JobStats(progress=lambda *report: reports.append(report), interval=0)
+    matrix = calculate_distance_matrix(prepared_data, n_jobs=n_jobs, tile_size=8, backend=backend, stats=stats)
+
+    assert np.allclose(matrix, calculate_distance_matrix(prepared_data))
+    summary = stats.as_dict()
+    assert summary['pairs'] == summary['total_pairs'] == 30 * 29 // 2
+    assert summary['dp_cells'] == _expected_cells(prepared_data)
+    assert set(summary['phases']) == {'prepare', 'kernel', 'write'}
+    assert reports[-1][:2] == (435, 435)
+    assert all(done <= total for done, total, _ in reports)
+
+
+def test_cache_counters_and_export(prepared_data, tmp_path):
+    cache = DistanceCache(str(tmp_path / "cache.sqlite"))
+    calculate_distance_matrix(prepared_data, cache=cache)
+
+    log = str(tmp_path / "stats.jsonl")
+    stats = JobStats(export=JsonLinesLogger(log))
+    calculate_distance_matrix(prepared_data, cache=cache, condensed=True, stats=stats)
+
+    assert stats.counters['cache_hits'] == 435
+    assert stats.counters['cache_misses'] == 0
+    assert stats.counters['dp_cells'] == 0
+    with open(log) as file:
+        records = [json.loads(line) for line in file]
+    assert records[-1]['event'] == 'done'
+    assert records[-1]['cache_hits'] == 435
+
+
+def test_knn_counters(prepared_data):
+    index = MDTWIndex(PackedCohort.from_prepared(prepared_data))
+    stats = JobStats()
+    results = index.query_batch(prepared_data, k=3, stats=stats)
+
+    assert stats.total_pairs == stats.counters['pairs'] == 30 * 30
+    assert stats.counters['pairs_pruned'] == sum(result.n_pruned for result in results)
+    assert stats.counters['pairs_skipped'] == sum(result.n_skipped for result in results)
+    assert stats.counters['pairs_abandoned'] == sum(result.n_abandoned for result in results)
+
+
+def test_phase_accumulates():
+    stats = JobStats()
+    with stats.phase('kernel'):
+        pass
+    with stats.phase('kernel'):
+        pass
+    assert list(stats.as_dict()['phases']) == ['kernel']
+    assert stats.as_dict()['pairs_per_second'] == 0
@@ -0,0 +1,78 @@
+import itertools
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.kmedoids import fasterpam, clara, LazyDistances
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+
+
+@pytest.fixture
+def cohort():
+    return prepare_cohort(generate_synthetic_data(num_people=200, min_meals=1, max_meals=6))
+
+
+def test_fasterpam_finds_optimum():
+    """Test that FasterPAM reaches the exhaustive optimum on a small problem."""
+    points = np.random.default_rng(0).normal(size=(12, 2))
+    D = np.linalg.norm(points[:, None] - points[None], axis=2)
+    medoids, labels, cost = fasterpam(D, 3)
+
+    optimum = min(D[:, list(m)].min(axis=1).sum() for m in itertools.combinations(range(12), 3))
+    assert np.isclose(cost, optimum)
+    assert np.isclose(D[np.arange(12), medoids[labels]].sum(), cost)
+
+
+def test_clara_small_cohort_is_exact(cohort):
+    """Test that a cohort no larger than the sample is clustered with one full matrix."""
+    small = cohort.subset(np.arange(30))
+    D = calculate_distance_matrix(small)
+    result = clara(small, 3, sample_size=30)
+
+    assert np.isclose(result.inertia, fasterpam(D, 3)[2])
+    assert result.medoid_ids == small.ids[result.medoids].tolist()
+    assert np.isclose(D[np.arange(30), result.medoids[result.labels]].sum(), result.inertia)
+
+
+def test_clara_uses_few_distances(cohort):
+    """Test that sampling stays close to full FasterPAM with a fraction of the pairs."""
+    D = calculate_distance_matrix(cohort)
+    result = clara(cohort, 4, n_samples=3, random_state=0)
+
+    n = len(cohort)
+    assert result.n_distance_calls < n * (n - 1) // 2 / 2
+    assert result.inertia <= 1.25 * fasterpam(D, 4)[2]
+    assert len(result.labels) == n
+    assert np.allclose(D[np.arange(n), result.medoids[result.labels]], D[:, result.medoids].min(axis=1))
+
+
+@pytest.mark.parametrize("n_clusters", [3, 8])
+def test_clara_inertia_is_close_to_fasterpam(cohort, n_clusters):
+    """Test that the default sample size and final swap pass stay close to FasterPAM on the full matrix."""
+    D = calculate_distance_matrix(cohort)
+    reference = fasterpam(D, n_clusters)[2]
+    for random_state in range(3):
+        result = clara(cohort, n_clusters, random_state=random_state)
+        assert result.inertia <= 1.12 * reference
+        assert np.isclose(result.inertia, D[:, result.medoids].min(axis=1).sum())
+
+
+def test_lazy_distances_cache_is_bounded(cohort):
+    distances = LazyDistances(cohort, max_cached_rows=2)
+    row = distances.row(5)
+    distances.row(5)
+    assert distances.n_calls == len(cohort) - 1
+    distances.row(6)
+    distances.row(7)
+    distances.row(5)
+    assert distances.n_calls == 4 * (len(cohort) - 1)
+    assert row[5] == 0
+
+
+def test_clara_gives_error(cohort):
+    with pytest.raises(ValueError):
+        clara(cohort, 0)
+    with pytest.raises(ValueError):
+        clara(cohort, 3, n_samples=0)
+    with pytest.raises(ValueError):
+        clara(cohort, 3, sample_size=2)
@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.knn import MDTWIndex
+from data.utils.modified_mdtw import generate_synthetic_data, prepare_person, mdtw_distance_optimized, events_to_arrays, mdtw_distance_batch
+
+
+@pytest.fixture
+def reference():
+    """Generate a reference cohort and separate query persons."""
+    data = generate_synthetic_data(num_people=80, min_meals=1, max_meals=6)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'].append(float((k * 7 + record['time']) % 11 + 1))
+    return prepare_cohort(data[:60]), [prepare_person(person) for person in data[60:]]
+
+
+@pytest.mark.parametrize("k", [1, 3, 10])
+def test_query_matches_brute_force(reference, k):
+    """Test that the index returns the same neighbours as a full scan."""
+    cohort, queries = reference
+    index = MDTWIndex(cohort, delta=4)
+
+    for query in queries:
+        distances = np.array([mdtw_distance_optimized(list(query.items()), cohort.events(i), delta=4) for i in range(len(cohort))])
+        result = index.query(query, k=k)
+
+        assert np.allclose(result.distances, np.sort(distances)[:k])
+        assert np.allclose([distances[cohort.index_of(person_id)] for person_id in result.ids], result.distances)
+        assert result.n_pruned + result.n_abandoned + result.n_computed == len(cohort)
+
+
+def test_query_prunes_candidates(reference):
+    """Test that bounds and early abandoning avoid most full DPs."""
+    cohort, queries = reference
+    results = MDTWIndex(cohort, delta=4).query_batch(queries, k=1)
+
+    assert len(results) == len(queries)
+    assert sum(result.n_computed for result in results) < 0.5 * len(queries) * len(cohort)
+
+
+def test_query_skips_most_persons():
+    """Test that the tree bounds skip most of a larger cohort without losing neighbours."""
+    data = generate_synthetic_data(num_people=2010)
+    cohort = prepare_cohort(data[:2000])
+    index = MDTWIndex(cohort)
+    times, nutrients, sq_norms, lengths = cohort.padded()
+
+    for query in map(prepare_person, data[2000:]):
+        t, V = events_to_arrays(list(query.items()))
+        sq = np.einsum('ij,ij->i', V, V)
+        distances = mdtw_distance_batch(t, V, times, nutrients, lengths, 23, 1, 2, sq, sq_norms)
+        result = index.query(query, k=5)
+
+        assert np.allclose(result.distances, np.sort(distances)[:5])
+        assert result.n_skipped <= result.n_pruned
+        assert result.n_skipped > 0.5 * len(cohort)
+
+
+def test_query_finds_itself(reference):
+    cohort, _ = reference
+    index = MDTWIndex(cohort.to_prepared())
+
+    result = index.query(cohort.events(5), k=1)
+    assert result.ids == [cohort.ids[5]]
+    assert result.distances[0] == 0
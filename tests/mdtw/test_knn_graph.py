@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.instrument import JobStats
+from data.utils.knn import MDTWIndex, knn_graph
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+
+
+@pytest.fixture
+def cohort():
+    persons = generate_synthetic_data(num_people=40, min_meals=1, max_meals=6)
+    # An exact duplicate, so zero distances between different persons occur
+    persons.append({'person_id': 'copy', 'records': persons[0]['records']})
+    return prepare_cohort(persons)
+
+
+@pytest.mark.parametrize("k", [1, 4])
+def test_kneighbors_match_dense_matrix(cohort, k):
+    D = calculate_distance_matrix(cohort)
+    distances, indices = MDTWIndex(cohort).kneighbors(k)
+
+    assert distances.shape == indices.shape == (len(cohort), k)
+    for i in range(len(cohort)):
+        assert i not in indices[i]
+        assert np.allclose(distances[i], np.sort(np.delete(D[i], i))[:k])
+        assert np.allclose(D[i, indices[i]], distances[i])
+
+
+def test_duplicates_are_neighbours(cohort):
+    distances, indices = MDTWIndex(cohort).kneighbors(2)
+    last = len(cohort) - 1
+    assert indices[0, 0] == last and indices[last, 0] == 0
+    assert distances[0, 0] == distances[last, 0] == 0
+
+
+def test_kneighbors_prune_and_parallelize(cohort):
+    index = MDTWIndex(cohort)
+    stats = JobStats()
+    distances, indices = index.kneighbors(3, stats=stats)
+    assert stats.counters['pairs_pruned'] + stats.counters['pairs_abandoned'] > 0
+    assert stats.counters['pairs'] == len(cohort) ** 2
+
+    parallel_distances, parallel_indices = index.kneighbors(3, n_jobs=2, block_size=7)
+    assert np.array_equal(parallel_indices, indices) and np.allclose(parallel_distances, distances)
+
+
+@pytest.mark.parametrize("k", [0, 41])
+def test_invalid_k_gives_error(cohort, k):
+    with pytest.raises(ValueError):
+        MDTWIndex(cohort).kneighbors(k)
+
+
+def test_knn_graph_is_csr(cohort):
+    pytest.importorskip("scipy")
+    graph = knn_graph(cohort, 3)
+    distances, indices = MDTWIndex(cohort).kneighbors(3)
+    n = len(cohort)
+
+    assert graph.format == 'csr' and graph.shape == (n, n) and graph.nnz == 3 * n
+    assert np.array_equal(graph.indptr, np.arange(0, 3 * n + 1, 3))
+    assert np.array_equal(graph.indices.reshape(n, 3), indices) and np.allclose(graph.data.reshape(n, 3), distances)
+    # The duplicate's zero distance is stored explicitly
+    assert graph[0, n - 1] == 0 and graph.indices[0] == n - 1
@@ -1,4 +1,4 @@
-from data.utils.modified_mdtw  import local_distance
+from data.utils.modified_mdtw  import local_distance, local_cost_matrix
 import pytest
 import numpy as np
 
@@ -50,5 +50,13 @@ def test_local_distance_skipped_meals(pair1, pair2):
     with pytest.raises(ValueError):
         local_distance(pair1, pair2)
 
-    
-    
\ No newline at end of file
+
+def test_local_cost_matrix_matches_local_distance():
+    rng = np.random.default_rng(0)
+    t1, V1 = rng.uniform(0, 24, 4), rng.uniform(0, 1, (4, 3))
+    t2, V2 = rng.uniform(0, 24, 6), rng.uniform(0, 1, (6, 3))
+    costs = local_cost_matrix(t1, V1, t2, V2, delta=10, beta=2, alpha=1)
+    for i in range(4):
+        for j in range(6):
+            expected = local_distance((t1[i], V1[i]), (t2[j], V2[j]), delta=10, beta=2, alpha=1)
+            assert np.isclose(costs[i, j], expected), f"Mismatch at ({i}, {j})"
@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+
+from data.utils.modified_mdtw import (mdtw_distance_vectorized, mdtw_lower_bound, lb_mass, lb_norms, lb_time)
+
+
+def random_sequence(rng, m, dim, normalized):
+    times = rng.uniform(0, 24, m)
+    nutrients = rng.uniform(0, 1, (m, dim))
+    if normalized:
+        nutrients /= nutrients.sum(axis=0)
+    return times, nutrients
+
+
+@pytest.mark.parametrize("normalized", [True, False])
+@pytest.mark.parametrize("delta, beta, alpha", [(23, 1, 2), (3, 1, 1), (2, 0.3, 0.5)])
+def test_bounds_never_exceed_distance(normalized, delta, beta, alpha):
+    """Test that every lower bound stays below the exact distance."""
+    rng = np.random.default_rng(7)
+    for _ in range(40):
+        m1, m2 = rng.integers(0, 12, size=2)
+        t1, V1 = random_sequence(rng, m1, 2, normalized)
+        t2, V2 = random_sequence(rng, m2, 2, normalized)
+        sq1, sq2 = np.sum(V1 ** 2, axis=1), np.sum(V2 ** 2, axis=1)
+        exact = mdtw_distance_vectorized(t1, V1, t2, V2, delta, beta, alpha)
+
+        for bound in (lb_mass(V1, V2), lb_norms(sq1, sq2), lb_time(t1, sq1, t2, sq2, delta, beta, alpha),
+                      mdtw_lower_bound(t1, V1, t2, V2, delta, beta, alpha)):
+            assert bound <= exact + 1e-9, f"Bound {bound} exceeds distance {exact}"
+        assert mdtw_lower_bound(t1, V1, t2, V2, delta, beta, alpha) <= \
+            mdtw_distance_vectorized(t1, V1, t2, V2, delta, beta, alpha, max_time_gap=1) + 1e-9
+
+
+def test_bounds_are_tight_for_empty_sequence():
+    V = np.array([[0.2, 0.5], [0.8, 0.5]])
+    t = np.array([8.0, 12.0])
+    empty = np.zeros((0, 2))
+    exact = mdtw_distance_vectorized(t, V, np.zeros(0), empty)
+
+    assert np.isclose(lb_mass(V, empty), exact)
+    assert np.isclose(lb_norms(np.sum(V ** 2, axis=1), np.zeros(0)), exact)
+
+
+def test_time_bound_separates_distant_meals():
+    """Test that the time bound sees meals that are too far apart to match."""
+    V = np.array([[1.0]])
+    sq = np.array([1.0])
+    t1, t2 = np.array([6.0]), np.array([20.0])
+    exact = mdtw_distance_vectorized(t1, V, t2, V, delta=4)
+
+    assert lb_norms(sq, sq) == 0
+    assert np.isclose(lb_time(t1, sq, t2, sq, delta=4), exact)
+
+
+def test_cascade_stops_at_cutoff():
+    rng = np.random.default_rng(8)
+    t1, V1 = random_sequence(rng, 6, 3, False)
+    t2, V2 = random_sequence(rng, 9, 3, False)
+    full = mdtw_lower_bound(t1, V1, t2, V2)
+
+    assert mdtw_lower_bound(t1, V1, t2, V2, cutoff=-1) <= full
+    assert mdtw_lower_bound(t1, V1, t2, V2, cutoff=full * 2) == full
@@ -1,7 +1,9 @@
 import pytest
+import tracemalloc
 import numpy as np
 
-from data.utils.modified_mdtw import (mdtw_distance,mdtw_distance_optimized)
+from data.utils.modified_mdtw import (mdtw_distance,mdtw_distance_optimized,
+                                      mdtw_distance_vectorized, events_to_arrays)
 
 
 # Test data
@@ -52,6 +54,22 @@ def test_correctness_with_original(sample_data):
         f"Original: {original_dist}, Optimized: {optimized_dist}"
 
 
+@pytest.mark.parametrize("m1, m2, dim", [(1, 7, 1), (5, 5, 3), (12, 4, 2), (20, 30, 4)])
+def test_vectorized_matches_original(m1, m2, dim):
+    """Test that the vectorized kernel agrees with the cell-by-cell reference."""
+    rng = np.random.default_rng(m1 * 100 + m2)
+    ER1 = [(float(t), list(v)) for t, v in zip(np.sort(rng.uniform(0, 24, m1)), rng.uniform(0, 1, (m1, dim)))]
+    ER2 = [(float(t), list(v)) for t, v in zip(np.sort(rng.uniform(0, 24, m2)), rng.uniform(0, 1, (m2, dim)))]
+
+    expected = mdtw_distance(ER1, ER2, delta=5, beta=0.5, alpha=1.5)
+    t1, V1 = events_to_arrays(ER1)
+    t2, V2 = events_to_arrays(ER2)
+
+    assert np.isclose(mdtw_distance_optimized(ER1, ER2, delta=5, beta=0.5, alpha=1.5), expected)
+    assert np.isclose(mdtw_distance_vectorized(t1, V1, t2, V2, delta=5, beta=0.5, alpha=1.5), expected)
+    assert np.isclose(mdtw_distance_vectorized(t2, V2, t1, V1, delta=5, beta=0.5, alpha=1.5), expected)
+
+
 def test_with_numpy_arrays(numpy_sample_data):
     """Test that function handles numpy arrays correctly."""
     ER1, ER2 = numpy_sample_data
@@ -173,37 +191,32 @@ def test_performance(sample_data, benchmark):
     assert isinstance(result, float) or isinstance(result, np.float32) or isinstance(result, np.float64)
     assert result >= 0
 
+def _peak_bytes(function, *args):
+    """Peak memory traced by tracemalloc during one call, NumPy buffers included."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
 def test_memory_usage(sample_data):
-    """Test memory usage (requires memory_profiler)."""
-    # This test is commented out as it requires the memory_profiler package
-    # If you want to run it, uncomment and install memory_profiler
+    """Test that the optimized kernel allocates less than the reference implementation."""
+    ER1, ER2 = sample_data
 
-    try:
-        from memory_profiler import memory_usage
-        import functools
-        
-        ER1, ER2 = sample_data
- 
-        # Create longer sequences for more meaningful memory measurement
-        long_ER1 = ER1 * 100
-        long_ER2 = ER2 * 100
-        
-        # Measure memory usage of original function
-        original_mem = max(memory_usage(
-            functools.partial(mdtw_distance, long_ER1, long_ER2)
-        ))
-        
-        # Measure memory usage of optimized function
-        optimized_mem = max(memory_usage(
-            functools.partial(mdtw_distance_optimized, long_ER1, long_ER2)
-        ))
-        
-        print(f"Original memory usage: {original_mem} MB")
-        print(f"Optimized memory usage: {optimized_mem} MB")
-        
-        # Check that optimized version uses less memory
-        assert optimized_mem < original_mem
-    except ImportError:
-        pytest.skip("memory_profiler not installed")
+    # Create longer sequences for more meaningful memory measurement
+    long_ER1 = ER1 * 100
+    long_ER2 = ER2 * 100
+
+    # Peak allocations do not depend on what the allocator kept from earlier tests, unlike RSS
+    original_mem = _peak_bytes(mdtw_distance, long_ER1, long_ER2)
+    optimized_mem = _peak_bytes(mdtw_distance_optimized, long_ER1, long_ER2)
+
+    print(f"Original peak allocation: {original_mem / 2 ** 20:.2f} MiB")
+    print(f"Optimized peak allocation: {optimized_mem / 2 ** 20:.2f} MiB")
+
+    # Check that optimized version uses less memory
+    assert optimized_mem < original_mem
 
     # # pass  # Placeholder for memory test
@@ -0,0 +1,44 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.parallel import upper_triangle_tiles, tile_pair_count
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data, mdtw_distance_optimized
+
+
+@pytest.fixture
+def cohort():
+    """Generate a packed cohort for testing."""
+    return prepare_cohort(generate_synthetic_data(num_people=23, min_meals=1, max_meals=6))
+
+
+@pytest.mark.parametrize("n, tile_size", [(0, 4), (1, 4), (10, 3), (23, 5), (16, 16), (7, 100)])
+def test_tiles_cover_upper_triangle_once(n, tile_size):
+    """Test that the tiles cover every pair i < j exactly once."""
+    covered = np.zeros((n, n), dtype=int)
+    tiles = upper_triangle_tiles(n, tile_size)
+    for r0, r1, c0, c1 in tiles:
+        for i in range(r0, r1):
+            for j in range(max(c0, i + 1), c1):
+                covered[i, j] += 1
+
+    assert (covered == np.triu(np.ones((n, n), dtype=int), 1)).all()
+    assert sum(tile_pair_count(tile) for tile in tiles) == n * (n - 1) // 2
+
+
+@pytest.mark.parametrize("backend", ["loky", "threading"])
+def test_parallel_matches_serial(cohort, backend):
+    """Test that the parallel build gives the same matrix as the serial one."""
+    expected = calculate_distance_matrix(cohort)
+    result = calculate_distance_matrix(cohort, n_jobs=2, tile_size=4, backend=backend)
+
+    assert np.array_equal(result, expected)
+
+
+def test_parallel_with_callback(cohort):
+    """Test that a user callback is run by process workers."""
+    prepared_data = cohort.to_prepared()
+    expected = calculate_distance_matrix(prepared_data, mdtw_distance_optimized)
+    result = calculate_distance_matrix(prepared_data, mdtw_distance_optimized, n_jobs=2, tile_size=6)
+
+    assert np.allclose(result, expected)
@@ -0,0 +1,95 @@
+import os
+import pytest
+import numpy as np
+
+from data.utils.cohort import PackedCohortWriter, prepare_cohort
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+from data.utils.shard import DistanceJob, main, run_local_workers
+
+
+@pytest.fixture
+def cohort():
+    return prepare_cohort(generate_synthetic_data(num_people=23, min_meals=1, max_meals=6))
+
+
+@pytest.fixture
+def expected(cohort):
+    return calculate_distance_matrix(cohort, delta=10, max_time_gap=12)
+
+
+def _create(directory, cohort, **kwargs):
+    return DistanceJob.create(str(directory), cohort, delta=10, max_time_gap=12, tile_size=5, **kwargs)
+
+
+def test_single_worker_job(tmp_path, cohort, expected):
+    job = _create(tmp_path / "job", cohort)
+    assert len(job) == len(DistanceJob(job.directory)) == 15
+    assert job.status() == {'units': 15, 'done': 0, 'claimed': 0, 'open': 15}
+
+    assert job.run_worker('worker') == 15
+    assert job.status()['done'] == 15 and job.run_worker('worker') == 0
+    assert np.allclose(job.merge(condensed=False), expected)
+
+    path = str(tmp_path / "matrix.bin")
+    job.merge(path)
+    assert np.allclose(np.memmap(path, dtype=np.float64), job.merge().data)
+
+
+def test_local_workers_share_the_units(tmp_path, cohort, expected):
+    job = _create(tmp_path / "job", cohort, dtype=np.float32)
+    assert run_local_workers(job.directory, 3) == len(job)
+    merged = job.merge()
+    assert merged.dtype == np.float32
+    assert np.allclose(merged.to_dense(), expected, rtol=1e-6)
+
+
+def test_job_resumes_after_crash(tmp_path, cohort, expected):
+    job = _create(tmp_path / "job", cohort)
+    assert job.run_worker('first', max_units=4) == 4
+    # A worker died holding two claims
+    assert job.claim(job.pending_units()[0], 'crashed') and job.claim(job.pending_units()[1], 'crashed')
+    with pytest.raises(ValueError):
+        job.merge()
+
+    assert job.run_worker('second') == len(job) - 6
+    assert job.status() == {'units': 15, 'done': 13, 'claimed': 2, 'open': 0}
+    assert job.run_worker('third', lease_seconds=0) == 2
+    assert np.allclose(job.merge(condensed=False), expected)
+
+
+def test_claims_are_exclusive_and_can_be_reset(tmp_path, cohort):
+    job = _create(tmp_path / "job", cohort)
+    assert job.claim(0, 'a') and not job.claim(0, 'b') and not job.claim(0, 'b', lease_seconds=3600)
+    assert job.claim(1, 'a')
+    assert job.reset_claims() == 2
+    assert job.claim(0, 'b')
+
+
+def test_job_from_cohort_directory_and_cli(tmp_path, cohort, expected, capsys):
+    cohort_directory = str(tmp_path / "cohort")
+    with PackedCohortWriter(cohort_directory) as writer:
+        writer.append(cohort)
+    directory = str(tmp_path / "job")
+    assert main(['create', directory, cohort_directory, '--delta', '10', '--max-time-gap', '12', '--tile-size', '7']) == 0
+    assert not os.path.exists(os.path.join(directory, "cohort"))
+    output = str(tmp_path / "matrix.bin")
+    assert main(['merge', directory, output]) == 1
+    assert main(['work', directory, '--worker-id', 'cli']) == 0
+    assert main(['status', directory]) == 0
+    assert main(['merge', directory, output]) == 0
+    assert '"done": 10' in capsys.readouterr().out
+    assert np.allclose(np.memmap(output, dtype=np.float64), np.asarray(calculate_distance_matrix(cohort, delta=10, max_time_gap=12,
+                                                                                                 condensed=True)))
+
+
+def test_job_with_weights(tmp_path, cohort):
+    W = np.array([2.0])
+    job = _create(tmp_path / "job", cohort, W=W)
+    job.run_worker('worker')
+    assert np.allclose(job.merge(condensed=False), calculate_distance_matrix(cohort, delta=10, max_time_gap=12, W=W))
+
+
+def test_existing_job_is_not_overwritten(tmp_path, cohort):
+    _create(tmp_path / "job", cohort)
+    with pytest.raises(ValueError):
+        _create(tmp_path / "job", cohort)
@@ -0,0 +1,47 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.condensed import CondensedDistanceMatrix
+from data.utils.sweep import parameter_grid, calculate_distance_matrix_sweep
+from data.utils.modified_mdtw import calculate_distance_matrix, generate_synthetic_data
+
+
+@pytest.fixture
+def cohort():
+    """Generate a packed cohort for testing."""
+    return prepare_cohort(generate_synthetic_data(num_people=15, min_meals=1, max_meals=6))
+
+
+def test_parameter_grid():
+    settings = parameter_grid({'delta': [2, 4], 'alpha': [1, 2, 3]})
+
+    assert len(settings) == 6
+    assert (4, 1, 3) in settings
+    assert parameter_grid([(1, 2, 3)]) == [(1, 2, 3)]
+    with pytest.raises(ValueError):
+        parameter_grid({'gamma': [1]})
+
+
+@pytest.mark.parametrize("max_time_gap", [None, 4])
+def test_sweep_matches_individual_builds(cohort, max_time_gap):
+    """Test that every matrix of the sweep equals a separate build with that setting."""
+    grid = {'delta': [3, 23], 'beta': [0.5, 1, 2], 'alpha': [1, 2]}
+    matrices = calculate_distance_matrix_sweep(cohort, grid, max_time_gap=max_time_gap, tile_size=4)
+
+    assert len(matrices) == 12
+    for (delta, beta, alpha), matrix in matrices.items():
+        expected = calculate_distance_matrix(cohort, delta=delta, beta=beta, alpha=alpha, max_time_gap=max_time_gap)
+        assert np.allclose(matrix, expected), f"Mismatch for delta={delta}, beta={beta}, alpha={alpha}"
+
+
+def test_sweep_streams_to_disk(cohort, tmp_path):
+    """Test that the sweep can write one memory-mapped condensed matrix per setting."""
+    grid = [(4, 1, 2), (8, 2, 1)]
+    matrices = calculate_distance_matrix_sweep(cohort.to_prepared(), grid, dtype=np.float32, path=str(tmp_path))
+
+    assert len(list(tmp_path.iterdir())) == 2
+    for (delta, beta, alpha), matrix in matrices.items():
+        expected = calculate_distance_matrix(cohort, delta=delta, beta=beta, alpha=alpha)
+        reopened = CondensedDistanceMatrix.open(matrix.data.filename, dtype=np.float32)
+        assert np.allclose(reopened.to_dense(), expected, rtol=1e-6)
@@ -0,0 +1,90 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils import synthetic
+from data.utils.ingest import iter_persons
+from data.utils.synthetic import (ARCHETYPES, SEED_BLOCK_SIZE, Archetype, generate_cohort, iter_synthetic_chunks, normalize_chunk,
+                                  write_event_log)
+
+MIX = {'regular': 2, 'skipper': 1, 'snacker': 1, 'night_eater': 1}
+
+
+def _chunks(num_people, **kwargs):
+    return list(iter_synthetic_chunks(num_people, archetypes=MIX, n_nutrients=2, **kwargs))
+
+
+@pytest.mark.parametrize("chunk_size,n_jobs", [(1000, 1), (SEED_BLOCK_SIZE + 7, 1), (2500, 2)])
+def test_persons_do_not_depend_on_chunking(chunk_size, n_jobs):
+    """Test that chunk size and worker count never change the persons drawn."""
+    num_people = SEED_BLOCK_SIZE + 1500
+    reference = generate_cohort(num_people, chunk_size=num_people, archetypes=MIX, n_nutrients=2)
+    chunks = _chunks(num_people, chunk_size=chunk_size, n_jobs=n_jobs)
+    cohort = generate_cohort(num_people, chunk_size=chunk_size, archetypes=MIX, n_nutrients=2, n_jobs=n_jobs)
+
+    assert [len(chunk.ids) for chunk in chunks[:-1]] == [chunk_size] * (len(chunks) - 1)
+    assert sum(len(chunk.ids) for chunk in chunks) == num_people
+    for name in ('ids', 'times', 'nutrients', 'offsets'):
+        assert np.array_equal(getattr(cohort, name), getattr(reference, name))
+
+
+def test_every_seed_block_is_drawn_once(monkeypatch):
+    calls = []
+    generate_block = synthetic._generate_block
+    monkeypatch.setattr(synthetic, '_generate_block', lambda *args: calls.append(args[1]) or generate_block(*args))
+    chunks = _chunks(SEED_BLOCK_SIZE + 1500, chunk_size=300)
+    assert calls == [0, 1]
+    assert [len(chunk.ids) for chunk in chunks] == [300] * 18 + [SEED_BLOCK_SIZE + 1500 - 5400]
+
+
+def test_seed_changes_persons():
+    a = _chunks(50, seed=1)[0]
+    b = _chunks(50, seed=2)[0]
+    assert not np.array_equal(a.nutrients[:10], b.nutrients[:10])
+
+
+def test_archetypes_shape_the_events():
+    chunk = _chunks(3000, n_days=2)[0]
+    lengths = np.diff(chunk.offsets)
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+
+    assert chunk.nutrients.shape == (len(chunk.times), 2)
+    assert set(chunk.archetypes.tolist()) == set(MIX)
+    for name in MIX:
+        archetype = ARCHETYPES[name]
+        persons = chunk.archetypes == name
+        assert lengths[persons].min() >= 2 * archetype.min_meals and lengths[persons].max() <= 2 * archetype.max_meals
+        hours = chunk.times[persons[owner]] % 24
+        assert np.argmax(np.bincount(hours.astype(int), minlength=24)) in np.argsort(archetype.hour_weights)[-6:]
+    for k in range(len(lengths)):
+        times = chunk.times[chunk.offsets[k]:chunk.offsets[k + 1]]
+        assert np.all(np.diff(times) > 0) and times.min() >= 0 and times.max() < 48
+
+
+def test_generated_cohort_is_prepared(tmp_path):
+    cohort = generate_cohort(300, archetypes=MIX, n_nutrients=3)
+    totals = np.add.reduceat(cohort.nutrients, cohort.offsets[:-1], axis=0)
+    assert np.allclose(totals, 1)
+
+    on_disk = generate_cohort(300, directory=str(tmp_path / "cohort"), chunk_size=128, archetypes=MIX, n_nutrients=3)
+    assert (tmp_path / "cohort" / "nutrients.npy").exists()
+    assert np.array_equal(on_disk.nutrients, cohort.nutrients) and on_disk.ids.tolist() == cohort.ids.tolist()
+
+
+@pytest.mark.parametrize("name", ["events.csv.gz", "events.jsonl"])
+def test_event_log_reads_back(tmp_path, name):
+    path = str(tmp_path / name)
+    write_event_log(path, 40, chunk_size=16, archetypes=MIX, n_nutrients=2)
+    persons = list(iter_persons(path, nutrient_columns=['nutrient_0', 'nutrient_1']))
+    expected = normalize_chunk(_chunks(40)[0])
+    cohort = prepare_cohort(persons)
+
+    assert cohort.ids.tolist() == expected.ids.tolist()
+    assert np.allclose(cohort.nutrients, expected.nutrients) and np.array_equal(cohort.times, expected.times)
+
+
+@pytest.mark.parametrize("archetypes", [{'regular': -1}, {'unknown': 1},
+                                        [Archetype('broken', 0, 2, tuple(np.ones(24)))], [Archetype('broken', 1, 2, (1.0,))]])
+def test_invalid_archetypes_give_error(archetypes):
+    with pytest.raises(ValueError):
+        next(iter_synthetic_chunks(10, archetypes=archetypes))
@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import prepare_cohort
+from data.utils.modified_mdtw import (mdtw_distance, mdtw_distance_optimized, exact_time_gap,
+                                      calculate_distance_matrix, generate_synthetic_data)
+
+
+def random_sequence(rng, m, dim):
+    times = np.sort(rng.uniform(0, 24, m))
+    return [(float(t), list(v)) for t, v in zip(times, rng.uniform(0, 1, (m, dim)))]
+
+
+@pytest.mark.parametrize("max_time_gap", [0.5, 2, 6])
+def test_band_matches_reference(max_time_gap):
+    """Test that the banded kernel agrees with the banded reference implementation."""
+    rng = np.random.default_rng(1)
+    for m1, m2 in [(4, 9), (15, 15), (30, 7)]:
+        ER1, ER2 = random_sequence(rng, m1, 2), random_sequence(rng, m2, 2)
+        expected = mdtw_distance(ER1, ER2, delta=4, max_time_gap=max_time_gap)
+        result = mdtw_distance_optimized(ER1, ER2, delta=4, max_time_gap=max_time_gap)
+        assert np.isclose(result, expected), f"Expected {expected}, but got {result}"
+        # Restricting the warping paths can only increase the distance
+        assert result >= mdtw_distance_optimized(ER1, ER2, delta=4) - 1e-12
+
+
+def test_band_with_unsorted_times():
+    """Test that the band is applied when event times are not sorted."""
+    rng = np.random.default_rng(2)
+    ER1, ER2 = random_sequence(rng, 8, 3)[::-1], random_sequence(rng, 11, 3)
+    expected = mdtw_distance(ER1, ER2, delta=4, max_time_gap=3)
+    assert np.isclose(mdtw_distance_optimized(ER1, ER2, delta=4, max_time_gap=3), expected)
+
+
+@pytest.mark.parametrize("delta, beta, alpha", [(4, 1, 2), (2, 3, 1), (6, 0.5, 1.5)])
+def test_band_is_exact_beyond_exact_time_gap(delta, beta, alpha):
+    """Test that the band does not change the distance once it is wide enough."""
+    rng = np.random.default_rng(3)
+    gap = exact_time_gap(delta, beta, alpha)
+    for _ in range(10):
+        ER1, ER2 = random_sequence(rng, 12, 2), random_sequence(rng, 10, 2)
+        exact = mdtw_distance_optimized(ER1, ER2, delta, beta, alpha)
+        assert np.isclose(mdtw_distance_optimized(ER1, ER2, delta, beta, alpha, max_time_gap=gap), exact)
+
+
+def test_distance_matrix_with_band():
+    """Test that the band is threaded through the matrix build."""
+    cohort = prepare_cohort(generate_synthetic_data(num_people=12, min_meals=1, max_meals=6))
+    banded = calculate_distance_matrix(cohort, delta=3, max_time_gap=exact_time_gap(3))
+
+    assert np.allclose(banded, calculate_distance_matrix(cohort, delta=3))
+    assert (calculate_distance_matrix(cohort, delta=3, max_time_gap=0.5) >= banded - 1e-12).all()
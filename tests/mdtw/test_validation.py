@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import PackedCohort, prepare_cohort
+from data.utils.modified_mdtw import (generate_synthetic_data, local_distance, mdtw_distance, mdtw_distance_optimized, prepare_person,
+                                      _local_distance)
+
+
+@pytest.fixture
+def sequences():
+    """Prepared two-nutrient sequences of synthetic persons."""
+    data = generate_synthetic_data(num_people=6, min_meals=1, max_meals=6)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'].append(float(k + record['time']))
+    return [list(prepare_person(person).items()) for person in data]
+
+
+def test_checked_and_trusted_paths_agree(sequences):
+    """Test that skipping the per-call checks does not change any distance."""
+    for ER1 in sequences:
+        for ER2 in sequences:
+            assert mdtw_distance(ER1, ER2, validate=False) == mdtw_distance(ER1, ER2)
+            assert mdtw_distance_optimized(ER1, ER2, validate=False) == mdtw_distance_optimized(ER1, ER2)
+            assert np.isclose(mdtw_distance(ER1, ER2), mdtw_distance_optimized(ER1, ER2))
+
+
+def test_local_distance_agrees_with_trusted_kernel(sequences):
+    for (ti, vi), (tj, vj) in zip(sequences[0], sequences[1]):
+        assert local_distance((ti, vi), (tj, vj), 5, 2, 3) == _local_distance(ti, np.array(vi), tj, np.array(vj), 5, 2, 3)
+
+
+@pytest.mark.parametrize("ER1,ER2", [
+    ([(1, [0.2, 0.3])], [(2, [0.3])]),
+    ([(1, [-0.2])], [(2, [0.3])]),
+    ([(1, [1.2])], [(2, [0.3])]),
+])
+def test_checked_reference_gives_error(ER1, ER2):
+    """Test that the reference keeps the errors of local_distance."""
+    with pytest.raises(ValueError):
+        mdtw_distance(ER1, ER2)
+
+
+@pytest.mark.parametrize("nutrients", [[-100], [float('nan')], [float('inf')]])
+def test_preparation_rejects_invalid_nutrients(nutrients):
+    person = {'person_id': 'person_1', 'records': [{'time': 8, 'nutrients': [300]}, {'time': 13, 'nutrients': nutrients}]}
+    with pytest.raises(ValueError):
+        prepare_person(person)
+    with pytest.raises(ValueError):
+        prepare_cohort([person])
+
+
+def test_from_prepared_rejects_invalid_nutrients():
+    with pytest.raises(ValueError):
+        PackedCohort.from_prepared({'person_1': {8.0: [0.5], 13.0: [1.5]}})
+    with pytest.raises(ValueError):
+        mdtw_distance_optimized([(8.0, [float('nan')])], [(9.0, [0.5])])
@@ -0,0 +1,134 @@
+import pytest
+import numpy as np
+
+from data.utils.cohort import PackedCohort, PackedCohortWriter, nutrient_weight_factor, prepare_cohort
+from data.utils.incremental import IncrementalDistanceMatrix
+from data.utils.knn import MDTWIndex
+from data.utils.modified_mdtw import (calculate_distance_matrix, generate_synthetic_data, local_distance, mdtw_distance,
+                                      mdtw_distance_optimized, prepare_person)
+
+W = np.array([[2.0, 0.5, 0.0],
+              [0.5, 1.0, 0.25],
+              [0.0, 0.25, 0.5]])
+
+
+@pytest.fixture
+def persons():
+    """Synthetic persons with three nutrients."""
+    data = generate_synthetic_data(num_people=8, min_meals=1, max_meals=6)
+    for k, person in enumerate(data):
+        for record in person['records']:
+            record['nutrients'] += [float(k + 1), float(record['time'] + 1)]
+    return data
+
+
+@pytest.fixture
+def prepared_data(persons):
+    return {person['person_id']: prepare_person(person) for person in persons}
+
+
+def weighted_local_distance(eo_i, eo_j, delta=23, beta=1, alpha=2):
+    """Direct evaluation of the weighted local distance."""
+    (ti, vi), (tj, vj) = eo_i, eo_j
+    vi, vj = np.array(vi), np.array(vj)
+    diff = vi - vj
+    return diff @ W @ diff + 2 * beta * (vi @ W @ vj) * (abs(ti - tj) / delta) ** alpha
+
+
+@pytest.mark.parametrize("weights", [np.array([2.0, 1.0, 0.5]), W, np.array([[1.0, 1.0, 0.0], [1.0, 1.0, 0.0], [0.0, 0.0, 1.0]])])
+def test_factor_reproduces_weights(weights):
+    factor = nutrient_weight_factor(weights)
+    expected = np.diag(weights) if weights.ndim == 1 else weights
+    assert np.allclose(factor @ factor.T, expected)
+
+
+@pytest.mark.parametrize("weights", [
+    np.ones((2, 3)),
+    np.array([[1.0, 0.5], [0.0, 1.0]]),
+    np.array([[1.0, 2.0], [2.0, 1.0]]),
+    np.array([[1.0, -0.5], [-0.5, 1.0]]),
+])
+def test_invalid_weights_give_error(weights):
+    with pytest.raises(ValueError):
+        nutrient_weight_factor(weights)
+
+
+def test_local_distance_with_weights(prepared_data):
+    events = [event for records in prepared_data.values() for event in records.items()]
+    for eo_i, eo_j in zip(events, events[1:]):
+        assert np.isclose(local_distance(eo_i, eo_j, 5, 2, 3, W=W), weighted_local_distance(eo_i, eo_j, 5, 2, 3))
+
+
+def test_identity_weights_change_nothing(prepared_data):
+    sequences = [list(records.items()) for records in prepared_data.values()]
+    for ER1, ER2 in zip(sequences, sequences[1:]):
+        assert np.isclose(mdtw_distance(ER1, ER2, W=np.eye(3)), mdtw_distance(ER1, ER2))
+        assert np.isclose(mdtw_distance_optimized(ER1, ER2, W=np.ones(3)), mdtw_distance_optimized(ER1, ER2))
+    assert np.allclose(calculate_distance_matrix(prepared_data, W=np.eye(3)), calculate_distance_matrix(prepared_data))
+
+
+def test_weighted_distance_matches_reference(prepared_data):
+    sequences = [list(records.items()) for records in prepared_data.values()]
+    for ER1, ER2 in zip(sequences, sequences[1:]):
+        expected = mdtw_distance(ER1, ER2, W=W)
+        assert np.isclose(mdtw_distance_optimized(ER1, ER2, W=W), expected)
+        assert not np.isclose(expected, mdtw_distance(ER1, ER2))
+
+
+def test_weighted_matrix_matches_pairwise(prepared_data):
+    sequences = [list(records.items()) for records in prepared_data.values()]
+    expected = np.array([[mdtw_distance(ER1, ER2, W=W) for ER2 in sequences] for ER1 in sequences])
+    assert np.allclose(calculate_distance_matrix(prepared_data, W=W), expected)
+    assert np.allclose(calculate_distance_matrix(PackedCohort.from_prepared(prepared_data, W=W)), expected)
+
+
+def test_prepare_cohort_with_weights(persons, prepared_data):
+    cohort = prepare_cohort(persons, W=W)
+    assert np.allclose(cohort.nutrients, PackedCohort.from_prepared(prepared_data).nutrients @ nutrient_weight_factor(W))
+
+
+def test_weights_with_callback_give_error(prepared_data):
+    with pytest.raises(ValueError):
+        calculate_distance_matrix(prepared_data, callback=mdtw_distance, W=W)
+
+
+def test_index_and_incremental_matrix_with_weights(prepared_data):
+    expected = calculate_distance_matrix(prepared_data, W=W)
+    ids = list(prepared_data)
+    index = MDTWIndex(prepared_data, W=W)
+    result = index.query(prepared_data[ids[0]], k=3)
+    assert np.allclose(result.distances, np.sort(expected[0])[:3])
+
+    matrix = IncrementalDistanceMatrix(W=W)
+    matrix.add({person_id: prepared_data[person_id] for person_id in ids[:4]})
+    matrix.add({person_id: prepared_data[person_id] for person_id in ids[4:]})
+    assert np.allclose(matrix.matrix.to_dense(), expected)
+
+
+def test_weights_applied_twice_give_error(persons, prepared_data, tmp_path):
+    """Test that a weighted cohort keeps its weights and cannot be weighted again."""
+    cohort = prepare_cohort(persons, W=W)
+    assert np.array_equal(cohort.weight_factor, nutrient_weight_factor(W))
+    with pytest.raises(ValueError):
+        calculate_distance_matrix(cohort, W=W)
+    with pytest.raises(ValueError):
+        MDTWIndex(cohort, W=np.diag([1.0, 2.0, 3.0]))
+    with pytest.raises(ValueError):
+        IncrementalDistanceMatrix(W=W).add(cohort)
+    with pytest.raises(ValueError):
+        cohort.subset([0, 1]).concat(prepare_cohort(persons))
+
+    cohort.save(str(tmp_path / "cohort.npz"))
+    assert np.array_equal(PackedCohort.load(str(tmp_path / "cohort.npz")).weight_factor, cohort.weight_factor)
+    assert PackedCohort.load(str(tmp_path / "cohort.npz")).subset([2, 0]).concat(cohort).weight_factor is not None
+    with PackedCohortWriter(str(tmp_path / "packed")) as writer:
+        writer.append(cohort.subset([0, 1]))
+        writer.append(cohort.subset([2]))
+        with pytest.raises(ValueError):
+            writer.append(prepare_cohort(persons[3:]))
+    assert np.array_equal(PackedCohort.open(str(tmp_path / "packed")).weight_factor, cohort.weight_factor)
+
+    # A cohort weighted beforehand weights the queries of an index built without W
+    expected = calculate_distance_matrix(prepared_data, W=W)
+    result = MDTWIndex(cohort).query(prepared_data[cohort.ids[0]], k=3)
+    assert np.allclose(result.distances, np.sort(expected[0])[:3])